@@ -1,110 +1,235 @@
+import os, io, sys, gzip, shutil, multiprocessing
+import numpy as np, pandas as pd, argparse
 
-import Bio.SeqIO, time, gzip
-from operator import itemgetter
-import numpy as np, argparse
-
-def parse_blast(handle):
-	for line in handle:
-		r = line.split()
-		yield {
-			'qname':r[0],
-			'tname':r[1],
-			'pid':float(r[2]),
-			'len':float(r[3]),
-			'qcoords':sorted([int(r[6]), int(r[7])]),
-			'tcoords':sorted([int(r[8]), int(r[9])]),
-			'qlen':float(r[-2]),
-			'tlen':float(r[-1]),
-			'evalue':float(r[-4])
-			}
-
-def yield_alignment_blocks(handle):
-	# init block with 1st record
-	key, alns = None, None
-	for aln in parse_blast(handle):
-		if aln['qname'] == aln['tname']:
-			continue
-		key = (aln['qname'], aln['tname'])
-		alns = [aln]
-		break
-	# loop over remaining records
-	for aln in parse_blast(handle):
-		# skip self hits
-		if aln['qname'] == aln['tname']:
+BLAST_FIELDS = ['qname', 'tname', 'pid', 'len', 'mismatch', 'gapopen', 'qstart', 'qend', 'tstart', 'tend', 'evalue', 'bitscore', 'qlen', 'tlen']
+BLAST_USECOLS = ['qname', 'tname', 'pid', 'len', 'qstart', 'qend', 'tstart', 'tend', 'evalue', 'qlen', 'tlen']
+BLAST_DTYPES = {
+	'qname':str, 'tname':str, 'pid':np.float64, 'len':np.float64,
+	'qstart':np.int64, 'qend':np.int64, 'tstart':np.int64, 'tend':np.int64,
+	'evalue':np.float64, 'qlen':np.float64, 'tlen':np.float64,
+	}
+ANI_FIELDS = ['qname', 'tname', 'num_alns', 'pid', 'qcov', 'tcov']
+
+def read_blast_chunks(handle, chunksize=2000000):
+	""" Read outfmt '6 std qlen slen' in typed chunks; self hits are dropped """
+	try:
+		reader = pd.read_csv(handle, sep='\t', header=None, names=BLAST_FIELDS, usecols=BLAST_USECOLS,
+			dtype=BLAST_DTYPES, chunksize=chunksize, float_precision='round_trip')
+	except pd.errors.EmptyDataError:
+		return
+	for chunk in reader:
+		yield chunk[chunk['qname'].to_numpy() != chunk['tname'].to_numpy()].reset_index(drop=True)
+
+def block_starts(alns):
+	""" Boolean array marking the first row of each run of consecutive rows with the same (qname, tname) """
+	qname, tname = alns['qname'].to_numpy(), alns['tname'].to_numpy()
+	starts = np.ones(len(alns), dtype=bool)
+	starts[1:] = (qname[1:] != qname[:-1]) | (tname[1:] != tname[:-1])
+	return starts
+
+def yield_alignment_blocks(chunks):
+	""" Regroup chunks so that no (qname, tname) block is split; yield (alns, block_ids) """
+	carry = None
+	for alns in chunks:
+		if carry is not None:
+			alns = pd.concat([carry, alns], ignore_index=True)
+		if len(alns) == 0:
 			continue
-		# extend block
-		elif (aln['qname'], aln['tname']) == key:
-			alns.append(aln)
-		# yield block and start new one
-		else:
-			yield alns
-			key = (aln['qname'], aln['tname'])
-			alns = [aln]
-	yield alns
-
-def prune_alns(alns, min_length=0, min_evalue=1e-3):
-	# remove short aligns
-	alns = [aln for aln in alns if aln['len'] >= min_length and aln['evalue'] <= min_evalue]
-	return alns
-
-def compute_ani(alns):
-	return round(sum(a['len'] * a['pid'] for a in alns)/sum(a['len'] for a in alns),2)
-
-def compute_cov(alns):
-
-	# merge qcoords
-	coords = sorted([a['qcoords'] for a in alns])
-	nr_coords = [coords[0]]
-	for start, stop in coords[1:]:
-		# overlapping, update start coord
-		if start <= (nr_coords[-1][1] + 1):
-			nr_coords[-1][1] = max(nr_coords[-1][1], stop)
-		# non-overlapping, append to list
-		else:
-			nr_coords.append([start, stop])
-	# compute qry_cov
-	alen = sum([stop - start + 1 for start, stop in nr_coords])
-	qcov = round(100.0*alen/alns[0]['qlen'],2)
-
-	# merge tcoords
-	coords = sorted([a['tcoords'] for a in alns])
-	nr_coords = [coords[0]]
-	for start, stop in coords[1:]:
-		# overlapping, update start coord
-		if start <= (nr_coords[-1][1] + 1):
-			nr_coords[-1][1] = max(nr_coords[-1][1], stop)
-		# non-overlapping, append to list
-		else:
-			nr_coords.append([start, stop])
-	# compute qry_cov
-	alen = sum([stop - start + 1 for start, stop in nr_coords])
-	tcov = round(100.0*alen/ alns[0]['tlen'],2)
-
-	return qcov, tcov
+		block_ids = np.cumsum(block_starts(alns)) - 1
+		# last block may continue in the next chunk
+		last = np.searchsorted(block_ids, block_ids[-1])
+		carry = alns.iloc[last:]
+		if last > 0:
+			yield alns.iloc[:last], block_ids[:last]
+	if carry is not None and len(carry) > 0:
+		yield carry, np.zeros(len(carry), dtype=np.int64)
+
+def merged_length(block_ids, start, stop, num_blocks):
+	""" Per block, total length of the union of closed intervals [start, stop]; touching intervals are merged """
+	# block ids are sorted; offsetting coordinates by block keeps blocks apart in a single sort key and running max
+	offset = block_ids * (int(stop.max()) + 2) if len(stop) else block_ids
+	order = np.argsort(start + offset, kind='stable')
+	block_ids, start, stop, offset = block_ids[order], start[order], stop[order], offset[order]
+	end = np.maximum.accumulate(stop + offset) - offset
+	new_seg = np.ones(len(start), dtype=bool)
+	new_seg[1:] = (block_ids[1:] != block_ids[:-1]) | (start[1:] > end[:-1] + 1)
+	seg_first = np.flatnonzero(new_seg)
+	seg_last = np.r_[seg_first[1:] - 1, len(start) - 1].astype(np.int64)
+	seg_len = (end[seg_last] - start[seg_first] + 1).astype(np.float64)
+	return np.bincount(block_ids[seg_first], weights=seg_len, minlength=num_blocks)
+
+def compute_ani_cov(alns, block_ids, min_length=0, min_evalue=1e-3):
+	""" Prune HSPs and compute [qname, tname, num_alns, pid, qcov, tcov] for every block with alignments left """
+	keep = (alns['len'].to_numpy() >= min_length) & (alns['evalue'].to_numpy() <= min_evalue)
+	alns, block_ids = alns[keep], block_ids[keep]
+	if len(alns) == 0:
+		return pd.DataFrame(columns=ANI_FIELDS)
+	# renumber surviving blocks 0..n-1
+	first = np.ones(len(block_ids), dtype=bool)
+	first[1:] = block_ids[1:] != block_ids[:-1]
+	block_ids = np.cumsum(first) - 1
+	num_blocks = int(block_ids[-1]) + 1
+	length, pid = alns['len'].to_numpy(), alns['pid'].to_numpy()
+	ani = np.bincount(block_ids, weights=length * pid, minlength=num_blocks) / np.bincount(block_ids, weights=length, minlength=num_blocks)
+	qstart, qend = alns['qstart'].to_numpy(), alns['qend'].to_numpy()
+	tstart, tend = alns['tstart'].to_numpy(), alns['tend'].to_numpy()
+	qalen = merged_length(block_ids, np.minimum(qstart, qend), np.maximum(qstart, qend), num_blocks)
+	talen = merged_length(block_ids, np.minimum(tstart, tend), np.maximum(tstart, tend), num_blocks)
+	first = np.flatnonzero(first)
+	return pd.DataFrame({
+		'qname': alns['qname'].to_numpy()[first],
+		'tname': alns['tname'].to_numpy()[first],
+		'num_alns': np.bincount(block_ids, minlength=num_blocks),
+		'pid': round_values(ani),
+		'qcov': round_values(100.0 * qalen / alns['qlen'].to_numpy()[first]),
+		'tcov': round_values(100.0 * talen / alns['tlen'].to_numpy()[first]),
+		})
+
+def round_values(values):
+	""" Round to 2 decimals with Python's round, which is what the ani table has always held """
+	return np.array([round(x, 2) for x in values.tolist()], dtype=np.float64)
+
+def filter_ani(ani, min_ani=0, min_qcov=0, min_tcov=0):
+	""" Keep ani rows meeting all thresholds, compared at float32 precision like cluster.py """
+	keep = (ani['qcov'].to_numpy(np.float32) >= np.float32(min_qcov)) & (ani['tcov'].to_numpy(np.float32) >= np.float32(min_tcov)) & (ani['pid'].to_numpy(np.float32) >= np.float32(min_ani))
+	return ani if keep.all() else ani[keep]
+
+def format_rows(ani):
+	""" Format ani rows as tab-delimited lines """
+	return ''.join(['%s\t%s\t%s\t%s\t%s\t%s\n' % row
+		for row in zip(ani['qname'].tolist(), ani['tname'].tolist(), ani['num_alns'].tolist(),
+			ani['pid'].tolist(), ani['qcov'].tolist(), ani['tcov'].tolist())])
+
+def write_ani(handle, out, min_length=0, thresholds=(0, 0, 0), chunksize=2000000):
+	""" Stream a blastn table from handle, aggregate blocks as they arrive and write threshold-passing ani rows (no header) """
+	num_pairs = 0
+	for alns, block_ids in yield_alignment_blocks(read_blast_chunks(handle, chunksize)):
+		ani = filter_ani(compute_ani_cov(alns, block_ids, min_length=min_length), *thresholds)
+		out.write(format_rows(ani))
+		num_pairs += len(ani)
+	return num_pairs
+
+def blast_to_ani(handle, out, min_length=0, thresholds=(0, 0, 0), chunksize=2000000):
+	""" Write the ani table (with header) for a blastn table read from handle """
+	out.write('\t'.join(ANI_FIELDS)+'\n')
+	return write_ani(handle, out, min_length, thresholds, chunksize)
 
+class TeeReader(io.RawIOBase):
+	""" Pass bytes read from a binary handle through, copying them to out """
+	def __init__(self, handle, out):
+		self.handle = handle
+		self.out = out
+
+	def readable(self):
+		return True
+
+	def readinto(self, buffer):
+		size = self.handle.readinto(buffer)
+		self.out.write(memoryview(buffer)[:size])
+		return size
+
+class FileSlice(io.RawIOBase):
+	""" Read-only view of bytes [start, end) of a file """
+	def __init__(self, path, start, end):
+		self.handle = open(path, 'rb')
+		self.handle.seek(start)
+		self.remaining = end - start
+
+	def readable(self):
+		return True
+
+	def readinto(self, buffer):
+		size = self.handle.readinto(memoryview(buffer)[:min(len(buffer), self.remaining)])
+		self.remaining -= size
+		return size
+
+	def close(self):
+		self.handle.close()
+		super().close()
+
+def shard_offsets(path, num_shards):
+	""" Split a blastn table into at most num_shards byte ranges that start at query block boundaries """
+	size = os.path.getsize(path)
+	offsets = [0]
+	with open(path, 'rb') as handle:
+		for i in range(1, num_shards):
+			target = max(size * i // num_shards, offsets[-1])
+			# align to the start of the first line at or after target
+			handle.seek(max(target - 1, 0))
+			if target > 0:
+				handle.readline()
+			line = handle.readline()
+			qname = line.split(b'\t', 1)[0]
+			# move forward to the first line of the next query
+			while line:
+				pos = handle.tell()
+				line = handle.readline()
+				if line.split(b'\t', 1)[0] != qname:
+					break
+			if line and pos > offsets[-1]:
+				offsets.append(pos)
+	offsets.append(size)
+	return list(zip(offsets[:-1], offsets[1:]))
+
+def ani_shard(path, start, end, out_path, min_length=0, thresholds=(0, 0, 0), chunksize=2000000):
+	""" Worker: compute ani rows (without header) for one byte range of a blastn table """
+	handle = io.BufferedReader(FileSlice(path, start, end), buffer_size=1<<20)
+	with open(out_path, 'w', buffering=1<<20) as out:
+		num_pairs = write_ani(handle, out, min_length, thresholds, chunksize)
+	handle.close()
+	return num_pairs
+
+def blast_to_ani_parallel(path, out, threads, min_length=0, thresholds=(0, 0, 0), chunksize=2000000):
+	""" Compute ani rows for query shards in a process pool and concatenate them to out in file order """
+	shards = shard_offsets(path, threads)
+	shard_paths = ["%s.shard%s" % (out.name, i) for i in range(len(shards))]
+	with multiprocessing.Pool(min(threads, len(shards))) as pool:
+		num_pairs = pool.starmap(ani_shard, [(path, start, end, shard_path, min_length, thresholds, chunksize) for (start, end), shard_path in zip(shards, shard_paths)])
+	out.write('\t'.join(ANI_FIELDS)+'\n')
+	for shard_path in shard_paths:
+		with open(shard_path) as shard:
+			shutil.copyfileobj(shard, out, 1<<20)
+		os.remove(shard_path)
+	return sum(num_pairs)
 
 def parse_arguments():
 	parser = argparse.ArgumentParser()
 	parser.add_argument('-i', dest='input', type=str, required=True, metavar='PATH',
-		help="path to blastn input file (format: 'std 6 qlen slen')")
+		help="path to blastn input file (format: 'std 6 qlen slen'); '-' streams it from stdin, e.g. piped from blastn")
 	parser.add_argument('-o', dest='output', type=str, required=True, metavar='PATH',
 		help="path to ani file")
-	parser.add_argument('-l', dest='length', type=int, metavar='INT',
+	parser.add_argument('-l', dest='length', type=int, metavar='INT', default=0,
 		help="minimum alignment length to keep")
+	parser.add_argument('-t', dest='threads', type=int, metavar='INT', default=1,
+		help="number of processes; the input is split into query shards (default=1; gzipped input is read serially)")
+	parser.add_argument('--min_ani', type=float, metavar='FLOAT', default=0,
+		help="only write pairs with ani >= FLOAT (default=0)")
+	parser.add_argument('--min_qcov', type=float, metavar='FLOAT', default=0,
+		help="only write pairs with qcov >= FLOAT (default=0)")
+	parser.add_argument('--min_tcov', type=float, metavar='FLOAT', default=0,
+		help="only write pairs with tcov >= FLOAT (default=0)")
+	parser.add_argument('--blast_out', type=str, metavar='PATH',
+		help="with '-i -', also keep a copy of the raw blastn table at PATH")
+	parser.add_argument('--chunksize', type=int, metavar='INT', default=2000000,
+		help="number of blast rows parsed per chunk (default=2000000)")
 	return vars(parser.parse_args())
-		
+
 if __name__ == "__main__":
 	args = parse_arguments()
-	out = gzip.open(args['output'], 'w') if args['output'].split('.')[-1]=='gz' else open(args['output'], 'w')
-	fields = ['qname', 'tname', 'num_alns', 'pid', 'qcov', 'tcov']
-	out.write('\t'.join(fields)+'\n')
-	input = gzip.open(args['input']) if args['input'].split('.')[-1]=='gz' else open(args['input'])
-	for alns in yield_alignment_blocks(input):
-		alns = prune_alns(alns)
-		if len(alns) == 0: continue
-		qname, tname = alns[0]['qname'], alns[0]['tname']
-		ani = compute_ani(alns)
-		qcov, tcov = compute_cov(alns)
-		row = [qname, tname, len(alns), ani, qcov, tcov]
-		out.write('\t'.join([str(_) for _ in row])+'\n')
-
+	out = gzip.open(args['output'], 'wt') if args['output'].split('.')[-1]=='gz' else open(args['output'], 'w', buffering=1<<20)
+	thresholds = (args['min_ani'], args['min_qcov'], args['min_tcov'])
+	if args['input'] == '-':
+		input = sys.stdin.buffer
+		if args['blast_out']:
+			blast_out = open(args['blast_out'], 'wb')
+			input = io.BufferedReader(TeeReader(input, blast_out), buffer_size=1<<20)
+		blast_to_ani(input, out, min_length=args['length'], thresholds=thresholds, chunksize=args['chunksize'])
+		if args['blast_out']:
+			blast_out.close()
+	elif args['threads'] > 1 and args['input'].split('.')[-1]!='gz':
+		blast_to_ani_parallel(args['input'], out, args['threads'], min_length=args['length'], thresholds=thresholds, chunksize=args['chunksize'])
+	else:
+		input = gzip.open(args['input'], 'rt') if args['input'].split('.')[-1]=='gz' else open(args['input'])
+		blast_to_ani(input, out, min_length=args['length'], thresholds=thresholds, chunksize=args['chunksize'])
+		input.close()
+	out.close()
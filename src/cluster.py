@@ -1,20 +1,250 @@
 #!/usr/bin/env python
 
-import time, resource, platform, sys, argparse, gzip
-
-def parse_seqs(path):
-	handle = gzip.open(path) if path.split('.')[-1] == 'gz' else open(path)
-	id = next(handle).split()[0][1:]
-	seq = ''
-	for line in handle:
-		if line[0] == '>':
-			yield id, seq
-			id = line.split()[0][1:]
-			seq = ''
+import os, time, resource, platform, sys, argparse, gzip, itertools
+import numpy as np, pandas as pd
+from utils import fasta
+
+def read_seqs(path, min_length=1, exclude=None, keep=None):
+	""" Return retained sequence ids and a matching array of lengths, in fna order """
+	ids, lengths = fasta.read_lengths(path)
+	retain = lengths >= min_length
+	if exclude:
+		retain &= np.fromiter((id not in exclude for id in ids), dtype=bool, count=len(ids))
+	if keep:
+		retain &= np.fromiter((id in keep for id in ids), dtype=bool, count=len(ids))
+	return [id for id, r in zip(ids, retain) if r], lengths[retain]
+
+def read_edge_table(path, seq_index, chunksize=5000000):
+	""" Stream blastani table in chunks; yield integer-encoded (qidx, tidx, ani, qcov, tcov) arrays """
+	if path == '-':
+		# edges piped from blastani.py; peek at the header without consuming the stream
+		source = sys.stdin.buffer
+		skiprows = 1 if source.peek(6)[:6] == b'qname\t' else 0
+	else:
+		source = path
+		handle = gzip.open(path, 'rt') if path.split('.')[-1] == 'gz' else open(path)
+		skiprows = 1 if handle.readline().split('\t')[0] == 'qname' else 0
+		handle.close()
+	reader = pd.read_csv(source, sep='\t', header=None, skiprows=skiprows, chunksize=chunksize,
+		usecols=[0, 1, 3, 4, 5], names=['qname', 'tname', 'num_alns', 'ani', 'qcov', 'tcov'],
+		dtype={'qname':str, 'tname':str, 'ani':np.float32, 'qcov':np.float32, 'tcov':np.float32})
+	for chunk in reader:
+		qidx = seq_index.get_indexer(chunk['qname']).astype(np.int32)
+		tidx = seq_index.get_indexer(chunk['tname']).astype(np.int32)
+		# drop self hits and ids not retained from fna
+		keep = (qidx >= 0) & (tidx >= 0) & (qidx != tidx)
+		yield (qidx[keep], tidx[keep], chunk['ani'].to_numpy()[keep],
+			chunk['qcov'].to_numpy()[keep], chunk['tcov'].to_numpy()[keep])
+
+def pass_thresholds(ani, qcov, tcov, min_ani, min_qcov, min_tcov):
+	""" Boolean mask of edges meeting all thresholds (compared at stored float32 precision) """
+	return (qcov >= np.float32(min_qcov)) & (tcov >= np.float32(min_tcov)) & (ani >= np.float32(min_ani))
+
+def read_edges(path, seq_index, min_ani, min_qcov, min_tcov, chunksize=5000000):
+	""" Stream blastani table in chunks; yield integer-encoded (qidx, tidx) arrays of retained edges """
+	for qidx, tidx, ani, qcov, tcov in read_edge_table(path, seq_index, chunksize):
+		keep = pass_thresholds(ani, qcov, tcov, min_ani, min_qcov, min_tcov)
+		yield qidx[keep], tidx[keep]
+
+def build_csr(qidx, tidx, num_seqs):
+	""" Build compressed sparse row arrays (indptr, indices) from lists of edge chunks, keeping file order per row """
+	qidx = np.concatenate(qidx) if len(qidx) else np.zeros(0, dtype=np.int32)
+	tidx = np.concatenate(tidx) if len(tidx) else np.zeros(0, dtype=np.int32)
+	order = np.argsort(qidx, kind='stable')
+	indices = tidx[order]
+	del order
+	indptr = np.zeros(num_seqs + 1, dtype=np.int64)
+	np.cumsum(np.bincount(qidx, minlength=num_seqs), out=indptr[1:])
+	return indptr, indices
+
+def subset_csr(indptr, indices, keep):
+	""" Return CSR arrays restricted to edges where keep is True """
+	rows = np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+	sub_indptr = np.zeros(len(indptr), dtype=np.int64)
+	np.cumsum(np.bincount(rows[keep], minlength=len(indptr) - 1), out=sub_indptr[1:])
+	return sub_indptr, indices[keep]
+
+def edge_cache_path(ani_path):
+	""" Binary edge cache stored next to the blastani table, e.g. filtered_ani.tsv -> filtered_ani.npz """
+	path = ani_path[:-3] if ani_path.endswith('.gz') else ani_path
+	return os.path.splitext(path)[0] + '.npz'
+
+def source_fingerprint(*paths):
+	""" Size and mtime of input files, used to invalidate a stale cache """
+	return np.array([[os.stat(p).st_size, os.stat(p).st_mtime_ns] for p in paths], dtype=np.int64)
+
+def build_edge_cache(fna, ani, path, chunksize=5000000):
+	""" Parse fna and blastani table once, save ID-encoded CSR edges with ani/qcov/tcov to an .npz file """
+	seqs, lengths = read_seqs(fna, min_length=0)
+	qidx, tidx, ani_vals, qcov, tcov = [], [], [], [], []
+	for q, t, a, qc, tc in read_edge_table(ani, pd.Index(seqs), chunksize):
+		qidx.append(q); tidx.append(t); ani_vals.append(a); qcov.append(qc); tcov.append(tc)
+	qidx = np.concatenate(qidx) if len(qidx) else np.zeros(0, dtype=np.int32)
+	order = np.argsort(qidx, kind='stable')
+	indptr = np.zeros(len(seqs) + 1, dtype=np.int64)
+	np.cumsum(np.bincount(qidx, minlength=len(seqs)), out=indptr[1:])
+	del qidx
+	cache = {
+		'seqs': np.array(seqs, dtype=bytes),
+		'lengths': lengths,
+		'indptr': indptr,
+		'source': source_fingerprint(fna, ani),
+	}
+	for key, chunks, dtype in [('indices', tidx, np.int32), ('ani', ani_vals, np.float32), ('qcov', qcov, np.float32), ('tcov', tcov, np.float32)]:
+		cache[key] = np.concatenate(chunks)[order] if len(chunks) else np.zeros(0, dtype=dtype)
+		del chunks[:]
+	np.savez(path, **cache)
+	cache['seqs'] = cache['seqs'].astype(str).tolist()
+	return cache
+
+def load_edge_cache(fna, ani, path):
+	""" Return cached edges if the cache exists and matches the current inputs, else None """
+	if not os.path.exists(path):
+		return None
+	with np.load(path) as f:
+		cache = dict(f)
+	if not np.array_equal(cache['source'], source_fingerprint(fna, ani)):
+		return None
+	cache['seqs'] = cache['seqs'].astype(str).tolist()
+	return cache
+
+def compact_csr(indptr, indices, retain):
+	""" Return CSR arrays induced on retained seqs, re-encoded to a compact range, and the kept-edge mask """
+	new_idx = np.cumsum(retain) - 1
+	rows = np.repeat(np.arange(len(retain)), np.diff(indptr))
+	edge_keep = retain[rows] & retain[indices]
+	sub_indptr, _ = subset_csr(indptr, indices, edge_keep)
+	sub_indptr = sub_indptr[np.r_[0, np.flatnonzero(retain) + 1]]
+	return sub_indptr, new_idx[indices[edge_keep]].astype(np.int32), edge_keep
+
+def select_seqs(cache, min_length=1, exclude=None, keep=None):
+	""" Restrict cached seqs and edges to retained sequences, re-encoding ids to a compact range """
+	seqs, lengths = cache['seqs'], cache['lengths']
+	retain = lengths >= min_length
+	if exclude:
+		retain &= ~np.fromiter((id in exclude for id in seqs), dtype=bool, count=len(seqs))
+	if keep:
+		retain &= np.fromiter((id in keep for id in seqs), dtype=bool, count=len(seqs))
+	indptr, indices, edge_keep = compact_csr(cache['indptr'], cache['indices'], retain)
+	return {
+		'seqs': [id for id, r in zip(seqs, retain) if r],
+		'lengths': lengths[retain],
+		'indptr': indptr,
+		'indices': indices,
+		'ani': cache['ani'][edge_keep],
+		'qcov': cache['qcov'][edge_keep],
+		'tcov': cache['tcov'][edge_keep],
+	}
+
+def greedy_cluster(lengths, indptr, indices):
+	""" Greedy centroid clustering over CSR edges; return the centroid index of every sequence
+
+	Sequences are visited from longest to shortest (ties keep input order). An unassigned
+	sequence becomes a centroid and recruits its unassigned neighbours. Sequences without
+	outgoing edges cannot recruit, so they are skipped in the loop and made singletons at
+	the end; neighbours ranked above the current centroid are therefore left alone.
+	"""
+	num_seqs = len(lengths)
+	order = np.argsort(-np.asarray(lengths), kind='stable')
+	rank = np.empty(num_seqs, dtype=np.int64)
+	rank[order] = np.arange(num_seqs)
+	centroids = np.full(num_seqs, -1, dtype=np.int64)
+	degree = np.diff(indptr)
+	for seq_idx in order[degree[order] > 0]:
+		if centroids[seq_idx] >= 0:
+			continue
+		centroids[seq_idx] = seq_idx
+		mem_idx = indices[indptr[seq_idx]:indptr[seq_idx+1]]
+		mem_idx = mem_idx[(centroids[mem_idx] < 0) & (rank[mem_idx] > rank[seq_idx])]
+		centroids[mem_idx] = seq_idx
+	singletons = np.flatnonzero(centroids < 0)
+	centroids[singletons] = singletons
+	return centroids
+
+def cluster_members(lengths, centroids, indptr, indices):
+	""" Yield (centroid, member indices) per cluster, longest centroid first; members follow edge order """
+	num_seqs = len(centroids)
+	rows = np.repeat(np.arange(num_seqs, dtype=np.int64), np.diff(indptr))
+	keep = centroids[indices] == rows
+	rows, mems = rows[keep], indices[keep].astype(np.int64)
+	# first occurrence of each (centroid, member) pair, kept in row-major edge order
+	first = np.sort(np.unique(rows * num_seqs + mems, return_index=True)[1])
+	rows, mems = rows[first], mems[first]
+	mem_ptr = np.zeros(num_seqs + 1, dtype=np.int64)
+	np.cumsum(np.bincount(rows, minlength=num_seqs), out=mem_ptr[1:])
+	order = np.argsort(-np.asarray(lengths), kind='stable')
+	for seq_idx in order[centroids[order] == order]:
+		yield seq_idx, mems[mem_ptr[seq_idx]:mem_ptr[seq_idx+1]]
+
+def write_clusters(path, seqs, lengths, centroids, indptr, indices):
+	""" Write tab-delimited [centroid, comma-separated members] table; return number of clusters """
+	seqs = np.asarray(seqs, dtype=object)
+	num_clusters = 0
+	with open(path, 'w') as out:
+		for seq_idx, mem_idx in cluster_members(lengths, centroids, indptr, indices):
+			out.write(seqs[seq_idx] + '\t' + ','.join([seqs[seq_idx]] + seqs[mem_idx].tolist())+'\n')
+			num_clusters += 1
+	return num_clusters
+
+def read_clusters(path):
+	""" Return centroid ids and member id lists of an existing cluster table """
+	reps, members = [], []
+	with open(path) as handle:
+		for line in handle:
+			rep, mem_ids = line.rstrip('\n').split('\t')
+			reps.append(rep)
+			members.append(mem_ids.split(','))
+	return reps, members
+
+def read_incremental_edges(path, seq_index, num_reps, min_ani, min_qcov, min_tcov, chunksize=5000000):
+	""" Stream blastani table of new seqs (queries) against centroids and each other; yield (qidx, tidx) edges
+
+	Alignments of a new seq against an existing centroid are flipped so that the centroid is the
+	query, as in a full all-vs-all run; edges between two centroids are dropped.
+	"""
+	for qidx, tidx, ani, qcov, tcov in read_edge_table(path, seq_index, chunksize):
+		flip = (qidx >= num_reps) & (tidx < num_reps)
+		qidx, tidx = np.where(flip, tidx, qidx), np.where(flip, qidx, tidx)
+		qcov, tcov = np.where(flip, tcov, qcov), np.where(flip, qcov, tcov)
+		keep = (tidx >= num_reps) & pass_thresholds(ani, qcov, tcov, min_ani, min_qcov, min_tcov)
+		yield qidx[keep], tidx[keep]
+
+def extend_clusters(num_reps, lengths, indptr, indices):
+	""" Add new seqs to an existing clustering; return the centroid index of every seq
+
+	Seq indices below num_reps are existing centroids in cluster table order, the rest are new.
+	A new seq joins the first existing centroid (in table order) with an edge to it; the leftovers
+	are clustered among themselves with greedy_cluster.
+	"""
+	num_seqs = len(lengths)
+	rows = np.repeat(np.arange(num_seqs, dtype=np.int64), np.diff(indptr))
+	from_rep = rows < num_reps
+	best = np.full(num_seqs, num_seqs, dtype=np.int64)
+	np.minimum.at(best, indices[from_rep], rows[from_rep])
+	centroids = np.where(best < num_reps, best, -1)
+	centroids[:num_reps] = np.arange(num_reps)
+	leftover = np.flatnonzero(centroids < 0)
+	sub_indptr, sub_indices, _ = compact_csr(indptr, indices, centroids < 0)
+	centroids[leftover] = leftover[greedy_cluster(lengths[leftover], sub_indptr, sub_indices)]
+	return centroids
+
+def write_extended_clusters(path, seqs, members, lengths, centroids, indptr, indices):
+	""" Write existing clusters in their original order with new members appended, then new clusters; return number of new clusters """
+	seqs = np.asarray(seqs, dtype=object)
+	num_reps = len(members)
+	new_mem_ids = {}
+	new_clusters = []
+	for seq_idx, mem_idx in cluster_members(lengths, centroids, indptr, indices):
+		if seq_idx < num_reps:
+			new_mem_ids[seq_idx] = seqs[mem_idx].tolist()
 		else:
-			seq += line.rstrip()
-	yield id, seq
-	handle.close()
+			new_clusters.append([seqs[seq_idx]] + seqs[mem_idx].tolist())
+	with open(path, 'w') as out:
+		for seq_idx, mem_ids in enumerate(members):
+			out.write(seqs[seq_idx] + '\t' + ','.join(mem_ids + new_mem_ids.get(seq_idx, []))+'\n')
+		for mem_ids in new_clusters:
+			out.write(mem_ids[0] + '\t' + ','.join(mem_ids)+'\n')
+	return len(new_clusters)
 
 def log_time(start):
 	current_time = time.time()
@@ -40,7 +270,8 @@ def parse_arguments():
 	parser.add_argument('--fna', type=str, required=True, metavar='PATH',
 		help="""Path to nucleotide sequences""")
 	parser.add_argument('--ani', type=str, required=True, metavar='PATH',
-		help="""Path to tab-delimited file with fields: [qname, tname, num_alns, ani, qcov, tcov]""")
+		help="""Path to tab-delimited file with fields: [qname, tname, num_alns, ani, qcov, tcov];
+'-' reads it from stdin, e.g. piped from blastani.py""")
 	parser.add_argument('--out', type=str, required=True, metavar='BASENAME',
 		help="""Path to output file""")
 	parser.add_argument('--exclude', type=str, metavar='PATH',
@@ -55,84 +286,136 @@ def parse_arguments():
 		help="""Minimum alignment coverage of shorter sequence (0...100, default=70)""")
 	parser.add_argument('--min_length', type=float, metavar='INT', default=1,
 		help="""Minimum sequence length (default=1)""")
+	parser.add_argument('--clusters', type=str, metavar='PATH',
+		help="""Path to an existing cluster table; the --fna seqs are added to it incrementally (requires --reps).
+--ani must hold alignments of the --fna seqs against the representatives and each other""")
+	parser.add_argument('--reps', type=str, metavar='PATH',
+		help="""Path to representative sequences of --clusters""")
+	parser.add_argument('--cache', action='store_true',
+		help="""Store parsed edges in a binary cache next to --ani (e.g. filtered_ani.npz), and reuse it
+while --fna and --ani are unchanged""")
+	parser.add_argument('--sweep_ani', type=float, nargs='+', metavar='FLOAT',
+		help="""Grid of --min_ani values to sweep (implies --cache)""")
+	parser.add_argument('--sweep_qcov', type=float, nargs='+', metavar='FLOAT',
+		help="""Grid of --min_qcov values to sweep (implies --cache)""")
+	parser.add_argument('--sweep_tcov', type=float, nargs='+', metavar='FLOAT',
+		help="""Grid of --min_tcov values to sweep (implies --cache);
+one table per grid point is written to <out>_ani<A>_qcov<Q>_tcov<T>.tsv""")
 	return vars(parser.parse_args())
 
-# main
-start = time.time()
-
-# args
-args = parse_arguments()
-
-# list seqs, sorted by length
-print("\nreading sequences...")
-seqs = {}
-exclude = set([_.rstrip() for _ in open(args['exclude'])]) if args['exclude'] else None
-keep = set([_.rstrip() for _ in open(args['keep'])]) if args['keep'] else None
-for index, r in enumerate(parse_seqs(args['fna'])):
-	id, seq  = r
-	if len(seq) < args['min_length']:
-		continue
-	elif exclude and id in exclude:
-		continue
-	elif keep and id not in keep:
-		continue
-	else:
-		seqs[id] = len(seq)
-seqs = [x[0] for x in sorted(seqs.items(), key=lambda x: x[1], reverse=True)]
-print("%s sequences retained from fna" % len(seqs))
-log_time(start)
-
-# store edges
-print("\nstoring edges...")
-num_edges = 0
-edges = dict([(x,[]) for x in seqs])
-handle = gzip.open(args['ani']) if args['ani'].split('.')[-1] == 'gz' else open(args['ani'])
-for index, line in enumerate(handle):
-	qname, tname, num_alns, ani, qcov, tcov = line.split()
-	if qname == tname:
-		continue
-	elif qname not in edges or tname not in edges:
-		continue
-	elif float(qcov) < args['min_qcov'] or float(tcov) < args['min_tcov'] or float(ani) < args['min_ani']:
-		continue
-	edges[qname].append(tname)
-	num_edges += 1
-#	if not num_edges % 1000000:
-#		current_time = time.time()
-#		program_time = round(current_time - start, 2)
-#		peak_ram = round(max_mem_usage(), 2)
-#		print("num edges: %s, seconds: %s, GB: %s" % (num_edges, program_time, peak_ram))
-handle.close()
-print("%s edges retained from blastani" % num_edges)
-print("%s edges currently stored" % sum([len(_) for _ in edges.values()]))
-log_time(start)
-
-# cluster
-print("\nclustering...")
-clust_to_seqs = {}
-seq_to_clust = {}
-# loop over seqs in sorted order
-for seq_id in seqs:
-	# seq already been assigned; cant be centroid
-	if seq_id in seq_to_clust:
-		continue
-	# seq is centroid for new cluster
-	else:
-		# add self to cluster
-		clust_to_seqs[seq_id] = [seq_id]
-		seq_to_clust[seq_id] = seq_id
-		# update with cluster members
-		for mem_id in edges[seq_id]:
-			if mem_id not in seq_to_clust:
-				clust_to_seqs[seq_id].append(mem_id)
-				seq_to_clust[mem_id] = seq_id
-print("%s total clusters" % len(clust_to_seqs))
-log_time(start)
-
-# write
-print("\nwriting clusters...")
-out = open(args['out'], 'w')
-for seq_id, mem_ids in clust_to_seqs.items():
-	out.write(seq_id + '\t' + ','.join(mem_ids)+'\n')
-log_time(start)
+def sweep_out_path(out, min_ani, min_qcov, min_tcov):
+	""" Output path of one sweep grid point, e.g. filtered_clusters.tsv -> filtered_clusters_ani95_qcov0_tcov85.tsv """
+	base, ext = os.path.splitext(out)
+	return "%s_ani%g_qcov%g_tcov%g%s" % (base, min_ani, min_qcov, min_tcov, ext or '.tsv')
+
+def main():
+	start = time.time()
+
+	# args
+	args = parse_arguments()
+	exclude = set([_.rstrip() for _ in open(args['exclude'])]) if args['exclude'] else None
+	keep = set([_.rstrip() for _ in open(args['keep'])]) if args['keep'] else None
+	sweep = args['sweep_ani'] or args['sweep_qcov'] or args['sweep_tcov']
+
+	if args['clusters']:
+		if not args['reps'] or args['cache'] or sweep:
+			sys.exit("error: --clusters requires --reps and cannot be combined with --cache or sweeps")
+		# existing centroids first, then new seqs
+		print("\nreading existing clusters and sequences...")
+		reps, members = read_clusters(args['clusters'])
+		clustered = set(itertools.chain.from_iterable(members))
+		rep_ids, rep_lengths = read_seqs(args['reps'], min_length=0, keep=set(reps))
+		rep_lengths = pd.Series(rep_lengths, index=rep_ids).reindex(reps).to_numpy()
+		if np.isnan(rep_lengths).any():
+			sys.exit("error: %s representatives are missing from %s" % (np.isnan(rep_lengths).sum(), args['reps']))
+		new_seqs, new_lengths = read_seqs(args['fna'], args['min_length'], exclude, keep)
+		new_mask = np.fromiter((id not in clustered for id in new_seqs), dtype=bool, count=len(new_seqs))
+		new_seqs, new_lengths = [id for id, m in zip(new_seqs, new_mask) if m], new_lengths[new_mask]
+		seqs = reps + new_seqs
+		lengths = np.concatenate([rep_lengths.astype(np.int64), new_lengths])
+		print("%s existing clusters, %s new sequences retained from fna" % (len(reps), len(new_seqs)))
+		log_time(start)
+
+		print("\nstoring edges...")
+		qidx, tidx = [], []
+		for q, t in read_incremental_edges(args['ani'], pd.Index(seqs), len(reps), args['min_ani'], args['min_qcov'], args['min_tcov']):
+			qidx.append(q)
+			tidx.append(t)
+		indptr, indices = build_csr(qidx, tidx, len(seqs))
+		del qidx, tidx
+		print("%s edges retained from blastani" % len(indices))
+		log_time(start)
+
+		print("\nclustering...")
+		centroids = extend_clusters(len(reps), lengths, indptr, indices)
+		num_assigned = np.count_nonzero(centroids[len(reps):] < len(reps))
+		print("%s new sequences assigned to existing clusters" % num_assigned)
+		num_clusters = write_extended_clusters(args['out'], seqs, members, lengths, centroids, indptr, indices)
+		print("%s new clusters written to %s" % (num_clusters, args['out']))
+		log_time(start)
+		return
+
+	if args['ani'] == '-' and (args['cache'] or sweep):
+		sys.exit("error: --ani - cannot be combined with --cache or sweeps")
+
+	if args['cache'] or sweep:
+		# load or build binary edge cache
+		cache_path = edge_cache_path(args['ani'])
+		print("\nloading edge cache...")
+		cache = load_edge_cache(args['fna'], args['ani'], cache_path)
+		if cache is None:
+			print("no valid cache at %s, parsing fna and blastani..." % cache_path)
+			cache = build_edge_cache(args['fna'], args['ani'], cache_path)
+		edges = select_seqs(cache, args['min_length'], exclude, keep)
+		del cache
+		seqs, lengths = edges['seqs'], edges['lengths']
+		print("%s sequences and %s edges retained from cache" % (len(seqs), len(edges['indices'])))
+		log_time(start)
+
+		grid = itertools.product(
+			args['sweep_ani'] or [args['min_ani']],
+			args['sweep_qcov'] or [args['min_qcov']],
+			args['sweep_tcov'] or [args['min_tcov']])
+		for min_ani, min_qcov, min_tcov in grid:
+			out = sweep_out_path(args['out'], min_ani, min_qcov, min_tcov) if sweep else args['out']
+			print("\nclustering with min_ani=%g, min_qcov=%g, min_tcov=%g..." % (min_ani, min_qcov, min_tcov))
+			keep_edges = pass_thresholds(edges['ani'], edges['qcov'], edges['tcov'], min_ani, min_qcov, min_tcov)
+			indptr, indices = subset_csr(edges['indptr'], edges['indices'], keep_edges)
+			centroids = greedy_cluster(lengths, indptr, indices)
+			num_clusters = write_clusters(out, seqs, lengths, centroids, indptr, indices)
+			print("%s edges retained, %s total clusters written to %s" % (len(indices), num_clusters, out))
+			log_time(start)
+		return
+
+	# list seqs
+	print("\nreading sequences...")
+	seqs, lengths = read_seqs(args['fna'], args['min_length'], exclude, keep)
+	print("%s sequences retained from fna" % len(seqs))
+	log_time(start)
+
+	# store edges
+	print("\nstoring edges...")
+	seq_index = pd.Index(seqs)
+	qidx, tidx = [], []
+	for q, t in read_edges(args['ani'], seq_index, args['min_ani'], args['min_qcov'], args['min_tcov']):
+		qidx.append(q)
+		tidx.append(t)
+	indptr, indices = build_csr(qidx, tidx, len(seqs))
+	del qidx, tidx
+	print("%s edges retained from blastani" % len(indices))
+	print("%s MB used by edge arrays" % round((indptr.nbytes + indices.nbytes)/float(1e6), 2))
+	log_time(start)
+
+	# cluster
+	print("\nclustering...")
+	centroids = greedy_cluster(lengths, indptr, indices)
+	print("%s total clusters" % np.count_nonzero(centroids == np.arange(len(seqs))))
+	log_time(start)
+
+	# write
+	print("\nwriting clusters...")
+	write_clusters(args['out'], seqs, lengths, centroids, indptr, indices)
+	log_time(start)
 
+if __name__ == "__main__":
+	main()
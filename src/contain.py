@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+
+import os, sys, argparse
+import numpy as np, pandas as pd
+from utils import fasta
+
+BASE_CODES = np.full(256, 4, dtype=np.uint8)
+for base, code in zip(b'ACGTacgt', [0, 1, 2, 3, 0, 1, 2, 3]):
+	BASE_CODES[base] = code
+TABLE_COLUMNS = ["contig", "length", "container", "strand", "start"]
+
+def packed_kmers(codes, positions, k):
+	""" 2-bit packed forward k-mers (k <= 31) starting at the given positions, and a mask of k-mers without non-ACGT bases """
+	kmers = np.zeros(len(positions), dtype=np.uint64)
+	for j in range(k):
+		kmers = (kmers << np.uint64(2)) | (codes[positions+j] & 3).astype(np.uint64)
+	invalid = np.r_[0, np.cumsum(codes == 4)]
+	return kmers, (invalid[positions+k] - invalid[positions]) == 0
+
+def reverse_complement(seq):
+	return seq.translate(fasta.COMPLEMENT)[::-1]
+
+def scan_kmers(path, k=31, step=32):
+	""" One pass over the fasta: every step-th k-mer of each contig (the index), and the k-mers starting at
+	offsets 0..step-1 of each contig and of its reverse complement (the queries)
+
+	A contig of at least k+step-1 bp that lies inside a longer one, on either strand, shares at least
+	one query k-mer with an indexed position of that contig, since indexed positions are step bp apart.
+	"""
+	index, queries = [], []
+	for record, (name, seq) in enumerate(fasta.read_records(path)):
+		codes = BASE_CODES[np.frombuffer(seq, dtype=np.uint8)]
+		if len(codes) < k:
+			continue
+		positions = np.arange(0, len(codes)-k+1, step)
+		kmers, valid = packed_kmers(codes, positions, k)
+		index.append((kmers[valid], np.full(valid.sum(), record, dtype=np.int32), positions[valid].astype(np.int64)))
+		if len(codes) < k+step-1:
+			continue
+		offsets = np.arange(step)
+		for strand, strand_codes in ((0, codes), (1, BASE_CODES[np.frombuffer(reverse_complement(seq), dtype=np.uint8)])):
+			kmers, valid = packed_kmers(strand_codes, offsets, k)
+			queries.append((kmers[valid], np.full(valid.sum(), record, dtype=np.int32), np.full(valid.sum(), strand, dtype=np.int8), offsets[valid]))
+	index = [np.concatenate(x) for x in zip(*index)] if index else [np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int64)]
+	queries = [np.concatenate(x) for x in zip(*queries)] if queries else [np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int8), np.zeros(0, dtype=np.int64)]
+	return index, queries
+
+def candidate_hits(index, queries, lengths):
+	""" Placements (query, target, strand, start) where a query k-mer meets an indexed k-mer of a longer contig,
+	sorted by query and then by decreasing target length """
+	index_kmers, index_records, index_positions = index
+	order = np.argsort(index_kmers, kind='stable')
+	index_kmers, index_records, index_positions = index_kmers[order], index_records[order], index_positions[order]
+	query_kmers, query_records, query_strands, query_offsets = queries
+	lo = np.searchsorted(index_kmers, query_kmers, side='left')
+	hi = np.searchsorted(index_kmers, query_kmers, side='right')
+	num_hits = hi - lo
+	hit = np.repeat(np.arange(len(query_kmers)), num_hits)
+	entry = np.arange(num_hits.sum()) - np.repeat(np.cumsum(num_hits) - num_hits, num_hits) + np.repeat(lo, num_hits)
+	qidx, tidx = query_records[hit], index_records[entry]
+	start = index_positions[entry] - query_offsets[hit]
+	# equal lengths only happen for identical contigs that dedup did not see; the later one is then the contained one
+	longer = (lengths[tidx] > lengths[qidx]) | ((lengths[tidx] == lengths[qidx]) & (tidx < qidx))
+	keep = longer & (start >= 0) & (start + lengths[qidx] <= lengths[tidx])
+	hits = pd.DataFrame({"query": qidx[keep], "target": tidx[keep], "strand": query_strands[hit][keep], "start": start[keep], "target_length": lengths[tidx[keep]]})
+	hits = hits.drop_duplicates(["query", "target", "strand", "start"])
+	return hits.sort_values(["query", "target_length", "target"], ascending=[True, False, True], kind='stable')
+
+def find_contained(path, k=31, step=32):
+	""" Return a table of contigs found verbatim inside a longer contig (either strand), with the outermost container """
+	index = fasta.FastaIndex(path)
+	lengths = index.lengths
+	hits = candidate_hits(*scan_kmers(path, k, step), lengths)
+	container = np.full(len(index), -1, dtype=np.int64)
+	strand = np.zeros(len(index), dtype=np.int8)
+	start = np.zeros(len(index), dtype=np.int64)
+	# records with lines of different lengths have no .fai geometry for random access; those among the hits are read whole
+	irregular = set(np.flatnonzero((index.linebases == 0) & (lengths > 0)).tolist()) & set(hits["query"].tolist() + hits["target"].tolist())
+	irregular_seqs = {record: seq for record, (name, seq) in enumerate(fasta.read_records(path)) if record in irregular} if irregular else {}
+	def fetch(record, begin=0, end=None):
+		if record in irregular_seqs:
+			return irregular_seqs[record][begin:end]
+		return index.fetch(index.names[record], begin, end)
+	with index:
+		for q, t, s, pos in zip(hits["query"].to_numpy(), hits["target"].to_numpy(), hits["strand"].to_numpy(), hits["start"].to_numpy()):
+			if container[q] >= 0:
+				continue
+			query_seq = fetch(q).upper()
+			if s == 1:
+				query_seq = reverse_complement(query_seq)
+			if fetch(t, pos, pos+lengths[q]).upper() == query_seq:
+				container[q], strand[q], start[q] = t, s, pos
+	# record the outermost container, so that it is a contig that is kept
+	contained = np.flatnonzero(container >= 0)
+	outermost = container.copy()
+	nested = contained[container[outermost[contained]] >= 0]
+	while len(nested):
+		# map the placement inside the direct container onto the container's own container
+		parent = outermost[nested]
+		flipped = strand[parent] == 1
+		start[nested] = np.where(flipped, start[parent] + lengths[parent] - start[nested] - lengths[nested], start[parent] + start[nested])
+		strand[nested] ^= strand[parent]
+		outermost[nested] = container[parent]
+		nested = nested[container[outermost[nested]] >= 0]
+	names = np.asarray(index.names, dtype=object)
+	return pd.DataFrame({
+		"contig": names[contained],
+		"length": lengths[contained],
+		"container": names[outermost[contained]],
+		"strand": np.where(strand[contained] == 1, "-", "+"),
+		"start": start[contained],
+	}, columns=TABLE_COLUMNS)
+
+def add_contained(clusters_path, table_path):
+	""" Append contained contigs to the cluster of their container in a [centroid, members] table; return number added """
+	contained = pd.read_table(table_path, sep='\t', header=0, dtype={"contig":str, "container":str})
+	clusters = pd.read_table(clusters_path, sep='\t', header=None, names=["rep", "members"], dtype=str)
+	members = clusters["members"].str.split(",")
+	clustered = members.explode()
+	cluster_of = pd.Series(clustered.index, index=clustered.to_numpy())
+	# contigs already in the table (e.g. from an earlier run) and those whose container did not make it into a cluster are left out
+	contained = contained[~contained["contig"].isin(cluster_of.index) & contained["container"].isin(cluster_of.index)]
+	additions = contained.groupby(cluster_of.reindex(contained["container"]).to_numpy(), sort=False)["contig"].agg(list)
+	for cluster, contigs in additions.items():
+		members[cluster] = members[cluster] + contigs
+	clusters["members"] = members.str.join(",")
+	clusters.to_csv(clusters_path + ".tmp", sep='\t', header=False, index=False)
+	os.replace(clusters_path + ".tmp", clusters_path)
+	return len(contained)
+
+def parse_arguments():
+	parser = argparse.ArgumentParser(
+		description="Containment filter between dedup and check_quality/cluster: contigs found verbatim inside a longer contig are set aside, and added back to the OVU of their container after clustering.")
+	subparsers = parser.add_subparsers(dest="command", required=True)
+	parser_filter = subparsers.add_parser("filter", help="Write the contigs not contained in another contig, and a table of the contained ones.")
+	parser_filter.add_argument('-i', dest='input', type=str, required=True, metavar='PATH',
+		help="Input fasta (e.g. merged_decontaminated_contigs_dedup.fasta)")
+	parser_filter.add_argument('-o', dest='output', type=str, required=True, metavar='PATH',
+		help="Output fasta without contained contigs")
+	parser_filter.add_argument('--table', type=str, required=True, metavar='PATH',
+		help="Output table of contained contigs: contig, length, container, strand, start")
+	parser_filter.add_argument('-k', dest='k', type=int, default=31, metavar='INT',
+		help="k-mer size, at most 31 (default=31)")
+	parser_filter.add_argument('--step', type=int, default=32, metavar='INT',
+		help="Index every STEP-th k-mer of each contig; contigs shorter than k+STEP-1 are never flagged (default=32)")
+	parser_add = subparsers.add_parser("add", help="Add contained contigs to the clusters of their containers.")
+	parser_add.add_argument('--clusters', type=str, required=True, metavar='PATH',
+		help="Cluster table written by cluster.py, updated in place")
+	parser_add.add_argument('--table', type=str, required=True, metavar='PATH',
+		help="Table of contained contigs written by filter")
+	args = parser.parse_args()
+	if args.command == "filter" and not 0 < args.k <= 31:
+		parser.error("-k must be between 1 and 31")
+	return args
+
+if __name__ == "__main__":
+	args = parse_arguments()
+	if args.command == "filter":
+		contained = find_contained(args.input, args.k, args.step)
+		contained.to_csv(args.table, sep='\t', index=False)
+		index = fasta.FastaIndex(args.input)
+		with index:
+			num_kept = index.write_records(set(index.names) - set(contained["contig"]), args.output)
+		print(f"{len(contained)} contained contigs written to {args.table}, {num_kept} contigs kept in {args.output}")
+	elif args.command == "add":
+		if not os.path.exists(args.table):
+			print(f"{args.table} does not exist; no contained contigs to add")
+			sys.exit(0)
+		num_added = add_contained(args.clusters, args.table)
+		print(f"{num_added} contained contigs added to the clusters of their containers in {args.clusters}")
@@ -7,7 +7,7 @@ def main():
     pwd = os.getcwd()
     parser = argparse.ArgumentParser(prog="VirIAP", description="This is a commandline software for the pipeline.")
     parser.add_argument("-p","--prj_dir", default=pwd, help="Specify your project directory. (e.g. './test')")
-    parser.add_argument("--max_batch_size", type=int, default=10, help="Defines the maximum number of samples a batch job contains.")
+    parser.add_argument("--max_batch_size", type=int, default=None, help="Defines the maximum number of samples a batch job contains. (default: max_batch_size in config.yaml)")
     parser.add_argument("--dryrun", action="store_true", help="Run the commands but not generate anything. (Used for testing.)")
     # subparser_search.add_argument("-c", "--config", help="The config file of this project in yaml format.")
 
@@ -32,13 +32,35 @@ def main():
     subparser_extract = subparsers.add_parser("extract", help="Extract putative contigs.")
     subparser_extract.add_argument("-l", "--min_length", type=int, default=3000, help="Minimum length for putative contigs.")
     subparser_extract.add_argument("-c", "--num_confirmed_tools", type=int, default=2, help="Minimum number of tools to confirm.")
+    subparser_extract.add_argument("--min_score", nargs="+", default=[], metavar="TOOL=SCORE", help="Per-tool minimum score for a viral vote, e.g. vlm=0.9 vs2=0.5 (tools: cat, vs2, gnm, vlm; default: vlm=0.8, others 0).")
+    subparser_extract.add_argument("--keep_plasmids", action="store_true", help="Do not veto contigs that geNomad calls plasmids.")
+    subparser_extract.add_argument("-w", "--workers", type=int, default=1, help="Number of samples processed in parallel. (default: 1)")
+    subparser_extract.add_argument("--force", action="store_true", help="Re-run samples whose outputs are newer than their inputs.")
+    subparser_extract.add_argument("--samples", nargs="+", default=None, help="Only process these samples (fileHeaders). (default: all samples)")
+    subparser_extract.add_argument("--batch_name", type=str, default=None, help="Name reports and pooled files after this batch, so that batch jobs can run side by side.")
+    subparser_extract.add_argument("--generate", action="store_true", help="Write batch jobs under ./jobs that run extract and decontam (pooled with --pooled) for --max_batch_size samples each (max_batch_size in config.yaml by default), instead of running extract here.")
+    subparser_extract.add_argument("--pooled", action="store_true", help="With --generate, run decontam --pooled in the jobs.")
 
     subparser_filter = subparsers.add_parser("decontam", help="Decontamination: filter out rRNAs from bac,euk,arc,mito.")
+    subparser_filter.add_argument("-w", "--workers", type=int, default=1, help="Number of samples processed in parallel; barrnap threads are shared among them. (default: 1)")
+    subparser_filter.add_argument("--force", action="store_true", help="Re-run samples whose outputs are newer than their inputs.")
+    subparser_filter.add_argument("--pooled", action="store_true", help="Pool putative contigs of all samples into --workers shards and run the four barrnap kingdoms concurrently on each shard.")
+    subparser_filter.add_argument("--samples", nargs="+", default=None, help="Only process these samples (fileHeaders). (default: all samples)")
+    subparser_filter.add_argument("--batch_name", type=str, default=None, help="Name reports and pooled files after this batch, so that batch jobs can run side by side.")
     # subparser_confirm = subparsers.add_parser("confirm", help="Output confirmed viral contigs.")
     subparser_merge = subparsers.add_parser("merge", help="Merge all confirmed viral contigs into one fasta file.")
-    subparser_dedup = subparsers.add_parser("dedup", help="Remove exactly the same contigs.")
+    subparser_merge.add_argument("--compress", action="store_true", help="Write the merged catalogue BGZF-compressed (merged_decontaminated_contigs.fasta.gz); dedup then writes compressed outputs too.")
+    subparser_merge.add_argument("-t", "--threads", type=int, default=1, help="Number of compression threads with --compress. (default: 1)")
+    subparser_dedup = subparsers.add_parser("dedup", help="Remove exactly the same contigs, including reverse-complement copies.")
+    subparser_dedup.add_argument("-w", "--workers", type=int, default=1, help="Number of processes hashing contigs. (default: 1)")
     subparser_quality_check = subparsers.add_parser("check_quality", help="Use CheckV to check the quality of merged viral contigs.")
+    subparser_quality_check.add_argument("--num_shards", type=int, default=1, help="Split the contigs into this many shards balanced by total length and run CheckV as an array job, one subjob per shard. (default: 1, a single job)")
+    subparser_quality_check.add_argument("--merge_shards", action="store_true", help="Merge the per-shard CheckV summaries and write quality_filtered_viral_contigs.fasta (run by the generated merge job).")
     subparser_cluster = subparsers.add_parser("cluster", help="Use ANI and AF results from blast all against all to cluster viral contigs.")
+    subparser_cluster.add_argument("--incremental", action="store_true", help="Keep existing OVUs and only cluster contigs not yet in OVU/filtered_clusters.tsv.")
+    subparser_cluster.add_argument("--keep_blast", action="store_true", help="Also keep the raw all-vs-all blastn table (filtered_blast.tsv); by default it is streamed straight into ANI computation.")
+    subparser_cluster.add_argument("--num_shards", type=int, default=1, help="Split the all-vs-all blast into this many query shards run as an array job, followed by a merge job. (default: 1, a single job)")
+    subparser_cluster.add_argument("--prefilter", action="store_true", help="Sketch contigs with MinHash first and only blast pairs that can be similar (containment Mash distance <= 0.1).")
     
     subparser_mapping = subparsers.add_parser("mapping", help="Map clean paired-end reads to representative contigs using strobealign, and calculate relative abundance.")
     subparser_mapping.add_argument("--manifest", required=True, type=str, help="a three column csv file, with columns: fileHeader,fq1,fq2")
@@ -46,6 +68,14 @@ def main():
     mapping_option.add_argument("--indexing", action="store_true", help="Generate jobs for building strobealign index with representative viral contigs.")
     mapping_option.add_argument("--mapping", action="store_true", help="Generate jobs for mapping batches of samples to the representatives.")
     mapping_option.add_argument("--count_matrix", action="store_true", help="Count number of reads and calculate FPKM and TPM.")
+    subparser_mapping.add_argument("--job_hours", type=float, default=10, help="With --mapping, samples are packed by FASTQ size into jobs of about this many hours, at most --max_batch_size samples each. (default: 10)")
+    subparser_mapping.add_argument("--gb_per_hour", type=float, default=8, help="With --mapping, GB of FASTQ (as stored, fq1+fq2) one job maps per hour; sets the job walltimes. (default: 8)")
+    subparser_mapping.add_argument("--counts_only", action="store_true", help="With --mapping, count reads per contig straight from the strobealign output (samcount.py) instead of sorting, indexing, flagstat and featureCounts; no BAM is written.")
+    subparser_mapping.add_argument("--keep_bam", action="store_true", help="With --counts_only, also write a sorted and indexed BAM per sample.")
+    subparser_mapping.add_argument("-w", "--workers", type=int, default=1, help="Number of threads reading count files with --count_matrix. (default: 1)")
+    subparser_mapping.add_argument("--block_size", type=int, default=500, help="Number of samples parsed at a time with --count_matrix; lower it when memory is tight. (default: 500)")
+    subparser_mapping.add_argument("--rebuild", action="store_true", help="With --count_matrix, re-parse every count file instead of reusing the cached counts of unchanged samples.")
+    subparser_mapping.add_argument("--no_csv", action="store_true", help="With --count_matrix, only write the sparse matrices under Abundance/matrix, not the dense all_*.csv tables.")
 
     subparser_classify = subparsers.add_parser("classify", help="Classify OVU representatives and merge lineage results from CAT, GeNomad and vContact3.")
     calssification_option = subparser_classify.add_mutually_exclusive_group(required=True)
@@ -81,32 +111,68 @@ def main():
         check_completeness.check_complete_multifile(prj_dir=project_dir)
     if args.modules in ["extract","decontam","confirm"]:
         fileHeader_list = pd.read_csv(os.path.join(project_dir,"completeness_status.csv"),sep=',',header=0,index_col=None)
+        if getattr(args, "samples", None) is not None:
+            unknown = set(args.samples) - set(fileHeader_list["fileHeader"].astype(str))
+            if unknown:
+                parser.error(f"--samples: unknown samples {' '.join(sorted(unknown))}")
+            fileHeader_list = fileHeader_list[fileHeader_list["fileHeader"].astype(str).isin(args.samples)]
         if args.modules=="extract":
-            post_process.extract_putative_contigs_multi_samples(prj_dir=project_dir, fileHeader_list=fileHeader_list.loc[:,"fileHeader"].tolist(), min_len=args.min_length)
+            rule = {}
+            for min_score in args.min_score:
+                tool, _, score = min_score.partition("=")
+                if tool not in ["cat", "vs2", "gnm", "vlm"] or score=="":
+                    parser.error(f"--min_score expects TOOL=SCORE with TOOL one of cat, vs2, gnm, vlm; got {min_score}")
+                rule[f"{tool}_min_score"] = float(score)
+            rule["plasmid_veto"] = not args.keep_plasmids
+            if args.generate==True:
+                proj_config = config.read_project_config(os.path.join(project_dir,"config.yaml"))
+                if args.max_batch_size==None: batch_size=proj_config["max_batch_size"]
+                else: batch_size=args.max_batch_size
+                # written once here, so that the batch jobs only read it
+                post_process.save_extraction_rule(project_dir, post_process.extraction_rule(args.min_length, args.num_confirmed_tools, rule))
+                extract_options = f"-l {args.min_length} -c {args.num_confirmed_tools}"
+                if args.min_score:
+                    extract_options += " --min_score " + " ".join(args.min_score)
+                if args.keep_plasmids:
+                    extract_options += " --keep_plasmids"
+                if args.force:
+                    extract_options += " --force"
+                post_process.generate_post_process_jobs(prj_dir=project_dir, config=proj_config, batch_size=batch_size, extract_options=extract_options, pooled=args.pooled, fileHeader_list=fileHeader_list.loc[:,"fileHeader"].tolist())
+            else:
+                post_process.extract_putative_contigs_multi_samples(prj_dir=project_dir, fileHeader_list=fileHeader_list.loc[:,"fileHeader"].tolist(), min_len=args.min_length, num_confirmed_tools=args.num_confirmed_tools, rule=rule, workers=args.workers, force=args.force, batch_name=args.batch_name)
         if args.modules=="decontam":
             proj_config = config.read_project_config(os.path.join(project_dir,"config.yaml"))
-            if proj_config["job_manager"] in ["pbs","gadi"]:
-                post_process.find_rRNAs_multi_files(prj_dir=project_dir, fileHeader_list=fileHeader_list.loc[:,"fileHeader"].tolist(), threads=proj_config['pbs']["ncpus"]) # [fileHeader_list["completed"]==False]
-                post_process.extract_decontaminated_contigs_multi_files(prj_dir=project_dir, fileHeader_list=fileHeader_list.loc[:,"fileHeader"].tolist())
+            if proj_config["job_manager"] in ["pbs","gadi","bash"]:
+                threads = proj_config['bash']["ncpus"] if proj_config["job_manager"]=="bash" else proj_config['pbs']["ncpus"]
+                if args.pooled==True:
+                    post_process.find_rRNAs_pooled(prj_dir=project_dir, fileHeader_list=fileHeader_list.loc[:,"fileHeader"].tolist(), threads=threads, workers=args.workers, force=args.force, batch_name=args.batch_name)
+                else:
+                    post_process.find_rRNAs_multi_files(prj_dir=project_dir, fileHeader_list=fileHeader_list.loc[:,"fileHeader"].tolist(), threads=threads, workers=args.workers, force=args.force, batch_name=args.batch_name) # [fileHeader_list["completed"]==False]
+                post_process.extract_decontaminated_contigs_multi_files(prj_dir=project_dir, fileHeader_list=fileHeader_list.loc[:,"fileHeader"].tolist(), workers=args.workers, force=args.force, batch_name=args.batch_name)
     if args.modules=="merge":
         fileHeader_list = pd.read_csv(os.path.join(project_dir,"completeness_status.csv"),sep=',',header=0,index_col=None)
-        post_process.merge_confirmed_contigs(prj_dir=project_dir, fileHeader_list=fileHeader_list.loc[:,"fileHeader"].tolist())
+        post_process.merge_confirmed_contigs(prj_dir=project_dir, fileHeader_list=fileHeader_list.loc[:,"fileHeader"].tolist(), compress=args.compress, threads=args.threads)
     if args.modules=="dedup":
-        post_process.dedup(prj_dir=project_dir)
+        post_process.dedup(prj_dir=project_dir, workers=args.workers)
     if args.modules=="check_quality":
-        proj_config = config.read_project_config(os.path.join(project_dir,"config.yaml"))
-        post_process.check_quality(prj_dir=project_dir, config=proj_config)
+        if args.merge_shards==True:
+            post_process.merge_quality_shards(prj_dir=project_dir)
+        else:
+            proj_config = config.read_project_config(os.path.join(project_dir,"config.yaml"))
+            post_process.check_quality(prj_dir=project_dir, config=proj_config, num_shards=args.num_shards)
     if args.modules=="cluster":
         proj_config = config.read_project_config(os.path.join(project_dir,"config.yaml"))
-        post_process.cluster(prj_dir=project_dir, config=proj_config)
+        post_process.cluster(prj_dir=project_dir, config=proj_config, incremental=args.incremental, keep_blast=args.keep_blast, num_shards=args.num_shards, prefilter=args.prefilter)
     if args.modules=="mapping":
         proj_config = config.read_project_config(os.path.join(project_dir,"config.yaml"))
         if args.indexing==True:
             mapping.indexing(prj_dir=project_dir, config=proj_config)
         if args.mapping==True:
-            mapping.mapping(prj_dir=project_dir, manifest=args.manifest, config=proj_config)
+            if args.max_batch_size==None: batch_size=proj_config["max_batch_size"]
+            else: batch_size=args.max_batch_size
+            mapping.mapping(prj_dir=project_dir, manifest=args.manifest, config=proj_config, batch_size=batch_size, job_hours=args.job_hours, gb_per_hour=args.gb_per_hour, counts_only=args.counts_only, keep_bam=args.keep_bam)
         if args.count_matrix==True:
-            mapping.count_matrix(prj_dir=project_dir, manifest=args.manifest)
+            mapping.count_matrix(prj_dir=project_dir, manifest=args.manifest, workers=args.workers, block_size=args.block_size, dense_csv=not args.no_csv, use_cache=not args.rebuild)
     if args.modules=="classify":
         os.makedirs(os.path.join(project_dir,"Classification"), exist_ok=True)
         proj_config = config.read_project_config(os.path.join(project_dir,"config.yaml"))
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+
+import os, sys, argparse
+import numpy as np
+from utils.mapping import read_features
+
+SUMMARY_STATUSES = ["Assigned", "Unassigned_Unmapped", "Unassigned_Read_Type", "Unassigned_Singleton", "Unassigned_MappingQuality",
+	"Unassigned_Chimera", "Unassigned_FragmentLength", "Unassigned_Duplicate", "Unassigned_MultiMapping", "Unassigned_Secondary",
+	"Unassigned_NonSplit", "Unassigned_NoFeatures", "Unassigned_Overlapping_Length", "Unassigned_Ambiguity"]
+
+def multi_mapping(line):
+	""" True if the record carries an NH tag above 1 """
+	pos = line.find(b'\tNH:i:')
+	if pos < 0:
+		return False
+	end = line.find(b'\t', pos+6)
+	return int(line[pos+6:end if end >= 0 else len(line)].rstrip()) > 1
+
+def count_sam(stream, references, pairs=False, echo=None):
+	""" Count the SAM records of a stream in aligner order per reference, the way featureCounts -p counts contig-long
+	features: reads by default, fragments (--countReadPairs) with pairs; return counts in the order of references and a summary
+
+	Every reference is one feature spanning the whole contig, so a mapped read always overlaps its contig's feature.
+	Multi-mapping (NH > 1) and secondary/supplementary records are not counted. In fragment mode a pair is counted once
+	on the contig of its mapped mate(s), and a pair whose mates map to two different contigs is ambiguous.
+	"""
+	row = {reference.encode(): i for i, reference in enumerate(references)}
+	counts = np.zeros(len(references), dtype=np.int64)
+	summary = dict.fromkeys(SUMMARY_STATUSES, 0)
+	for line in stream:
+		if echo is not None:
+			echo.write(line)
+		if line[:1] == b'@':
+			continue
+		fields = line.split(b'\t', 8)
+		flag = int(fields[1])
+		if flag & 0x900:
+			summary["Unassigned_Secondary"] += 1
+			continue
+		if pairs:
+			# a pair is decided on its first mate, which carries the mapping state of both
+			if flag & 0x1 and not flag & 0x40:
+				continue
+			if flag & 0x4 and (not flag & 0x1 or flag & 0x8):
+				summary["Unassigned_Unmapped"] += 1
+				continue
+			if multi_mapping(line):
+				summary["Unassigned_MultiMapping"] += 1
+				continue
+			if flag & 0x4:
+				# unmapped first mate: count on the reference of the mapped mate
+				reference = fields[6] if fields[6] != b'=' else fields[2]
+			else:
+				reference = fields[2]
+				if flag & 0x1 and not flag & 0x8 and fields[6] not in (b'=', reference):
+					summary["Unassigned_Ambiguity"] += 1
+					continue
+		else:
+			if flag & 0x4:
+				summary["Unassigned_Unmapped"] += 1
+				continue
+			if multi_mapping(line):
+				summary["Unassigned_MultiMapping"] += 1
+				continue
+			reference = fields[2]
+		if reference not in row:
+			summary["Unassigned_NoFeatures"] += 1
+			continue
+		counts[row[reference]] += 1
+		summary["Assigned"] += 1
+	return counts, summary
+
+def write_counts(out, features, counts, summary, label, command):
+	""" Write the featureCounts table (comment line, Geneid header, key columns and one count column) and its .summary """
+	table = features.rename(columns={"contig": "Geneid"}).assign(**{label: counts})
+	with open(out + ".tmp", 'w') as f:
+		f.write(f"# Program:samcount.py; Command:{command}\n")
+		table.to_csv(f, sep='\t', index=False)
+	with open(out + ".summary.tmp", 'w') as f:
+		f.write(f"Status\t{label}\n")
+		f.writelines(f"{status}\t{summary[status]}\n" for status in SUMMARY_STATUSES)
+	os.replace(out + ".tmp", out)
+	os.replace(out + ".summary.tmp", out + ".summary")
+
+def parse_arguments():
+	parser = argparse.ArgumentParser(
+		description="Count SAM records per contig, as featureCounts -p does with the contig features of rep_contigs.gtf, straight from an aligner's output stream.")
+	parser.add_argument('-a', dest='gtf', type=str, required=True, metavar='PATH',
+		help="Contig features (Abundance/rep_contigs.gtf); sets the rows of the table")
+	parser.add_argument('-o', dest='output', type=str, required=True, metavar='PATH',
+		help="Output count table (featureCounts format); the summary goes to PATH.summary")
+	parser.add_argument('-i', dest='input', type=str, default='-', metavar='PATH',
+		help="SAM file, or '-' for stdin, e.g. piped from strobealign (default='-')")
+	parser.add_argument('--label', type=str, default=None, metavar='STR',
+		help="Name of the count column (default=input path)")
+	parser.add_argument('--pairs', action='store_true',
+		help="Count fragments instead of reads, like featureCounts --countReadPairs")
+	parser.add_argument('--echo', action='store_true',
+		help="Copy the SAM stream to stdout, e.g. into samtools sort when a BAM is wanted")
+	return parser.parse_args()
+
+if __name__ == "__main__":
+	args = parse_arguments()
+	features = read_features(args.gtf)
+	echo = sys.stdout.buffer if args.echo else None
+	if args.input == '-':
+		counts, summary = count_sam(sys.stdin.buffer, features["Chr"].tolist(), args.pairs, echo)
+	else:
+		with open(args.input, 'rb') as sam:
+			counts, summary = count_sam(sam, features["Chr"].tolist(), args.pairs, echo)
+	write_counts(args.output, features, counts, summary, args.label or args.input, " ".join(f'"{x}"' for x in sys.argv))
+	print(f"{summary['Assigned']} {'fragments' if args.pairs else 'reads'} assigned to {int((counts > 0).sum())} of {len(counts)} contigs, written to {args.output}", file=sys.stderr)
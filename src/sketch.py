@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+
+import os, argparse, multiprocessing
+import numpy as np
+from scipy import sparse
+from utils import fasta
+
+BASE_CODES = np.full(256, 4, dtype=np.uint8)
+for base, code in zip(b'ACGTacgt', [0, 1, 2, 3, 0, 1, 2, 3]):
+	BASE_CODES[base] = code
+
+def mix64(x):
+	""" splitmix64 finalizer; spreads 2-bit packed k-mers over the full uint64 range """
+	x = (x ^ (x >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+	x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+	return x ^ (x >> np.uint64(31))
+
+def kmer_hashes(seq, k):
+	""" Hashes of all canonical k-mers (k <= 31) of a sequence; k-mers containing non-ACGT bases are skipped """
+	codes = BASE_CODES[np.frombuffer(seq, dtype=np.uint8)]
+	num_kmers = len(codes) - k + 1
+	if num_kmers <= 0:
+		return np.zeros(0, dtype=np.uint64)
+	fwd_codes = (codes & 3).astype(np.uint64)
+	rev_codes = np.uint64(3) - fwd_codes
+	fwd = np.zeros(num_kmers, dtype=np.uint64)
+	rev = np.zeros(num_kmers, dtype=np.uint64)
+	for j in range(k):
+		fwd = (fwd << np.uint64(2)) | fwd_codes[j:j+num_kmers]
+		rev |= rev_codes[j:j+num_kmers] << np.uint64(2*j)
+	invalid = np.r_[0, np.cumsum(codes == 4)]
+	valid = (invalid[k:] - invalid[:-k]) == 0
+	return mix64(np.minimum(fwd, rev)[valid])
+
+def sketch_seq(args):
+	""" Scaled (FracMinHash) sketch: sorted unique hashes below max_hash """
+	seq, k, max_hash = args
+	hashes = kmer_hashes(seq, k)
+	return np.unique(hashes[hashes < max_hash])
+
+def sketch_fasta(path, k=21, scaled=100, threads=1):
+	""" Sketch every record of a fasta in file order; returns (ids, lengths, sketches) """
+	max_hash = np.uint64(np.iinfo(np.uint64).max // np.uint64(scaled))
+	ids, lengths = [], []
+	def jobs():
+		for name, seq in fasta.read_records(path):
+			ids.append(name)
+			lengths.append(len(seq))
+			yield seq, k, max_hash
+	if threads > 1:
+		with multiprocessing.Pool(threads) as pool:
+			sketches = list(pool.imap(sketch_seq, jobs(), chunksize=64))
+	else:
+		sketches = [sketch_seq(job) for job in jobs()]
+	return ids, np.array(lengths, dtype=np.int64), sketches
+
+def candidate_pairs(sketches, k=21, max_dist=0.1, min_hashes=5):
+	""" Symmetric boolean csr adjacency of contig pairs within max_dist, and a mask of contigs with too few hashes to judge """
+	sizes = np.array([len(x) for x in sketches], dtype=np.int64)
+	rows = np.repeat(np.arange(len(sketches)), sizes)
+	hashes = np.concatenate(sketches) if len(sketches) else np.zeros(0, dtype=np.uint64)
+	_, cols = np.unique(hashes, return_inverse=True)
+	presence = sparse.csr_matrix((np.ones(len(rows), dtype=np.int32), (rows, cols.ravel())), shape=(len(sketches), cols.max()+1 if len(cols) else 0))
+	shared = (presence @ presence.T).tocoo()
+	qidx, tidx, num_shared = shared.row, shared.col, shared.data
+	# containment of the smaller sketch in the larger one, so that short contigs inside long ones (tcov) are kept
+	containment = num_shared / np.maximum(np.minimum(sizes[qidx], sizes[tidx]), 1)
+	with np.errstate(divide='ignore'):
+		dist = -np.log(containment) / k
+	keep = (qidx != tidx) & (dist <= max_dist)
+	adjacency = sparse.csr_matrix((np.ones(keep.sum(), dtype=bool), (qidx[keep], tidx[keep])), shape=shared.shape)
+	return adjacency, sizes < min_hashes
+
+def plan_batches(lengths, adjacency, fallback, num_batches):
+	""" Split queries into contiguous bp-balanced batches; per batch, the query and subject record indices to blast """
+	has_candidates = (np.diff(adjacency.indptr) > 0) | fallback
+	fallback_ids = np.flatnonzero(fallback)
+	batches = []
+	for start, end in fasta.shard_bounds(lengths, num_batches):
+		queries = start + np.flatnonzero(has_candidates[start:end])
+		if len(queries) == 0:
+			continue
+		if fallback[start:end].any():
+			# too few hashes to trust the sketch: search the whole catalogue
+			subjects = None
+		else:
+			subjects = np.union1d(np.unique(adjacency[queries].indices), fallback_ids)
+		batches.append((queries, subjects))
+	return batches
+
+def write_batches(path, out_dir, batches, num_records, total_bp):
+	""" Write shard_{i}.fasta (queries) and subjects_{i}.fasta (blast db records) for every batch, plus the catalogue size """
+	os.makedirs(out_dir, exist_ok=True)
+	out_paths = []
+	members = [[] for _ in range(num_records)]
+	for i, (queries, subjects) in enumerate(batches):
+		out_paths.append(os.path.join(out_dir, f"shard_{i}.fasta"))
+		for record in queries:
+			members[record].append(len(out_paths)-1)
+		if subjects is not None:
+			out_paths.append(os.path.join(out_dir, f"subjects_{i}.fasta"))
+			for record in subjects:
+				members[record].append(len(out_paths)-1)
+	fasta.write_subsets(path, out_paths, members)
+	# blastn -dbsize, so that e-values against a subject subset match those against the full catalogue
+	with open(os.path.join(out_dir, "dbsize"), 'w') as f:
+		f.write(f"{total_bp}\n")
+
+def parse_arguments():
+	parser = argparse.ArgumentParser(
+		description="MinHash prefilter for the all-vs-all blast of the cluster stage. Writes query batches and the candidate subjects each batch needs to be aligned against.",
+		usage="%(prog)s -i <fasta> -o <out_dir> [options]")
+	parser.add_argument('-i', dest='input', type=str, required=True, metavar='PATH',
+		help="Input fasta (e.g. quality_filtered_viral_contigs.fasta)")
+	parser.add_argument('-o', dest='out_dir', type=str, required=True, metavar='PATH',
+		help="Output directory for shard_{i}.fasta, subjects_{i}.fasta and dbsize")
+	parser.add_argument('-n', dest='num_batches', type=int, default=100, metavar='INT',
+		help="Number of contiguous query batches balanced by total bp (default=100)")
+	parser.add_argument('-k', dest='k', type=int, default=21, metavar='INT',
+		help="k-mer size, at most 31 (default=21)")
+	parser.add_argument('--scaled', type=int, default=100, metavar='INT',
+		help="Keep on average one in every SCALED k-mer hashes (default=100)")
+	parser.add_argument('--max_dist', type=float, default=0.1, metavar='FLOAT',
+		help="Maximum containment Mash distance for a candidate pair (default=0.1, i.e. ~90%% identity)")
+	parser.add_argument('--min_hashes', type=int, default=5, metavar='INT',
+		help="Contigs with fewer sketch hashes are blasted against every contig (default=5)")
+	parser.add_argument('-t', dest='threads', type=int, default=1, metavar='INT',
+		help="Number of processes used for sketching (default=1)")
+	args = parser.parse_args()
+	if not 0 < args.k <= 31:
+		parser.error("-k must be between 1 and 31")
+	return args
+
+if __name__ == "__main__":
+	args = parse_arguments()
+	ids, lengths, sketches = sketch_fasta(args.input, args.k, args.scaled, args.threads)
+	adjacency, fallback = candidate_pairs(sketches, args.k, args.max_dist, args.min_hashes)
+	batches = plan_batches(lengths, adjacency, fallback, args.num_batches)
+	write_batches(args.input, args.out_dir, batches, len(ids), int(lengths.sum()))
+	num_pairs = adjacency.nnz // 2
+	all_pairs = len(ids) * (len(ids) - 1) // 2
+	print(f"{len(ids)} contigs, {num_pairs} candidate pairs of {all_pairs}, {int(fallback.sum())} contigs without enough hashes, {len(batches)} query batches written to {args.out_dir}")
@@ -1,6 +1,7 @@
 import pandas as pd
 import numpy as np
 import os
+from utils import fasta
 
 def check_complete_singlefile(series, prj_dir: str="."):
     # if all final files exist, then complete
@@ -13,8 +14,7 @@ def check_complete_singlefile(series, prj_dir: str="."):
     if os.path.exists(os.path.join(prj_dir,"out",s["fileHeader"],"VirSorter2_results",f"{s['fileHeader']}-final-viral-score.tsv")):
         s["VirSorter2"] = True
     # Verification of GeNomad: "./out/{}/GeNomad_results/final.contigs_summary/final.contigs_plasmid_summary.tsv and final.contigs_virus_summary.tsv"
-    # print(f"{'.'.join(s['path'].split('/')[-1].split('.')[:-1])}")
-    if os.path.exists(os.path.join(prj_dir,"out",s["fileHeader"],"GeNomad_results",f"{'.'.join(s['path'].split('/')[-1].split('.')[:-1])}_summary",f"{'.'.join(s['path'].split('/')[-1].split('.')[:-1])}_virus_summary.tsv")) and os.path.exists(os.path.join(prj_dir,"out",s["fileHeader"],"GeNomad_results",f"{'.'.join(s['path'].split('/')[-1].split('.')[:-1])}_summary",f"{'.'.join(s['path'].split('/')[-1].split('.')[:-1])}_plasmid_summary.tsv")):
+    if os.path.exists(os.path.join(prj_dir,"out",s["fileHeader"],"GeNomad_results",f"{fasta.assembly_name(s['path'])}_summary",f"{fasta.assembly_name(s['path'])}_virus_summary.tsv")) and os.path.exists(os.path.join(prj_dir,"out",s["fileHeader"],"GeNomad_results",f"{fasta.assembly_name(s['path'])}_summary",f"{fasta.assembly_name(s['path'])}_plasmid_summary.tsv")):
         s["GeNomad"] = True
     # Verification of ViraLM: "./out/{}/ViraLM_results/result_final.csv"
     if os.path.exists(os.path.join(prj_dir,"out",s["fileHeader"],"ViraLM_results",f"result_{s['fileHeader']}.csv")): 
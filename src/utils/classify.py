@@ -2,8 +2,7 @@ import os
 import envs
 import numpy as np
 import pandas as pd
-from Bio import SeqIO
-from utils import job_management
+from utils import job_management, fasta
 
 def anno_vContact3(prj_dir, config):
     os.makedirs(os.path.join(prj_dir,"Classification"), exist_ok=True)
@@ -71,7 +70,7 @@ def summarise_OVUs(prj_dir):
                 # f"../out/{fileHeader}/CAT_results/{fileHeader}.nr.contig2classification.with_names.txt",
                 header=0, sep='\t', index_col=None
             ).rename({"# contig":"contig"}, axis=1)
-            gnm_fileHeader = '.'.join(status[status["fileHeader"]==fileHeader]['path'].iloc[0].split('/')[-1].split('.')[:-1])
+            gnm_fileHeader = fasta.assembly_name(status[status["fileHeader"]==fileHeader]['path'].iloc[0])
             gnm_out = pd.read_table(
                 os.path.join(prj_dir,"out",fileHeader,"GeNomad_results",f"{gnm_fileHeader}_annotate",f"{gnm_fileHeader}_taxonomy.tsv"),
                 # f"../out/{fileHeader}/GeNomad_results/final.contigs_annotate/final.contigs_taxonomy.tsv",
@@ -176,18 +175,18 @@ def summarise_OVUs(prj_dir):
         return lineage
 
     def length_info(OVU_info, quality_filtered_contigs_path):
-        contig_id_list = []
-        contig_length_list = []
-        with open(quality_filtered_contigs_path, 'r') as f:
-            for record in SeqIO.parse(f, "fasta"):
-                contig_id_list.append(record.id)
-                contig_length_list.append(len(record.seq))
-        df_contig_length = pd.DataFrame({
-            "contig_id": contig_id_list,
-            "contig_length": contig_length_list,
-        })
-        OVU_info["cluster_length"] = OVU_info.apply(lambda s: df_contig_length[df_contig_length["contig_id"].isin(s["contigs_in_cluster"].split(","))]["contig_length"].sum(), axis=1)
-        OVU_info["cluster_median_length"] = OVU_info.apply(lambda s: np.median(df_contig_length[df_contig_length["contig_id"].isin(s["contigs_in_cluster"].split(","))]["contig_length"].tolist()), axis=1)
+        contig_ids, contig_lengths = fasta.read_lengths(quality_filtered_contigs_path)
+        contig_length = pd.Series(contig_lengths, index=contig_ids)
+        # contained contigs were added back to their container's OVU without going through quality filtering
+        contained_path = os.path.join(os.path.dirname(quality_filtered_contigs_path),"contained_contigs.tsv")
+        if os.path.exists(contained_path):
+            contained = pd.read_table(contained_path, sep='\t', header=0, dtype={"contig":str})
+            contig_length = pd.concat([contig_length, pd.Series(contained["length"].to_numpy(), index=contained["contig"])])
+        contig_length = contig_length[~contig_length.index.duplicated()]
+        member_length = OVU_info["contigs_in_cluster"].str.split(",").explode()
+        member_length = member_length.map(contig_length).groupby(level=0)
+        OVU_info["cluster_length"] = member_length.sum().astype(np.int64)
+        OVU_info["cluster_median_length"] = member_length.median()
         OVU_info["cluster_mean_length"] = OVU_info["cluster_length"]/OVU_info["cluster_size"]
         OVU_info = OVU_info.loc[:,['OVU', 'representative_contig', 'cluster_size', 'cluster_length', 'cluster_median_length', 'cluster_mean_length', 'lineage', 'contigs_in_cluster']]
         
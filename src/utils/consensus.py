@@ -0,0 +1,119 @@
+import os
+import numpy as np
+import pandas as pd
+from utils import fasta
+
+TOOLS = ["cat", "vs2", "gnm", "vlm"]
+# min_tools: viral votes needed; <tool>_min_score: a call only votes at or above this score (calls without a score always vote);
+# cat_confirms: a CAT virus call is enough on its own; plasmid_veto: drop contigs geNomad calls plasmids
+DEFAULT_RULE = {
+    "min_tools": 2,
+    "min_length": 3000,
+    "cat_min_score": 0.0,
+    "vs2_min_score": 0.0,
+    "gnm_min_score": 0.0,
+    "vlm_min_score": 0.8,
+    "vs2_exclude_groups": ["RNA"],
+    "cat_confirms": True,
+    "plasmid_veto": True,
+}
+SUMMARY_COLUMNS = ["seq_name", "length", "cat_category", "vs2_category", "gnm_category", "vlm_category", "v_count"]
+
+def tool_paths(prj_dir, fileHeader, file_path):
+    # outputs of the four tools for one sample; geNomad names its outputs after the assembly file
+    assembly_name = fasta.assembly_name(file_path)
+    return {
+        "cat": os.path.join(prj_dir,"out",f"{fileHeader}","CAT_results", f"{fileHeader}.nr.contig2classification.with_names.txt"),
+        "vs2": os.path.join(prj_dir,"out",f"{fileHeader}","VirSorter2_results", f"{fileHeader}-final-viral-score.tsv"),
+        "gnm_virus": os.path.join(prj_dir,"out",f"{fileHeader}","GeNomad_results",f"{assembly_name}_summary",f"{assembly_name}_virus_summary.tsv"),
+        "gnm_plasmid": os.path.join(prj_dir,"out",f"{fileHeader}","GeNomad_results",f"{assembly_name}_summary",f"{assembly_name}_plasmid_summary.tsv"),
+        "vlm": os.path.join(prj_dir,"out",f"{fileHeader}","ViraLM_results",f"result_{fileHeader}.csv"),
+    }
+
+def score_column(df, column):
+    if column in df.columns:
+        return pd.to_numeric(df[column], errors='coerce').to_numpy(dtype=np.float32)
+    return np.full(len(df), np.nan, dtype=np.float32)
+
+def read_tool_calls(paths):
+    # one long table of calls: seq_name, tool, category, group (vs2 max_score_group), score
+    cat = pd.read_table(paths["cat"], sep='\t', header=0, dtype=str).rename({"# contig":"contig"}, axis=1)
+    cat = cat[cat["classification"]=="taxid assigned"]
+    # CAT with names reports "name: score"
+    superkingdom = cat["superkingdom"].fillna("").str.split(":", n=1, regex=False)
+    vs2 = pd.read_table(paths["vs2"], sep='\t', header=0, dtype={"seqname":str, "max_score_group":str})
+    gnm_v = pd.read_table(paths["gnm_virus"], sep='\t', header=0, dtype={"seq_name":str})
+    gnm_p = pd.read_table(paths["gnm_plasmid"], sep='\t', header=0, dtype={"seq_name":str})
+    vlm = pd.read_table(paths["vlm"], sep=',', header=0, dtype={"seq_name":str})
+    calls = [
+        pd.DataFrame({"seq_name": cat["contig"], "tool": "cat", "category": superkingdom.str[0].str.strip(), "group": "",
+                      "score": pd.to_numeric(superkingdom.str[1], errors='coerce').to_numpy(dtype=np.float32)}),
+        pd.DataFrame({"seq_name": vs2["seqname"].str.split("||", n=1, regex=False).str[0], "tool": "vs2", "category": "Viruses",
+                      "group": vs2["max_score_group"] if "max_score_group" in vs2.columns else "", "score": score_column(vs2, "max_score")}),
+        pd.DataFrame({"seq_name": gnm_v["seq_name"], "tool": "gnm", "category": "Viruses", "group": "", "score": score_column(gnm_v, "virus_score")}),
+        pd.DataFrame({"seq_name": gnm_p["seq_name"], "tool": "gnm", "category": "Plasmids", "group": "", "score": score_column(gnm_p, "plasmid_score")}),
+        pd.DataFrame({"seq_name": vlm["seq_name"], "tool": "vlm", "category": "Viruses", "group": "", "score": score_column(vlm, "virus_score")}),
+    ]
+    calls = pd.concat(calls, ignore_index=True)
+    calls["tool"] = pd.Categorical(calls["tool"], categories=TOOLS)
+    calls["category"] = calls["category"].astype("category")
+    calls["group"] = calls["group"].fillna("").astype("category")
+    return calls
+
+def load_sample_calls(prj_dir, fileHeader, file_path, assembly=None):
+    # calls of one sample plus the lengths and file positions of the called contigs, cached in out/<fileHeader>/tool_calls.pkl
+    # while it is newer than the tool outputs and the assembly
+    cache_path = os.path.join(prj_dir, "out", fileHeader, "tool_calls.pkl")
+    inputs = list(tool_paths(prj_dir, fileHeader, file_path).values()) + [file_path]
+    if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= max(os.path.getmtime(x) for x in inputs):
+        return pd.read_pickle(cache_path)
+    calls = read_tool_calls(tool_paths(prj_dir, fileHeader, file_path))
+    if assembly is None:
+        assembly = fasta.FastaIndex(file_path)
+    lengths = pd.DataFrame({"seq_name": assembly.names, "length": assembly.lengths, "record": np.arange(len(assembly))})
+    lengths = lengths[lengths["seq_name"].isin(calls["seq_name"])].reset_index(drop=True)
+    sample = {"calls": calls, "lengths": lengths}
+    pd.to_pickle(sample, cache_path)
+    return sample
+
+def call_putative(calls, lengths, rule=None):
+    # vote per contig with boolean arithmetic over integer contig keys; calls and lengths may hold many samples
+    # (a "sample" column in both); returns one summary row per putative contig, ordered by sample and file position
+    rule = {**DEFAULT_RULE, **(rule or {})}
+    keys = ["sample", "seq_name"] if "sample" in calls.columns else ["seq_name"]
+    contigs = lengths.drop_duplicates(keys).reset_index(drop=True)
+    contig_index = pd.MultiIndex.from_frame(contigs[keys])
+    key = contig_index.get_indexer(pd.MultiIndex.from_frame(calls[keys]))
+    known = key >= 0
+    calls, key = calls[known], key[known]
+    num_contigs = len(contigs)
+    tool = calls["tool"].to_numpy()
+    category = calls["category"].to_numpy()
+    score = calls["score"].to_numpy()
+    is_virus = category=="Viruses"
+    if rule["vs2_exclude_groups"]:
+        is_virus &= ~((tool=="vs2") & calls["group"].isin(rule["vs2_exclude_groups"]).to_numpy())
+    votes = {}
+    for name in TOOLS:
+        passes = (tool==name) & is_virus & (np.isnan(score) | (score >= rule[f"{name}_min_score"]))
+        votes[name] = np.zeros(num_contigs, dtype=bool)
+        votes[name][key[passes]] = True
+    plasmid = np.zeros(num_contigs, dtype=bool)
+    plasmid[key[(tool=="gnm") & (category=="Plasmids")]] = True
+    v_count = np.sum([votes[name] for name in TOOLS], axis=0, dtype=np.int64) if num_contigs else np.zeros(0, dtype=np.int64)
+    putative = v_count >= rule["min_tools"]
+    if rule["cat_confirms"]:
+        putative |= votes["cat"]
+    if rule["plasmid_veto"]:
+        putative &= ~plasmid
+    putative &= contigs["length"].to_numpy() >= rule["min_length"]
+    # reported category per tool: CAT superkingdom as called, Plasmids over Viruses for geNomad, otherwise Viruses or empty
+    summary = contigs.copy()
+    cat_calls = calls[tool=="cat"]
+    summary["cat_category"] = pd.Series(cat_calls["category"].astype(str).to_numpy(), index=key[tool=="cat"]).groupby(level=0).first()
+    summary["vs2_category"] = np.where(votes["vs2"], "Viruses", "")
+    summary["gnm_category"] = np.where(plasmid, "Plasmids", np.where(votes["gnm"], "Viruses", ""))
+    summary["vlm_category"] = np.where(votes["vlm"], "Viruses", "")
+    summary["v_count"] = v_count
+    summary = summary[putative].sort_values(keys[:-1] + ["record"], kind="stable")
+    return summary.loc[:, keys[:-1] + SUMMARY_COLUMNS].reset_index(drop=True)
@@ -1,5 +1,5 @@
 import os
-from utils import config
+from utils import config, fasta
 import pandas as pd
 
 def create_project(proj_dir):
@@ -40,20 +40,20 @@ def parse_input(proj_dir, input):
     if input==None:
         file_list = []
     elif len(input)==1:
-        with open(input[0],'r') as f:
+        # a single fasta (plain or compressed), or a list of fasta paths
+        with fasta.open_fasta(input[0]) as f:
             first_line = f.readline()
-            f.seek(0)
-            if first_line.startswith(">"):
-                file_list = input
-            else:
+        if first_line.startswith(b">"):
+            file_list = input
+        else:
+            with open(input[0],'r') as f:
                 file_list = [s.rstrip('\n') for s in f.readlines()]
     else:
         file_list = input
     print(f"Total {len(file_list)} files input.")
     df = pd.DataFrame({
         "path": file_list,
-        # to be refined
-        "fileHeader": [file_path.split("/")[-1].split(".")[0] for file_path in file_list],
+        "fileHeader": [fasta.file_header(file_path) for file_path in file_list],
         "completed": False,
         "CAT": False,
         "VirSorter2": False,
@@ -0,0 +1,418 @@
+import os
+import gzip
+import mmap
+import shutil
+import hashlib
+import argparse
+import itertools
+import subprocess
+import multiprocessing
+import numpy as np
+import pandas as pd
+
+FAI_COLUMNS = ["name", "length", "offset", "linebases", "linewidth"]
+COMPLEMENT = bytes.maketrans(b'ACGTRYKMBDHVN', b'TGCAYRMKVHDBN')
+COMPRESSED_SUFFIXES = (".gz", ".bgz")
+
+def is_compressed(path):
+    return path.endswith(COMPRESSED_SUFFIXES)
+
+def strip_compression(name):
+    for suffix in COMPRESSED_SUFFIXES:
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
+    return name
+
+def assembly_name(path):
+    # file name without compression suffix and extension, e.g. a/S1.contigs.fa.gz -> S1.contigs (how geNomad names its outputs)
+    return os.path.splitext(strip_compression(os.path.basename(path)))[0]
+
+def file_header(path):
+    # sample name of an input file: its name up to the first ".", e.g. a/S1.contigs.fa.gz -> S1
+    return os.path.basename(path).split(".")[0]
+
+def open_fasta(path):
+    # binary reader; gzip and BGZF (a series of gzip members) files are decompressed on the fly
+    return gzip.open(path, 'rb') if is_compressed(path) else open(path, 'rb')
+
+class BgzipWriter():
+    # binary writer piping into bgzip, which compresses BGZF blocks with several threads
+    def __init__(self, path, threads=1) -> None:
+        self._out = open(path, 'wb')
+        self._process = subprocess.Popen(["bgzip", "-c", "-@", str(threads)], stdin=subprocess.PIPE, stdout=self._out)
+
+    def write(self, data):
+        return self._process.stdin.write(data)
+
+    def close(self):
+        self._process.stdin.close()
+        returncode = self._process.wait()
+        self._out.close()
+        if returncode != 0:
+            raise RuntimeError(f"bgzip exited with {returncode} while writing {self._out.name}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def open_output(path, compress=False, threads=1):
+    # binary writer; compressed output is BGZF when bgzip (htslib) is installed, plain gzip otherwise
+    if not compress:
+        return open(path, 'wb')
+    if shutil.which("bgzip") is not None:
+        return BgzipWriter(path, threads)
+    return gzip.open(path, 'wb', compresslevel=6)
+
+def index_buffer(buf):
+    # vectorised index of a fasta held in a uint8 array: per record the header line start, the header text end (without
+    # line break), sequence start and end (next header or end of buffer) and the samtools faidx length, linebases and linewidth;
+    # records whose lines are not all the same length (except the last, ignoring trailing empty lines) get linebases=linewidth=0,
+    # and so do records with an empty first sequence line, which a .fai cannot describe either
+    n = len(buf)
+    newlines = np.flatnonzero(buf == 10)
+    starts = np.r_[0, newlines + 1]
+    stops = np.r_[newlines + 1, n]
+    starts, stops = starts[starts < n], stops[starts < n]
+    content_ends = stops - (buf[stops - 1] == 10)
+    content_ends -= (content_ends > starts) & (buf[np.maximum(content_ends - 1, 0)] == 13)
+    bases = content_ends - starts
+    is_header = buf[starts] == 62
+    record = np.cumsum(is_header) - 1
+    headers = np.flatnonzero(is_header)
+    num_records = len(headers)
+    if num_records == 0:
+        return tuple(np.zeros(0, dtype=np.int64) for _ in range(7))
+    is_seq = ~is_header & (record >= 0)
+    lengths = np.bincount(record[is_seq], weights=bases[is_seq], minlength=num_records).astype(np.int64)
+    record_ends = np.r_[starts[headers[1:]], n].astype(np.int64) if num_records else np.zeros(0, dtype=np.int64)
+    # the first sequence line sets the line length; every later line up to the last non-empty one must match it
+    first_line = headers + 1
+    has_lines = np.zeros(num_records, dtype=bool)
+    has_lines[:] = first_line < len(starts)
+    has_lines[has_lines] &= ~is_header[first_line[has_lines]]
+    linebases = np.zeros(num_records, dtype=np.int64)
+    linewidths = np.zeros(num_records, dtype=np.int64)
+    linebases[has_lines] = bases[first_line[has_lines]]
+    linewidths[has_lines] = (stops - starts)[first_line[has_lines]]
+    line_index = np.arange(len(starts))
+    last_full = np.full(num_records, -1, dtype=np.int64)
+    full = is_seq & (bases > 0)
+    np.maximum.at(last_full, record[full], line_index[full])
+    irregular = np.zeros(num_records, dtype=bool)
+    mismatch = is_seq & (bases != linebases[np.maximum(record, 0)]) & (line_index < last_full[np.maximum(record, 0)])
+    irregular[record[mismatch]] = True
+    has_full = last_full >= 0
+    irregular[has_full] |= bases[last_full[has_full]] > linebases[has_full]
+    linebases[irregular] = 0
+    linewidths[irregular] = 0
+    return starts[headers].astype(np.int64), content_ends[headers].astype(np.int64), stops[headers].astype(np.int64), record_ends, lengths, linebases, linewidths
+
+def record_buffers(handle, chunk_size=1<<26):
+    # (offset, bytes) pieces of a binary fasta stream of about chunk_size that end right before a header line, so that no record is split
+    offset = 0
+    carry = b''
+    while True:
+        data = handle.read(chunk_size)
+        if not data:
+            break
+        carry += data
+        cut = carry.rfind(b'\n>')
+        if cut < 0:
+            continue
+        yield offset, carry[:cut+1]
+        offset += cut + 1
+        carry = carry[cut+1:]
+    if carry:
+        yield offset, carry
+
+def build_index(path):
+    # samtools faidx columns per record, in file order, indexed a chunk of records at a time;
+    # offsets of compressed files refer to the decompressed stream, as in samtools faidx of a BGZF file
+    names, columns = [], [[] for _ in range(4)]
+    with open_fasta(path) as f:
+        for offset, buf in record_buffers(f):
+            header_starts, header_ends, seq_starts, _, lengths, linebases, linewidths = index_buffer(np.frombuffer(buf, dtype=np.uint8))
+            names += [buf[x+1:y].split(None, 1)[0].decode() for x, y in zip(header_starts.tolist(), header_ends.tolist())]
+            for column, values in zip(columns, (lengths, seq_starts + offset, linebases, linewidths)):
+                column.append(values)
+    return names, [np.concatenate(x) if x else np.zeros(0, dtype=np.int64) for x in columns]
+
+def write_fai(fai_path, names, lengths, offsets, linebases, linewidths):
+    pd.DataFrame(dict(zip(FAI_COLUMNS, [names, lengths, offsets, linebases, linewidths]))).to_csv(fai_path, sep='\t', header=False, index=False)
+
+class FastaIndex():
+    # lengths and byte offsets of a fasta from its .fai (built and cached next to the fasta when missing or stale),
+    # with random access to sequences through mmap; a compressed fasta is decompressed into memory when first opened
+    def __init__(self, path, cache=True) -> None:
+        self.path = path
+        self.fai_path = path + ".fai"
+        if os.path.exists(self.fai_path) and os.path.getmtime(self.fai_path) >= os.path.getmtime(path):
+            fai = pd.read_csv(self.fai_path, sep='\t', header=None, usecols=range(5), names=FAI_COLUMNS, dtype={"name":str}, keep_default_na=False)
+            self.names = fai["name"].tolist()
+            self.lengths, self.offsets, self.linebases, self.linewidths = [fai[x].to_numpy(dtype=np.int64) for x in FAI_COLUMNS[1:]]
+        else:
+            self.names, (self.lengths, self.offsets, self.linebases, self.linewidths) = build_index(path)
+            # irregular line lengths cannot be described by a .fai, so such an index is only kept in memory
+            if cache and not ((self.linebases == 0) & (self.lengths > 0)).any():
+                self.save()
+        self._lookup = None
+        self._mmap = None
+        self._handle = None
+
+    def __len__(self):
+        return len(self.names)
+
+    def save(self):
+        try:
+            write_fai(self.fai_path, self.names, self.lengths, self.offsets, self.linebases, self.linewidths)
+        except OSError:
+            pass
+
+    def position(self, record, base):
+        # byte offset of a 0-based base position within a record
+        if self.linebases[record] == 0:
+            if self.lengths[record] == 0:
+                return self.offsets[record]
+            raise ValueError(f"{self.names[record]} in {self.path} has lines of different lengths; random access is not possible.")
+        return self.offsets[record] + (base // self.linebases[record]) * self.linewidths[record] + base % self.linebases[record]
+
+    def open(self):
+        if self._lookup is None:
+            self._lookup = {x: i for i, x in enumerate(self.names)}
+            if is_compressed(self.path):
+                with open_fasta(self.path) as f:
+                    self._mmap = f.read()
+                return
+            self._handle = open(self.path, 'rb')
+            self._mmap = mmap.mmap(self._handle.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(self.path) > 0 else b''
+
+    def record_start(self, record):
+        # byte offset of the header line of a record
+        return self._mmap.rfind(b'\n', 0, self.offsets[record]-1) + 1
+
+    def fetch(self, name, start=0, end=None):
+        # sequence bytes of name[start:end] without line breaks
+        self.open()
+        record = self._lookup[name]
+        end = self.lengths[record] if end is None else min(end, self.lengths[record])
+        if end <= start:
+            return b''
+        raw = self._mmap[self.position(record, start):self.position(record, end-1)+1]
+        return raw.replace(b'\n', b'').replace(b'\r', b'')
+
+    def write_records(self, names, out_path, threads=1):
+        # copy the named records (header and sequence lines as they are) to out_path in file order; unknown names are skipped.
+        # out_path ending in .gz is written BGZF-compressed
+        self.open()
+        records = sorted(self._lookup[x] for x in set(names) if x in self._lookup)
+        # written aside and moved into place, so an interrupted run never leaves a partial file behind
+        with open_output(out_path + ".tmp", compress=is_compressed(out_path), threads=threads) as out:
+            for record in records:
+                end = self.record_start(record+1) if record+1 < len(self) else len(self._mmap)
+                block = self._mmap[self.record_start(record):end]
+                out.write(block)
+                if not block.endswith(b'\n'):
+                    out.write(b'\n')
+        os.replace(out_path + ".tmp", out_path)
+        return len(records)
+
+    def close(self):
+        if isinstance(self._mmap, mmap.mmap):
+            self._mmap.close()
+        if self._handle is not None:
+            self._handle.close()
+        self._lookup = self._mmap = self._handle = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def merge_fastas(inputs, out_path, table_path=None, threads=1):
+    # concatenate fastas given as (path, prefix, sample) into out_path with every header line prefixed; sequence lines are
+    # copied as whole blocks. The .fai of the merged fasta (and optionally a contig, sample, sample_contig table) come
+    # out of the same pass, so nothing has to re-read the merged file to learn lengths or offsets.
+    # Inputs may be compressed; out_path ending in .gz is written BGZF-compressed
+    names, columns, table = [], [[] for _ in range(4)], []
+    pos = 0
+    with open_output(out_path + ".tmp", compress=is_compressed(out_path), threads=threads) as out:
+        for path, prefix, sample in inputs:
+            prefix = prefix.encode()
+            last = b'\n'
+            with open_fasta(path) as f:
+                for _, buf in record_buffers(f):
+                    header_starts, header_ends, seq_starts, record_ends, lengths, linebases, linewidths = index_buffer(np.frombuffer(buf, dtype=np.uint8))
+                    # anything before the first header is copied as it is
+                    leading = int(header_starts[0]) if len(header_starts) else len(buf)
+                    out.write(buf[:leading])
+                    pos += leading
+                    offsets = np.zeros(len(header_starts), dtype=np.int64)
+                    for i, (h, e, q, r) in enumerate(zip(header_starts.tolist(), header_ends.tolist(), seq_starts.tolist(), record_ends.tolist())):
+                        header = b'>' + prefix + buf[h+1:q]
+                        out.write(header)
+                        offsets[i] = pos + len(header)
+                        out.write(buf[q:r])
+                        pos += len(header) + r - q
+                        contig = buf[h+1:e].split(None, 1)[0].decode()
+                        names.append(prefix.decode() + contig)
+                        table.append((sample, contig))
+                    for column, values in zip(columns, (lengths, offsets, linebases, linewidths)):
+                        column.append(values)
+                    last = buf[-1:]
+            if last != b'\n':
+                # the next file must start on a new line
+                out.write(b'\n')
+                pos += 1
+    os.replace(out_path + ".tmp", out_path)
+    # written after the fasta, so that FastaIndex sees an up-to-date .fai
+    write_fai(out_path + ".fai", names, *[np.concatenate(x) if x else np.zeros(0, dtype=np.int64) for x in columns])
+    if table_path is not None:
+        table = pd.DataFrame(table, columns=["sample", "sample_contig"])
+        table.insert(0, "contig", names)
+        table.to_csv(table_path, sep='\t', index=False)
+    return len(names)
+
+def read_lengths(path):
+    # contig ids and sequence lengths in file order, through the cached .fai
+    index = FastaIndex(path)
+    return index.names, index.lengths
+
+def shard_bounds(lengths, num_shards):
+    # contiguous record ranges with roughly equal total bp; never more shards than records
+    num_shards = max(1, min(num_shards, len(lengths)))
+    cum_bp = np.cumsum(lengths)
+    targets = cum_bp[-1] * np.arange(1, num_shards) / num_shards if len(lengths) else np.zeros(0)
+    cuts = np.unique(np.searchsorted(cum_bp, targets, side='left') + 1)
+    cuts = cuts[(cuts > 0) & (cuts < len(lengths))]
+    bounds = np.r_[0, cuts, len(lengths)]
+    return list(zip(bounds[:-1].tolist(), bounds[1:].tolist()))
+
+def read_records(path):
+    # yield (contig id, sequence bytes) in file order
+    name = None
+    chunks = []
+    with open_fasta(path) as f:
+        for line in f:
+            if line.startswith(b'>'):
+                if name is not None:
+                    yield name, b''.join(chunks)
+                name = line[1:].split(None, 1)[0].decode()
+                chunks = []
+            else:
+                chunks.append(line.rstrip())
+    if name is not None:
+        yield name, b''.join(chunks)
+
+def read_raw_records(path):
+    # yield (contig id, record bytes as they are in the file: header and sequence lines) in file order
+    name = None
+    lines = []
+    with open_fasta(path) as f:
+        for line in f:
+            if line.startswith(b'>'):
+                if name is not None:
+                    yield name, b''.join(lines)
+                name = line[1:].split(None, 1)[0].decode()
+                lines = []
+            lines.append(line)
+    if name is not None:
+        yield name, b''.join(lines)
+
+def canonical_digest(record):
+    # 128-bit digest of the upper-cased sequence of a raw record or of its reverse complement, whichever is smaller,
+    # so that a contig and its reverse complement get the same digest
+    seq = record[record.find(b'\n')+1:].replace(b'\n', b'').replace(b'\r', b'').upper()
+    seq = min(seq, seq.translate(COMPLEMENT)[::-1])
+    return hashlib.blake2b(seq, digest_size=16).digest()
+
+def dedup_fasta(path, out_path, dup_path, detail_path, workers=1, chunk_size=10000):
+    # keep the first of every group of identical sequences (on either strand) in one streaming pass;
+    # removed records go to dup_path and every group with duplicates to detail_path as "count\tid, id, ..." (seqkit rmdup -D);
+    # memory grows with the number of unique sequences (one digest each), not with their length
+    first_seen = {}
+    groups = {}
+    records = read_raw_records(path)
+    pool = multiprocessing.Pool(workers) if workers > 1 else None
+    try:
+        with open_output(out_path + ".tmp", compress=is_compressed(out_path), threads=workers) as out, open_output(dup_path + ".tmp", compress=is_compressed(dup_path)) as dup:
+            while True:
+                chunk = list(itertools.islice(records, chunk_size))
+                if not chunk:
+                    break
+                blocks = [block for _, block in chunk]
+                digests = pool.map(canonical_digest, blocks, chunksize=max(1, len(blocks)//(4*workers))) if pool else map(canonical_digest, blocks)
+                for (name, block), digest in zip(chunk, digests):
+                    if digest in first_seen:
+                        groups.setdefault(digest, [first_seen[digest]]).append(name)
+                        dup.write(block)
+                    else:
+                        first_seen[digest] = name
+                        out.write(block)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    with open(detail_path + ".tmp", 'w') as f:
+        for names in groups.values():
+            f.write(f"{len(names)}\t{', '.join(names)}\n")
+    for x in (out_path, dup_path, detail_path):
+        os.replace(x + ".tmp", x)
+    num_removed = sum(len(x) - 1 for x in groups.values())
+    return len(first_seen), num_removed
+
+def write_subsets(path, out_paths, members):
+    # copy each record to every output listed in members[record] (indices into out_paths); outputs that get no record are not created
+    handles = [None] * len(out_paths)
+    targets = ()
+    record = -1
+    with open_fasta(path) as f:
+        for line in f:
+            if line.startswith(b'>'):
+                record += 1
+                targets = members[record]
+                for target in targets:
+                    if handles[target] is None:
+                        handles[target] = open(out_paths[target], 'wb')
+            for target in targets:
+                handles[target].write(line)
+    for handle in handles:
+        if handle is not None:
+            handle.close()
+
+def split_fasta(path, out_dir, num_shards, prefix="shard"):
+    # split a fasta into contiguous shards balanced by total bp, written as {prefix}_{i}.fasta
+    os.makedirs(out_dir, exist_ok=True)
+    _, lengths = read_lengths(path)
+    bounds = shard_bounds(lengths, num_shards)
+    shard_paths = [os.path.join(out_dir, f"{prefix}_{i}.fasta") for i in range(len(bounds))]
+    members = [(shard,) for shard, (start, end) in enumerate(bounds) for _ in range(start, end)]
+    write_subsets(path, shard_paths, members)
+    return shard_paths
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="FASTA utilities used inside generated jobs.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparser_split = subparsers.add_parser("split", help="Split a fasta into contiguous shards balanced by total bp.")
+    subparser_split.add_argument("-i", "--input", required=True, help="Input fasta.")
+    subparser_split.add_argument("-o", "--out_dir", required=True, help="Output directory for {prefix}_{i}.fasta shards.")
+    subparser_split.add_argument("-n", "--num_shards", type=int, required=True, help="Number of shards.")
+    subparser_split.add_argument("--prefix", default="shard", help="Shard file prefix. (default: shard)")
+    subparser_dedup = subparsers.add_parser("dedup", help="Remove duplicated sequences, including reverse-complement copies.")
+    subparser_dedup.add_argument("-i", "--input", required=True, help="Input fasta.")
+    subparser_dedup.add_argument("-o", "--output", required=True, help="Deduplicated fasta.")
+    subparser_dedup.add_argument("-d", "--dup", required=True, help="Fasta of the removed duplicates.")
+    subparser_dedup.add_argument("-D", "--detail", required=True, help="Table of duplicated sequence groups.")
+    subparser_dedup.add_argument("-w", "--workers", type=int, default=1, help="Number of hashing processes. (default: 1)")
+    return parser.parse_args()
+
+if __name__=="__main__":
+    args = parse_arguments()
+    if args.command=="split":
+        shard_paths = split_fasta(args.input, args.out_dir, args.num_shards, prefix=args.prefix)
+        print(f"{len(shard_paths)} shards written to {args.out_dir}")
+    elif args.command=="dedup":
+        num_unique, num_removed = dedup_fasta(args.input, args.output, args.dup, args.detail, workers=args.workers)
+        print(f"{num_unique} unique sequences kept, {num_removed} duplicates removed")
@@ -17,7 +17,7 @@ class BashHeader():
         return header
 
 class PBSHeader(BashHeader):
-    def __init__(self, job_name, ncpus, ngpus, mem, walltime, mail_addr, log_o, log_e) -> None:
+    def __init__(self, job_name, ncpus, ngpus, mem, walltime, mail_addr, log_o, log_e, array_indices=None) -> None:
         super().__init__(job_name, ncpus)
         self.ngpus = ngpus
         self.mem = mem
@@ -25,6 +25,8 @@ class PBSHeader(BashHeader):
         self.mail_addr = mail_addr
         self.log_o = log_o
         self.log_e = log_e
+        # e.g. "0-9"; subjobs read their index from $PBS_ARRAY_INDEX
+        self.array_indices = array_indices
     
     # return a list of header lines
     def get_header(self):
@@ -41,6 +43,8 @@ class PBSHeader(BashHeader):
             header.append(f"#PBS -l ngpus={self.ngpus}")
         header.append(f"#PBS -l mem={self.mem}")
         header.append(f"#PBS -l walltime={self.walltime}")
+        if self.array_indices is not None:
+            header.append(f"#PBS -J {self.array_indices}")
 
         header = [x+"\n" for x in header]
         return header
@@ -97,6 +101,80 @@ class Job():
         for line in self.scripts:
             print(line, end="")
 
+def save_stage_job(config, job_name, commands, job_dir, log_dir, mem="64GB", walltime="10:00:00", ncpus=None, array_indices=None):
+    # write a pbs/gadi/bash job for a single post-processing stage; commands are lines without "\n"
+    # returns the names of the saved jobs (gadi and bash have no job arrays, so an array stage becomes one job per index)
+    if ncpus is None:
+        ncpus = config['bash']['ncpus'] if config['job_manager']=='bash' else config['pbs']['ncpus']
+    commands = [x+"\n" for x in commands]
+    if config['job_manager']=='pbs':
+        job_header = PBSHeader(
+            job_name=job_name,
+            ncpus=ncpus,
+            ngpus=0,
+            mem=mem,
+            walltime=walltime,
+            mail_addr=config['pbs']['mail_addr'],
+            log_o=os.path.join(log_dir, f"{job_name}.o"),
+            log_e=os.path.join(log_dir, f"{job_name}.e"),
+            array_indices=None if array_indices is None else f"{array_indices[0]}-{array_indices[-1]}",
+        )
+        Job(job_manager='pbs', job_header=job_header, commands=commands).save_job(job_dir=job_dir)
+        return [job_name]
+    elif config['job_manager']=='gadi':
+        job_names = []
+        for index in ([None] if array_indices is None else array_indices):
+            name = job_name if index is None else f"{job_name}_{index}"
+            job_header = GadiHeader(
+                job_name=name,
+                ncpus=ncpus,
+                ngpus=0,
+                mem=mem,
+                walltime=walltime,
+                mail_addr=config['pbs']['mail_addr'],
+                log_o=os.path.join(log_dir, f"{name}.o"),
+                log_e=os.path.join(log_dir, f"{name}.e"),
+                project=config['pbs']['gadi']['-P project'],
+                storage=config['pbs']['gadi']['-l storage'],
+                node_type="normalsl",
+                jobfs="2GB",
+            )
+            job_commands = commands if index is None else [f"PBS_ARRAY_INDEX={index}\n"] + commands
+            Job(job_manager='gadi', job_header=job_header, commands=job_commands).save_job(job_dir=job_dir)
+            job_names.append(name)
+        return job_names
+    elif config['job_manager']=='bash':
+        job_names = []
+        for index in ([None] if array_indices is None else array_indices):
+            name = job_name if index is None else f"{job_name}_{index}"
+            job_header = BashHeader(job_name=name, ncpus=ncpus)
+            job_commands = commands if index is None else [f"PBS_ARRAY_INDEX={index}\n"] + commands
+            Job(job_manager='bash', job_header=job_header, commands=job_commands).save_job(job_dir=job_dir)
+            job_names.append(name)
+        return job_names
+
+def save_submit_script(job_dir, stages, script_name, job_manager='pbs'):
+    # chain stages with qsub dependencies; each stage is a list of job names that may run in parallel
+    # the bash manager has no scheduler, so its jobs are run one after another and a failing job stops the chain
+    if job_manager=='bash':
+        lines = ["#!/bin/bash", "set -e", f"cd {job_dir}"]
+        for stage in stages:
+            for job_name in stage:
+                lines.append(f"echo \"running {job_name}\"; bash {job_name}.sh")
+        with open(os.path.join(job_dir, script_name), 'w') as f:
+            f.writelines([x+"\n" for x in lines])
+        os.system(f"chmod +x {os.path.join(job_dir, script_name)}")
+        return
+    lines = ["#!/bin/bash", "set -e", f"cd {job_dir}", "depend=\"\""]
+    for idx, stage in enumerate(stages):
+        lines.append(f"ids_{idx}=\"\"")
+        for job_name in stage:
+            lines.append(f"id=$(qsub $depend {job_name}.pbs); echo \"$id {job_name}\"; ids_{idx}=\"$ids_{idx}:$id\"")
+        lines.append(f"depend=\"-W depend=afterok$ids_{idx}\"")
+    with open(os.path.join(job_dir, script_name), 'w') as f:
+        f.writelines([x+"\n" for x in lines])
+    os.system(f"chmod +x {os.path.join(job_dir, script_name)}")
+
 
 def generate_CAT_commands(job_header, out_dir, file_list):
     commands = [
@@ -196,6 +274,7 @@ def generate_GNM_commands(job_header, out_dir, file_list):
         '\t\tmkdir -p $out_dir/',
         '\tfi',
         "\theader=$(echo $file | awk -F \'/\' \'{print $NF}\')",
+        '\theader=${header%.gz}; header=${header%.bgz}', # geNomad drops the compression suffix too
         '\tif [ -f "$out_dir/${header%.*}_summary/${header%.*}_virus_summary.tsv" ];then',
         '\t\tif [ -f "$out_dir/${header%.*}_summary/${header%.*}_plasmid_summary.tsv" ] ;then',
         '\t\t\techo "$fileHeader geNomad has already finished. Continue to the next one."',
@@ -1,5 +1,9 @@
 import os
+import hashlib
+import numpy as np
 import pandas as pd
+from scipy import sparse, io
+from concurrent.futures import ThreadPoolExecutor
 import envs
 from utils import job_management
 
@@ -103,28 +107,104 @@ def chunk_dataframe(df: pd.DataFrame, size: int=10):
         chunks.append(chunk)
     return chunks
 
-def mapping(prj_dir, manifest, config):
+def fastq_bytes(df):
+    # bytes of fq1+fq2 per sample, the proxy for mapping time; missing files count as the median sample
+    def size(path):
+        try:
+            return os.path.getsize(path)
+        except OSError:
+            return np.nan
+    sizes = pd.Series([size(fq1) + size(fq2) for fq1, fq2 in zip(df["fq1"], df["fq2"])], index=df.index, dtype=np.float64)
+    for header in df.loc[sizes.isna(), "fileHeader"]:
+        print(f"{header}\tFASTQ not found, its size is taken as the median sample")
+    fill = sizes.median() if sizes.notna().any() else 0
+    return sizes.fillna(fill).astype(np.int64)
+
+def pack_samples(sizes, byte_budget, batch_size):
+    # first-fit decreasing: largest samples first, each into the first job with room left in both bytes and sample count;
+    # a sample larger than the budget gets a job of its own. Returns a list of index lists, largest job first
+    jobs, loads = [], []
+    for idx, num_bytes in sizes.sort_values(ascending=False, kind='stable').items():
+        for job, load in enumerate(loads):
+            if load + num_bytes <= byte_budget and len(jobs[job]) < batch_size:
+                jobs[job].append(idx)
+                loads[job] += num_bytes
+                break
+        else:
+            jobs.append([idx])
+            loads.append(num_bytes)
+    return jobs
+
+def predicted_walltime(num_bytes, gb_per_hour, safety=1.5):
+    # mapping time at gb_per_hour of FASTQ, with a safety margin, rounded up to half an hour
+    hours = max(0.5, np.ceil(2 * safety * num_bytes / (gb_per_hour * 1e9)) / 2)
+    return f"{int(hours)}:{int(round((hours % 1) * 60)):02d}:00"
+
+def predicted_mem(reference, threads, sort=True):
+    # strobealign index (~12 bytes per reference bp, taken from the fasta size) plus samtools sort buffers (768MB per thread)
+    if not os.path.isfile(reference):
+        return "120GB"
+    return f"{int(np.ceil(12 * os.path.getsize(reference) / 1e9 + (0.8 * threads if sort else 0) + 4))}GB"
+
+def sample_commands(threads, counts_only=False, keep_bam=False):
+    # per-sample body of the mapping loop; $fasta, $gtf, $fq1, $fq2, $out_dir, $bam, $stat and $count are set by the loop.
+    # counts_only streams the strobealign SAM into samcount.py instead of sorting, indexing, flagstat and featureCounts,
+    # and only writes a (sorted, indexed) BAM with keep_bam
+    if not counts_only:
+        return [
+            f"\t{STROBEALIGN_PATH} $fasta $fq1 $fq2 -t {threads} | {SAMTOOLS_PATH} sort -T $out_dir -o $bam -@ {threads}",
+            f"\t{SAMTOOLS_PATH} index $bam -@ {threads}",
+            f"\t{SAMTOOLS_PATH} flagstat $bam -@ {threads} > $stat",
+            f"\t{FEATURECOUNTS_PATH} -p -t contig -g contig_id -a $gtf -o $count -T {threads} $bam",
+        ]
+    samcount = f"python {os.path.join(envs.INSTALLATION_PATH, 'src', 'samcount.py')} -a $gtf -o $count.part --label $header"
+    if keep_bam:
+        samcount += f" --echo | {SAMTOOLS_PATH} sort -T $out_dir -o $bam -@ {threads}"
+    commands = [
+        # the counts are only moved into place when every stage of the pipe succeeded (set -o pipefail)
+        f"\tif {STROBEALIGN_PATH} $fasta $fq1 $fq2 -t {threads} | {samcount}; then",
+        "\t\tmv $count.part $count && mv $count.part.summary $count.summary",
+    ]
+    if keep_bam:
+        commands.append(f"\t\t{SAMTOOLS_PATH} index $bam -@ {threads}")
+    commands += [
+        "\telse",
+        "\t\techo \"$header mapping failed!\"",
+        "\t\trm -f $count.part $count.part.summary",
+        "\t\tcontinue",
+        "\tfi",
+    ]
+    return commands
+
+def mapping(prj_dir, manifest, config, batch_size=10, job_hours=10, gb_per_hour=8, counts_only=False, keep_bam=False):
+    # samples are bin-packed by FASTQ size into jobs of about job_hours at gb_per_hour, at most batch_size samples each;
+    # every job asks for the walltime of its own load
     os.makedirs(os.path.join(prj_dir,"Abundance"), exist_ok=True)
     os.makedirs(os.path.join(prj_dir,"Abundance","jobs"), exist_ok=True)
     os.makedirs(os.path.join(prj_dir,"Abundance","logs"), exist_ok=True)
     os.makedirs(os.path.join(prj_dir,"Abundance","out"), exist_ok=True)
 
     df = pd.read_csv(manifest, header=None, names=["fileHeader", "fq1", "fq2"], index_col=None)
-    chunks = chunk_dataframe(df, size=10)
+    sizes = fastq_bytes(df)
+    jobs = pack_samples(sizes, byte_budget=job_hours*gb_per_hour*1e9, batch_size=batch_size)
     fasta = os.path.join(prj_dir, "Abundance", "rep_contigs.fasta")
     gtf = os.path.join(prj_dir,"Abundance","rep_contigs.gtf")
-    
-    for chunk in chunks:
-        header_list = chunk["fileHeader"].tolist()
-        fq1_list = chunk["fq1"].tolist()
-        fq2_list = chunk["fq2"].tolist()
-        header_pair_list = [header+"|"+fq1+"|"+fq2 for header,fq1,fq2 in zip(header_list,fq1_list,fq2_list)]
-        job_dir = os.path.join(prj_dir,"Abundance","jobs")
-        log_dir = os.path.join(prj_dir,"Abundance","logs")
-        if config['job_manager'] in ['pbs', 'gadi']:
-            threads = config['pbs']['ncpus']
+    job_dir = os.path.join(prj_dir,"Abundance","jobs")
+    log_dir = os.path.join(prj_dir,"Abundance","logs")
+    threads = config['bash']['ncpus'] if config['job_manager']=='bash' else config['pbs']['ncpus']
+    # rep_contigs.fasta is only copied into Abundance by the indexing job
+    mem = predicted_mem(os.path.join(prj_dir, "OVU", "rep_contigs.fasta"), threads, sort=keep_bam or not counts_only)
+
+    plan = []
+    for job_idx, samples in enumerate(jobs):
+        chunk = df.loc[samples]
+        job_name = f"mapping_{job_idx+1}_{len(jobs)}"
+        job_bytes = int(sizes[samples].sum())
+        walltime = predicted_walltime(job_bytes, gb_per_hour)
+        header_pair_list = [header+"|"+fq1+"|"+fq2 for header,fq1,fq2 in zip(chunk["fileHeader"],chunk["fq1"],chunk["fq2"])]
         bash_commands = [
             f"source {CONDA_PATH}/bin/activate {MAIN_ENV_NAME}",
+            "set -o pipefail",
             "header_pair_list=(",
             "{}".format('\n'.join(f'"{item}"' for item in header_pair_list)),
             ")",
@@ -140,139 +220,205 @@ def mapping(prj_dir, manifest, config):
             f"\tcount={os.path.join(prj_dir,'Abundance', 'out')}/$header/\"$header\"_count.tsv",
             f"\tmkdir -p $out_dir",
             "\techo \"$header mapping started.\"",
-            f"\t{STROBEALIGN_PATH} $fasta $fq1 $fq2 -t {threads} | {SAMTOOLS_PATH} sort -T $out_dir -o $bam -@ {threads}",
-            f"\t{SAMTOOLS_PATH} index $bam -@ {threads}",
-            f"\t{SAMTOOLS_PATH} flagstat $bam -@ {threads} > $stat",
-            f"\t{FEATURECOUNTS_PATH} -p -t contig -g contig_id -a $gtf -o $count -T {threads} $bam",
+        ] + sample_commands(threads, counts_only, keep_bam) + [
             f"\techo \"$header mapping finished!\"",
             f"\techo \"{'-'*100}\"",
-            # f"\tbreak",
             "done",
         ]
-        bash_commands = [x+"\n" for x in bash_commands]
-        if config['job_manager']=='pbs':
-            cluster_job_header = job_management.PBSHeader(
-                job_name=f"mapping_{chunk.index.to_list()[0]+1}_{chunk.index.to_list()[-1]+1}",
-                ncpus=threads,
-                ngpus=0,
-                mem="120GB",
-                walltime="10:00:00",
-                mail_addr=config['pbs']['mail_addr'],
-                log_o=os.path.join(log_dir, f"{log_dir}/mapping_{chunk.index.to_list()[0]+1}_{chunk.index.to_list()[-1]+1}.o"),
-                log_e=os.path.join(log_dir, f"{log_dir}/mapping_{chunk.index.to_list()[0]+1}_{chunk.index.to_list()[-1]+1}.e"),
-            )
-            cluster_job = job_management.Job(
-                job_manager='pbs',job_header=cluster_job_header, commands=bash_commands,
-            )
-            cluster_job.save_job(job_dir=job_dir)
-        elif config['job_manager']=='gadi':
-            cluster_job_header = job_management.GadiHeader(
-                job_name=f"mapping_{chunk.index.to_list()[0]+1}_{chunk.index.to_list()[-1]+1}",
-                ncpus=threads,
-                ngpus=0,
-                mem="120GB",
-                walltime="10:00:00",
-                mail_addr=config['pbs']['mail_addr'],
-                log_o=os.path.join(log_dir, f"{log_dir}/mapping_{chunk.index.to_list()[0]+1}_{chunk.index.to_list()[-1]+1}.o"),
-                log_e=os.path.join(log_dir, f"{log_dir}/mapping_{chunk.index.to_list()[0]+1}_{chunk.index.to_list()[-1]+1}.e"),
-                project=config['pbs']['gadi']['-P project'],
-                storage=config['pbs']['gadi']['-l storage'],
-                node_type="normalsl",
-                jobfs="2GB",
-            )
-            cluster_job = job_management.Job(
-                job_manager='gadi',job_header=cluster_job_header, commands=bash_commands,
-            )
-            cluster_job.save_job(job_dir=job_dir)
-        
-        # print(cluster_job.job_header.job_name)
-        # pbs_header = [
-        #     "#!/bin/bash",
-        #     "# Job Name:",
-        #     f"#PBS -N mapping_{chunk.index.to_list()[0]+1}_{chunk.index.to_list()[-1]+1}",
-        #     "# Project Info:",
-        #     "#PBS -P mp96",
-        #     "#PBS -l storage=gdata/oo46+gdata/mp96",
-        #     "# Log Output:",
-        #     f"#PBS -o {logs}/mapping_{chunk.index.to_list()[0]+1}_{chunk.index.to_list()[-1]+1}.o",
-        #     f"#PBS -e {logs}/mapping_{chunk.index.to_list()[0]+1}_{chunk.index.to_list()[-1]+1}.e",
-        #     "#PBS -j oe",
-        #     "# Mailing:",
-        #     "#PBS -m abe",
-        #     "#PBS -M 379004663@qq.com",   
-        #     "# Resources Allocation:",
-        #     "#PBS -q normalsl",
-        #     "#PBS -l walltime=2:30:00",
-        #     "#PBS -l mem=120GB",
-        #     f"#PBS -l ncpus={threads}",
-        #     "#PBS -l jobfs=2GB",
-        # ]
-        # with open(job, 'w') as f:
-        #     f.writelines([line + "\n" for line in pbs_header] + [line + "\n" for line in bash_commands])
-    return 
+        job_management.save_stage_job(config, job_name, bash_commands, job_dir, log_dir, mem=mem, walltime=walltime, ncpus=threads)
+        plan.append(pd.DataFrame({"job": job_name, "fileHeader": chunk["fileHeader"], "bytes": sizes[samples], "job_bytes": job_bytes, "walltime": walltime, "mem": mem}))
+    if plan:
+        pd.concat(plan).to_csv(os.path.join(prj_dir, "Abundance", "mapping_jobs.tsv"), sep='\t', index=None)
+    print(f"{len(df)} samples ({sizes.sum()/1e9:.1f} GB of FASTQ) packed into {len(jobs)} mapping jobs in {job_dir}; plan in {os.path.join(prj_dir, 'Abundance', 'mapping_jobs.tsv')}")
+    return
+
+MAPPING_OUTPUTS = ["_count.tsv", "_count.tsv.summary", "_sorted.bam", "_sorted.bam.bai", "_stat.txt"]
+# the counts are written last in both modes; counts-only jobs (samcount.py) write no BAM, index or flagstat
+REQUIRED_OUTPUTS = ["_count.tsv", "_count.tsv.summary"]
 
 def check(prj_dir, manifest):
     manifest = pd.read_csv(manifest, header=None, names=["fileHeader", "fq1", "fq2"], index_col=None)
-    mapping = pd.DataFrame({
-        "fileHeader": manifest["fileHeader"],
-        "mapping": False,
-        "_count.tsv": False,
-        "_count.tsv.summary": False,
-        "_sorted.bam": False,
-        "_sorted.bam.bai": False,
-        "_stat.txt": False
-    })
-    def check_single(s, prj_dir):
-        columns_to_check = ["_count.tsv", "_count.tsv.summary", "_sorted.bam", "_sorted.bam.bai", "_stat.txt"]
-        for col in columns_to_check:
-            s[col] = os.path.isfile(os.path.join(prj_dir, "Abundance", "out", s["fileHeader"], s["fileHeader"]+col))
-        if s[columns_to_check].all():
-            s["mapping"] = True
-        return s
-    mapping = mapping.apply(lambda s: check_single(s, prj_dir=prj_dir), axis=1)
+    out_dir = os.path.join(prj_dir, "Abundance", "out")
+    # one directory listing per sample instead of a stat call per expected file
+    def listing(sample):
+        try:
+            return set(os.listdir(os.path.join(out_dir, sample)))
+        except (FileNotFoundError, NotADirectoryError):
+            return set()
+    listings = [listing(sample) for sample in manifest["fileHeader"]]
+    mapping = pd.DataFrame({"fileHeader": manifest["fileHeader"], "mapping": False})
+    for col in MAPPING_OUTPUTS:
+        mapping[col] = [sample+col in files for sample, files in zip(manifest["fileHeader"], listings)]
+    mapping["mapping"] = mapping[REQUIRED_OUTPUTS].all(axis=1)
     mapping.to_csv(os.path.join(prj_dir, "Abundance", "mapping_check.csv"),index=None)
     return mapping
 
-def count_matrix(prj_dir, manifest):
-    # get all
+COUNT_KEYS = ['contig', 'Chr', 'Start', 'End', 'Strand','Length']
+
+def read_features(gtf):
+    # featureCounts key columns of every contig, in the row order featureCounts writes them (the order of the gtf)
+    features = pd.read_table(gtf, sep='\t', header=None, usecols=[0, 3, 4, 6, 8], names=['Chr', 'Start', 'End', 'Strand', 'attributes'], dtype={'Chr':str})
+    features.insert(0, 'contig', features.pop('attributes').str.extract(r'contig_id "([^"]*)"', expand=False))
+    features['Length'] = features['End'] - features['Start'] + 1
+    return features.loc[:, COUNT_KEYS]
+
+def read_count_column(count_path, contigs):
+    # count column of one featureCounts table as int32, in the order of contigs
+    counts = pd.read_table(count_path, sep='\t', skiprows=1, header=0, usecols=[0, 6], names=['contig', 'count'], dtype={'contig':str, 'count':np.int64})
+    if not np.array_equal(counts['contig'].to_numpy(), contigs):
+        counts = counts.set_index('contig').reindex(contigs, fill_value=0).reset_index()
+    if len(counts) and counts['count'].max() > np.iinfo(np.int32).max:
+        raise ValueError(f"{count_path}: counts do not fit into int32")
+    return counts['count'].to_numpy(dtype=np.int32)
+
+def count_path(prj_dir, sample):
+    return os.path.join(prj_dir, "Abundance", "out", sample, f"{sample}_count.tsv")
+
+def count_key(path):
+    # a count file is re-parsed only when its path, size or mtime changes
+    stat = os.stat(path)
+    return os.path.abspath(path), stat.st_size, stat.st_mtime_ns
+
+def features_digest(contigs):
+    # cached columns are only valid for the contig order they were parsed against
+    return hashlib.blake2b("\n".join(contigs).encode(), digest_size=16).hexdigest()
+
+def save_count_cache(cache_path, column, key, digest):
+    # non-zero rows of one parsed count column, with the key of the count file it came from
+    rows = np.flatnonzero(column).astype(np.int32)
+    tmp_path = cache_path[:-len(".npz")] + ".tmp.npz"
+    np.savez(tmp_path, rows=rows, counts=column[rows], path=key[0], size=key[1], mtime=key[2], digest=digest)
+    os.replace(tmp_path, cache_path)
+
+def load_count_cache(cache_path, key, digest, num_rows):
+    # the cached count column, or None if there is none or it is stale
+    if not os.path.isfile(cache_path):
+        return None
+    try:
+        with np.load(cache_path) as cache:
+            if (str(cache["path"]), int(cache["size"]), int(cache["mtime"]), str(cache["digest"])) != (key[0], key[1], key[2], digest):
+                return None
+            column = np.zeros(num_rows, dtype=np.int32)
+            column[cache["rows"]] = cache["counts"]
+            return column
+    except (OSError, ValueError, KeyError):
+        return None
+
+def read_count_block(prj_dir, samples, contigs, keys, digest, cache_dir, workers=1):
+    # count columns of a block of samples, filled in a thread pool into one preallocated int32 array and returned as
+    # csc; each column comes from the per-sample cache when it is fresh, otherwise it is parsed and cached
+    block = np.zeros((len(contigs), len(samples)), dtype=np.int32)
+    def fill(column):
+        cache_path = os.path.join(cache_dir, f"{samples[column]}.npz")
+        counts = load_count_cache(cache_path, keys[column], digest, len(contigs))
+        if counts is None:
+            counts = read_count_column(count_path(prj_dir, samples[column]), contigs)
+            save_count_cache(cache_path, counts, keys[column], digest)
+        block[:, column] = counts
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(fill, range(len(samples))))
+    return sparse.csc_matrix(block)
+
+def save_assembled(path, counts, samples, keys, digest):
+    # the assembled count matrix, with the key of the count file behind every column
+    tmp_path = path[:-len(".npz")] + ".tmp.npz"
+    np.savez(tmp_path, data=counts.data, indices=counts.indices, indptr=counts.indptr, shape=np.array(counts.shape),
+        samples=np.array(samples, dtype=str), paths=np.array([key[0] for key in keys], dtype=str),
+        sizes=np.array([key[1] for key in keys], dtype=np.int64), mtimes=np.array([key[2] for key in keys], dtype=np.int64), digest=digest)
+    os.replace(tmp_path, path)
+
+def load_assembled(path, digest):
+    # the count matrix of the previous run and a {sample: (column, key)} lookup, or None if missing or built on other contigs
+    if not os.path.isfile(path):
+        return None
+    try:
+        with np.load(path) as saved:
+            if str(saved["digest"]) != digest:
+                return None
+            counts = sparse.csc_matrix((saved["data"], saved["indices"], saved["indptr"]), shape=tuple(saved["shape"]))
+            columns = {sample: (column, (p, int(size), int(mtime))) for column, (sample, p, size, mtime) in enumerate(zip(saved["samples"].tolist(), saved["paths"].tolist(), saved["sizes"], saved["mtimes"]))}
+    except (OSError, ValueError, KeyError):
+        return None
+    return counts, columns
+
+def scale_columns(matrix, factors):
+    # multiply every column by its factor; columns with a zero total (factor inf or nan) stay zero
+    return (matrix @ sparse.diags(np.nan_to_num(factors, nan=0.0, posinf=0.0))).tocsc()
+
+def write_dense_csv(path, features, samples, matrix, chunk_rows=100000):
+    # dense csv of key columns and samples, written a block of rows at a time
+    for start in range(0, max(matrix.shape[0], 1), chunk_rows):
+        rows = features.iloc[start:start+chunk_rows].reset_index(drop=True)
+        block = pd.DataFrame(matrix[start:start+chunk_rows].toarray(), columns=samples)
+        pd.concat([rows, block], axis=1).to_csv(path, index=None, mode='w' if start==0 else 'a', header=start==0)
+
+def write_sparse(out_dir, features, samples, matrices):
+    # Matrix Market files (only non-zero entries) that share one features.tsv (rows) and samples.tsv (columns)
+    os.makedirs(out_dir, exist_ok=True)
+    features.to_csv(os.path.join(out_dir, "features.tsv"), sep='\t', index=None)
+    pd.Series(samples, name="fileHeader").to_csv(os.path.join(out_dir, "samples.tsv"), sep='\t', index=None)
+    for name, matrix in matrices.items():
+        io.mmwrite(os.path.join(out_dir, f"{name}.mtx"), matrix)
+
+def count_matrix(prj_dir, manifest, workers=1, block_size=500, dense_csv=True, use_cache=True):
+    # counts are held as a sparse contigs x samples matrix, since most OVUs are absent from most samples; count files
+    # are parsed block_size samples at a time, so at most one dense block is in memory
+    # parsed columns are cached per sample (Abundance/matrix/cache) and the assembled matrix is kept
+    # (Abundance/matrix/count_cache.npz), so a rerun only parses samples whose count file is new or has changed
     def get_all_count(prj_dir, manifest):
         mapping_check = check(prj_dir=prj_dir, manifest=manifest)
-        all_count = pd.DataFrame()
-        for idx, row in mapping_check.iterrows():
-            if row["mapping"]==False:
-                print(f"{idx}\t{row['fileHeader']}\tNo file")
-                continue
-            else:
-                current_count = pd.read_table(
-                    os.path.join(prj_dir, "Abundance", "out", row["fileHeader"], f"{row['fileHeader']}_count.tsv"),header=1,
-                    names = ['contig', 'Chr', 'Start', 'End', 'Strand','Length', row["fileHeader"]],
-                )
-                if all_count.shape[1]==0:
-                    all_count = current_count
-                else:
-                    all_count = pd.merge(all_count, current_count, how='left')
-        return all_count
-    
-    def get_RPK(all_count):
-        RPK = all_count.apply(lambda x: x/all_count.index.get_level_values("Length")*1e3, axis=0)
-        return RPK
+        for idx, row in mapping_check[mapping_check["mapping"]==False].iterrows():
+            print(f"{idx}\t{row['fileHeader']}\tNo file")
+        samples = mapping_check.loc[mapping_check["mapping"]==True, "fileHeader"].tolist()
+        features = read_features(os.path.join(prj_dir,"Abundance","rep_contigs.gtf"))
+        contigs = features['contig'].to_numpy()
+        digest = features_digest(contigs)
+        keys = [count_key(count_path(prj_dir, sample)) for sample in samples]
+        matrix_dir = os.path.join(prj_dir, "Abundance", "matrix")
+        cache_dir = os.path.join(matrix_dir, "cache")
+        os.makedirs(cache_dir, exist_ok=True)
+        assembled_path = os.path.join(matrix_dir, "count_cache.npz")
+        assembled = load_assembled(assembled_path, digest) if use_cache else None
+        previous, columns = assembled if assembled is not None else (None, {})
+        reused = [i for i, (sample, key) in enumerate(zip(samples, keys)) if sample in columns and columns[sample][1] == key]
+        new = sorted(set(range(len(samples))) - set(reused))
+        if not use_cache:
+            for i in new:
+                cache_path = os.path.join(cache_dir, f"{samples[i]}.npz")
+                if os.path.exists(cache_path):
+                    os.remove(cache_path)
+        blocks = [previous[:, [columns[samples[i]][0] for i in reused]]] if reused else []
+        for start in range(0, len(new), block_size):
+            block = new[start:start+block_size]
+            blocks.append(read_count_block(prj_dir, [samples[i] for i in block], contigs, [keys[i] for i in block], digest, cache_dir, workers))
+        counts = sparse.hstack(blocks, format='csc') if blocks else sparse.csc_matrix((len(features), 0), dtype=np.int32)
+        # back into manifest order
+        order = np.argsort(np.array(reused + new, dtype=np.int64), kind='stable')
+        counts = counts[:, order].tocsc() if len(order) else counts
+        save_assembled(assembled_path, counts, samples, keys, digest)
+        print(f"{len(reused)} samples taken from the previous count matrix, {len(new)} new or changed samples added")
+        return features, samples, counts
+
+    # RPK: reads per kilobase of contig; FPKM: RPK per million mapped reads; TPM: RPK scaled to a million per sample
+    def get_RPK(features, all_count):
+        return (sparse.diags(1e3/features["Length"].to_numpy(dtype=np.float64)) @ all_count).tocsc()
     def get_FPKM(all_count, RPK):
-        FPKM = RPK.apply(lambda x: x/all_count[x.name].sum()*1e6,axis=0)
-        return FPKM
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return scale_columns(RPK, 1e6/np.asarray(all_count.sum(axis=0), dtype=np.float64).ravel())
     def get_TPM(RPK):
-        TPM = RPK.apply(lambda x: x/x.sum()*1e6,axis=0)
-        return TPM
-
-    all_count = get_all_count(prj_dir, manifest)
-    all_count.to_csv(os.path.join(prj_dir, "Abundance", "all_count.csv"), index=None)
-    all_count = all_count.set_index(['contig', 'Chr', 'Start', 'End', 'Strand','Length']).astype(int)
-    
-    RPK = get_RPK(all_count)
-    FPKM = get_FPKM(all_count, RPK).reset_index()
-    TPM = get_TPM(RPK).reset_index()
-    
-    FPKM.to_csv(os.path.join(prj_dir,"Abundance","all_FPKM.csv"), index=None)
-    TPM.to_csv(os.path.join(prj_dir,"Abundance","all_TPM.csv"), index=None)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return scale_columns(RPK, 1e6/np.asarray(RPK.sum(axis=0)).ravel())
+
+    features, samples, all_count = get_all_count(prj_dir, manifest)
+    RPK = get_RPK(features, all_count)
+    FPKM = get_FPKM(all_count, RPK)
+    TPM = get_TPM(RPK)
+    write_sparse(os.path.join(prj_dir, "Abundance", "matrix"), features, samples, {"count": all_count, "FPKM": FPKM, "TPM": TPM})
+    if dense_csv:
+        write_dense_csv(os.path.join(prj_dir, "Abundance", "all_count.csv"), features, samples, all_count)
+        write_dense_csv(os.path.join(prj_dir, "Abundance", "all_FPKM.csv"), features, samples, FPKM)
+        write_dense_csv(os.path.join(prj_dir, "Abundance", "all_TPM.csv"), features, samples, TPM)
+    print(f"{all_count.shape[0]} contigs x {len(samples)} samples, {all_count.nnz} non-zero counts; matrices written to {os.path.join(prj_dir, 'Abundance', 'matrix')}")
 
 if __name__=="__main__":
     pass
@@ -1,120 +1,137 @@
 import pandas as pd
 import numpy as np
 import os
+import json
+import time
+import traceback
+import subprocess
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import envs
-from utils import job_management
+from utils import job_management, fasta, consensus
 
-def extract_putative_contigs_single_sample(prj_dir, fileHeader, file_path, min_len=3000):
+def stage_name(stage, batch_name=None):
+    # batch jobs running side by side keep their reports (and scratch directories) apart
+    return stage if batch_name is None else f"{stage}_{batch_name}"
+
+def outputs_up_to_date(inputs, outputs):
+    # every output exists and is at least as new as every input
+    if not all(os.path.exists(x) for x in outputs):
+        return False
+    return min(os.path.getmtime(x) for x in outputs) >= max(os.path.getmtime(x) for x in inputs)
+
+def run_sample(func, kwargs):
+    # run one sample of a stage; returns (seconds, error message or "")
+    start = time.time()
+    try:
+        func(**kwargs)
+        error = ""
+    except Exception:
+        error = traceback.format_exc().strip().splitlines()[-1]
+    return time.time()-start, error
+
+def run_samples(prj_dir, stage, func, tasks, workers=1, force=False):
+    # run func for every (fileHeader, inputs, outputs, kwargs) task in a pool of workers processes;
+    # samples with missing inputs or up-to-date outputs are skipped. A per-sample report is written to {stage}_report.tsv
+    report = []
+    todo = []
+    for fileHeader, inputs, outputs, kwargs in tasks:
+        missing = [x for x in inputs if not os.path.exists(x)]
+        if len(missing)>0:
+            report.append([fileHeader, "missing_input", 0.0, f"{missing[0]} does not exist."])
+        elif not force and outputs_up_to_date(inputs, outputs):
+            report.append([fileHeader, "up_to_date", 0.0, ""])
+        else:
+            todo.append((fileHeader, kwargs))
+    start = time.time()
+    if workers>1 and len(todo)>1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [(fileHeader, pool.submit(run_sample, func, kwargs)) for fileHeader, kwargs in todo]
+            results = [(fileHeader, future.result()) for fileHeader, future in futures]
+    else:
+        results = [(fileHeader, run_sample(func, kwargs)) for fileHeader, kwargs in todo]
+    for fileHeader, (seconds, error) in results:
+        report.append([fileHeader, "failed" if error else "done", round(seconds, 2), error])
+    return write_report(prj_dir, stage, report, start)
+
+def write_report(prj_dir, stage, report, start):
+    # report rows are [fileHeader, status, seconds, error]
+    report = pd.DataFrame(report, columns=["fileHeader", "status", "seconds", "error"])
+    report.to_csv(os.path.join(prj_dir, f"{stage}_report.tsv"), sep='\t', index=None)
+    counts = report["status"].value_counts()
+    print(f"{stage}: {counts.get('done', 0)} done, {counts.get('up_to_date', 0)} up to date, {counts.get('missing_input', 0)} missing inputs, {counts.get('failed', 0)} failed in {time.time()-start:.1f}s. Details in {os.path.join(prj_dir, f'{stage}_report.tsv')}")
+    for _, row in report[report["status"].isin(["failed", "missing_input"])].iterrows():
+        print(f"  {row['fileHeader']}: {row['status']}: {row['error']}")
+    return report
+
+def putative_inputs(prj_dir, fileHeader, file_path):
+    # tool outputs that extract_putative_contigs_single_sample reads, besides the assembly itself
+    return list(consensus.tool_paths(prj_dir, fileHeader, file_path).values())
+
+def extraction_rule(min_len=3000, num_confirmed_tools=2, rule=None):
+    return {**consensus.DEFAULT_RULE, **(rule or {}), "min_length": min_len, "min_tools": num_confirmed_tools}
+
+def save_extraction_rule(prj_dir, rule):
+    # the rule file is rewritten only when the rule changes, which makes every sample out of date
+    rule_path = os.path.join(prj_dir, "extract_rule.json")
+    if os.path.exists(rule_path):
+        with open(rule_path, 'r') as f:
+            if json.load(f)==rule:
+                return rule_path
+    with open(rule_path + ".tmp", 'w') as f:
+        json.dump(rule, f, indent=4)
+    os.replace(rule_path + ".tmp", rule_path)
+    return rule_path
+
+def write_putative_contigs(prj_dir, fileHeader, file_path, putative):
+    # putative_summary.csv and putative_contigs.fasta of one sample from its rows of consensus.call_putative
+    putative.loc[:, consensus.SUMMARY_COLUMNS].to_csv(os.path.join(prj_dir,"out",fileHeader,"putative_summary.csv"), index=None)
+    with fasta.FastaIndex(file_path) as assembly:
+        assembly.write_records(putative["seq_name"], os.path.join(prj_dir, 'out', fileHeader,'putative_contigs.fasta'))
+
+def extract_putative_contigs_single_sample(prj_dir, fileHeader, file_path, min_len=3000, num_confirmed_tools=2, rule=None):
     # pre-run check
-    files_to_check = [
-        os.path.join(prj_dir,"out",f"{fileHeader}","CAT_results", f"{fileHeader}.nr.contig2classification.with_names.txt"),
-        os.path.join(prj_dir,"out",f"{fileHeader}","VirSorter2_results", f"{fileHeader}-final-viral-score.tsv"),
-        os.path.join(prj_dir,"out",f"{fileHeader}","GeNomad_results",f"{'.'.join(file_path.split('/')[-1].split('.')[:-1])}_summary",f"{'.'.join(file_path.split('/')[-1].split('.')[:-1])}_virus_summary.tsv"),
-        os.path.join(prj_dir,"out",f"{fileHeader}","GeNomad_results",f"{'.'.join(file_path.split('/')[-1].split('.')[:-1])}_summary",f"{'.'.join(file_path.split('/')[-1].split('.')[:-1])}_plasmid_summary.tsv"),
-        os.path.join(prj_dir,"out",f"{fileHeader}","ViraLM_results",f"result_{fileHeader}.csv")
-    ]
+    files_to_check = putative_inputs(prj_dir, fileHeader, file_path)
     for file in files_to_check:
         if not os.path.exists(file):
             print(f'{file} does not exist.')
             return
     
-    cat = pd.read_table(os.path.join(prj_dir,"out",f"{fileHeader}","CAT_results",
-                                     f"{fileHeader}.nr.contig2classification.with_names.txt"), sep='\t', header=0).rename({"# contig":"contig"},axis=1)
-    vs2 = pd.read_table(os.path.join(prj_dir,"out",f"{fileHeader}","VirSorter2_results",
-                                     f"{fileHeader}-final-viral-score.tsv"), sep='\t', header=0)
-    gnm_v = pd.read_table(os.path.join(prj_dir,"out",f"{fileHeader}","GeNomad_results",f"{'.'.join(file_path.split('/')[-1].split('.')[:-1])}_summary",f"{'.'.join(file_path.split('/')[-1].split('.')[:-1])}_virus_summary.tsv"),
-                           sep='\t', header=0)
-    gnm_p = pd.read_table(os.path.join(prj_dir,"out",f"{fileHeader}","GeNomad_results",f"{'.'.join(file_path.split('/')[-1].split('.')[:-1])}_summary",f"{'.'.join(file_path.split('/')[-1].split('.')[:-1])}_plasmid_summary.tsv"),
-                           sep='\t', header=0)
-    vlm = pd.read_table(os.path.join(prj_dir,"out",f"{fileHeader}","ViraLM_results",f"result_{fileHeader}.csv"), sep=',', header=0)
-    completeness_status = pd.read_csv(os.path.join(prj_dir, "completeness_status.csv"), sep=',', header=0, index_col=None)
-    
-    # processing vs2 and gnm reports; adding names
-    cat = cat[cat["classification"]=="taxid assigned"]
-    cat.columns = ["cat_" + x for x in cat.columns.values.tolist()]
-    cat = cat.rename({"cat_contig":"seq_name", "cat_superkingdom":"cat_category"}, axis=1)
-    cat = cat.loc[:,["seq_name","cat_category"]].reset_index(drop=True)
-    
-    if vs2.shape[0]>0:
-        vs2["completeness"] = vs2["seqname"].str.split("||", expand=True)[1]
-        vs2["seqname"] = vs2["seqname"].str.split("||", expand=True)[0]
-        vs2["category"] = "Viruses"
-        vs2.columns = ["vs2_" + x for x in vs2.columns.values.tolist()]
-        vs2 = vs2.rename({"vs2_seqname":"seq_name"}, axis=1)
-        vs2 = vs2[vs2["vs2_max_score_group"]!="RNA"]
-        vs2 = vs2.loc[:, ["seq_name", "vs2_category"]].reset_index(drop=True)
-    else:
-        vs2["completeness"] = None
-        vs2["seqname"] = None
-        vs2["category"] = None
-        vs2.columns = ["vs2_" + x for x in vs2.columns.values.tolist()]
-        vs2 = vs2.rename({"vs2_seqname":"seq_name"}, axis=1)
-        vs2 = vs2[vs2["vs2_max_score_group"]!="RNA"]
-        vs2 = vs2.loc[:, ["seq_name", "vs2_category"]].reset_index(drop=True)
-    
-    gnm_v["category"] = "Viruses"
-    gnm_p["category"] = "Plasmids"
-    gnm = pd.merge(gnm_v, gnm_p, 'outer')
-    gnm.columns = ["gnm_" + x for x in gnm.columns.values.tolist()]
-    gnm = gnm.rename({"gnm_seq_name":"seq_name"}, axis=1)
-    gnm = gnm.loc[:,["seq_name", "gnm_category"]].reset_index(drop=True)
-    
-    vlm = vlm[vlm["virus_score"]>=0.8]
-    vlm["category"] = "Viruses"
-    vlm.columns = ["vlm_" + x for x in vlm.columns.values.tolist()]
-    vlm = vlm.rename({"vlm_seq_name":"seq_name"}, axis=1)
-    vlm = vlm.loc[:, ["seq_name", "vlm_category"]].reset_index(drop=True)
-    
-    all = pd.merge(cat, vs2, on="seq_name", how='outer')
-    all = pd.merge(all, gnm, on="seq_name", how='outer')
-    all = pd.merge(all, vlm, on="seq_name", how='outer')
-    all.to_csv(os.path.join(prj_dir, "out", fileHeader, "putative_summary_tmp.csv"), sep='\t', index=None)
-    bash_commands_1 = [
-        f"grep -F -f <(sed \'1d\' {os.path.join(prj_dir, 'out', fileHeader, 'putative_summary_tmp.csv')} | cut -f1) {completeness_status[completeness_status['fileHeader']==fileHeader].iloc[0]['path']} -w | cut -d\' \' -f1,4 | sed \'s/^>//\' | sed \'s/ /\\t/\' | sed \'s/len=//\' > {os.path.join(prj_dir, 'out', fileHeader, 'putative_contigs_length_info_tmp.csv')}\n"
-    ]
-    with open(os.path.join(prj_dir, "find_len_tmp.sh"), 'w') as f:
-        f.writelines("#!/bin/bash\n")
-        f.writelines(bash_commands_1)
-    os.system(f"chmod +x {os.path.join(prj_dir, 'find_len_tmp.sh')}")
-    os.system(os.path.join(prj_dir, "find_len_tmp.sh"))
-    os.remove(os.path.join(prj_dir, "find_len_tmp.sh"))
-    
-    length = pd.read_table(os.path.join(prj_dir,"out",fileHeader,"putative_contigs_length_info_tmp.csv"), header=None, names=["seq_name", "length"])
-    # merge length info into summary
-    all = pd.merge(all, length, on="seq_name", how='left')
-    # filter putative
-    putative = all.copy()
-    putative_min_len = putative[putative["length"]>=min_len].reset_index(drop=True).set_index(["seq_name","length"])
-    def CountVirus(row):
-        count = row[row=="Viruses"].count()
-        return count
-    putative_min_len["v_count"] = putative_min_len.apply(CountVirus, axis=1)
-    putative_min_len = putative_min_len[((putative_min_len["v_count"]>=2) | (putative_min_len["cat_category"]=="Viruses")) & (putative_min_len["gnm_category"]!="Plasmids")].reset_index().astype({"length":int}).astype(str)
-    putative_min_len.to_csv(os.path.join(prj_dir,"out",fileHeader,"putative_summary.csv"), index=None)
-    os.remove(os.path.join(prj_dir,"out",fileHeader,"putative_summary_tmp.csv"))
-    os.remove(os.path.join(prj_dir, "out", fileHeader, "putative_contigs_length_info_tmp.csv"))
-
-    # extract fasta
-    bash_commands_2 = [
-        f"seqkit grep -f <(sed '1d' {os.path.join(prj_dir, 'out', fileHeader, 'putative_summary.csv')} | cut -f1 -d',') {completeness_status[completeness_status['fileHeader']==fileHeader].iloc[0]['path']} > {os.path.join(prj_dir, 'out', fileHeader,'putative_contigs.fasta')}\n"
-    ]
-    with open(os.path.join(prj_dir, "extract_putative_contigs_tmp.sh"), 'w') as f:
-        f.writelines("#!/bin/bash\n")
-        f.writelines(bash_commands_2)
-    os.system(f"chmod +x {os.path.join(prj_dir, 'extract_putative_contigs_tmp.sh')}")
-    os.system(os.path.join(prj_dir, "extract_putative_contigs_tmp.sh"))
-    os.remove(os.path.join(prj_dir, "extract_putative_contigs_tmp.sh"))
-    
+    sample = consensus.load_sample_calls(prj_dir, fileHeader, file_path)
+    putative = consensus.call_putative(sample["calls"], sample["lengths"], extraction_rule(min_len, num_confirmed_tools, rule))
+    write_putative_contigs(prj_dir, fileHeader, file_path, putative)
 
-def extract_putative_contigs_multi_samples(prj_dir, fileHeader_list, min_len=3000):
-    status = pd.read_csv(os.path.join(prj_dir,"completeness_status.csv"),sep=',',header=0,index_col=None)
-    for fileHeader in fileHeader_list:
-        # if os.path.isfile(os.path.join(prj_dir,"out",fileHeader,"putative_contigs.fasta")):
-        #     print(f"{fileHeader} has finished, skip.")
-        #     continue
-        # else:
-        extract_putative_contigs_single_sample(prj_dir=prj_dir, fileHeader=fileHeader, file_path=status.set_index("fileHeader").loc[fileHeader,"path"], min_len=min_len)
-        # break
+def extract_putative_contigs_multi_samples(prj_dir, fileHeader_list, min_len=3000, num_confirmed_tools=2, rule=None, workers=1, force=False, batch_name=None):
+    # 1. parse (and cache) the tool calls of every sample, 2. call putative contigs for all samples at once,
+    # 3. write the per-sample summaries and fasta files. Changing the rule only redoes steps 2 and 3
+    status = pd.read_csv(os.path.join(prj_dir,"completeness_status.csv"),sep=',',header=0,index_col=None).set_index("fileHeader")
+    rule = extraction_rule(min_len, num_confirmed_tools, rule)
+    rule_path = save_extraction_rule(prj_dir, rule)
+    file_paths = {fileHeader: status.loc[fileHeader,"path"] for fileHeader in fileHeader_list}
+    cache_paths = {fileHeader: os.path.join(prj_dir,"out",fileHeader,"tool_calls.pkl") for fileHeader in fileHeader_list}
+    call_inputs = {fileHeader: putative_inputs(prj_dir, fileHeader, file_path) + [file_path] for fileHeader, file_path in file_paths.items()}
+    tasks = []
+    for fileHeader, file_path in file_paths.items():
+        tasks.append((fileHeader, call_inputs[fileHeader], [cache_paths[fileHeader]], dict(prj_dir=prj_dir, fileHeader=fileHeader, file_path=file_path)))
+    run_samples(prj_dir, stage_name("extract_calls", batch_name), consensus.load_sample_calls, tasks, workers=workers, force=force)
+
+    loaded = [fileHeader for fileHeader in file_paths if all(os.path.exists(x) for x in call_inputs[fileHeader]) and outputs_up_to_date(call_inputs[fileHeader], [cache_paths[fileHeader]])]
+    samples = {fileHeader: pd.read_pickle(cache_paths[fileHeader]) for fileHeader in loaded}
+    if len(samples)==0:
+        print("No sample has all tool outputs.")
+        return
+    calls = pd.concat([sample["calls"].assign(sample=fileHeader) for fileHeader, sample in samples.items()], ignore_index=True)
+    lengths = pd.concat([sample["lengths"].assign(sample=fileHeader) for fileHeader, sample in samples.items()], ignore_index=True)
+    putative = consensus.call_putative(calls, lengths, rule)
+    putative_by_sample = dict(tuple(putative.groupby("sample", sort=False)))
+    tasks = []
+    for fileHeader in loaded:
+        tasks.append((
+            fileHeader,
+            [cache_paths[fileHeader], rule_path, file_paths[fileHeader]],
+            [os.path.join(prj_dir,"out",fileHeader,"putative_summary.csv"), os.path.join(prj_dir,"out",fileHeader,"putative_contigs.fasta")],
+            dict(prj_dir=prj_dir, fileHeader=fileHeader, file_path=file_paths[fileHeader], putative=putative_by_sample.get(fileHeader, putative.iloc[:0])),
+        ))
+    return run_samples(prj_dir, stage_name("extract", batch_name), write_putative_contigs, tasks, workers=workers, force=force)
 
     
 def find_rRNAs_single_file(prj_dir, fileHeader, threads=32):
@@ -127,121 +144,272 @@ def find_rRNAs_single_file(prj_dir, fileHeader, threads=32):
         if not os.path.exists(file):
             return
     
-    if os.path.exists(os.path.join(prj_dir, "out", fileHeader, "rRNAs.tsv")):
-        os.remove(os.path.join(prj_dir, "out", fileHeader, "rRNAs.tsv"))
+    # per-sample script and a temporary table, so samples can run side by side and a killed run never looks finished
+    rRNAs_tmp = os.path.join(prj_dir, 'out', fileHeader, 'rRNAs.tsv.tmp')
+    script = os.path.join(prj_dir, 'out', fileHeader, 'find_rRNAs_tmp.sh')
     bash_commands = [
-        f"source /g/data1b/oo46/wj6768/miniconda3/bin/activate /g/data1b/oo46/wj6768/miniconda3/envs/mpa\n",
-        f"barrnap --kingdom bac --threads {threads} {os.path.join(prj_dir, 'out', fileHeader, 'putative_contigs.fasta')} | sed '1d' >> {os.path.join(prj_dir, 'out', fileHeader, 'rRNAs.tsv')}\n",
-        f"barrnap --kingdom arc --threads {threads} {os.path.join(prj_dir, 'out', fileHeader, 'putative_contigs.fasta')} | sed '1d' >> {os.path.join(prj_dir, 'out', fileHeader, 'rRNAs.tsv')}\n",
-        f"barrnap --kingdom euk --threads {threads} {os.path.join(prj_dir, 'out', fileHeader, 'putative_contigs.fasta')} | sed '1d' >> {os.path.join(prj_dir, 'out', fileHeader, 'rRNAs.tsv')}\n",
-        f"barrnap --kingdom mito --threads {threads} {os.path.join(prj_dir, 'out', fileHeader, 'putative_contigs.fasta')} | sed '1d' >> {os.path.join(prj_dir, 'out', fileHeader, 'rRNAs.tsv')}\n"
+        f"source {envs.CONDA_PATH}/bin/activate {envs.MAIN_ENV_NAME}\n",
+        f"set -eo pipefail\n",
+        f": > {rRNAs_tmp}\n",
+        f"barrnap --kingdom bac --threads {threads} {os.path.join(prj_dir, 'out', fileHeader, 'putative_contigs.fasta')} | sed '1d' >> {rRNAs_tmp}\n",
+        f"barrnap --kingdom arc --threads {threads} {os.path.join(prj_dir, 'out', fileHeader, 'putative_contigs.fasta')} | sed '1d' >> {rRNAs_tmp}\n",
+        f"barrnap --kingdom euk --threads {threads} {os.path.join(prj_dir, 'out', fileHeader, 'putative_contigs.fasta')} | sed '1d' >> {rRNAs_tmp}\n",
+        f"barrnap --kingdom mito --threads {threads} {os.path.join(prj_dir, 'out', fileHeader, 'putative_contigs.fasta')} | sed '1d' >> {rRNAs_tmp}\n",
+        f"mv {rRNAs_tmp} {os.path.join(prj_dir, 'out', fileHeader, 'rRNAs.tsv')}\n",
     ]
-    with open(os.path.join(prj_dir, "find_rRNAs_tmp.sh"), 'w') as f:
+    with open(script, 'w') as f:
         f.writelines("#!/bin/bash\n")
         f.writelines(bash_commands)
-    os.system(f"chmod +x {os.path.join(prj_dir, 'find_rRNAs_tmp.sh')}")
-    os.system(os.path.join(prj_dir, "find_rRNAs_tmp.sh"))
-    os.remove(os.path.join(prj_dir, "find_rRNAs_tmp.sh"))
+    os.system(f"chmod +x {script}")
+    exit_code = os.system(script)
+    os.remove(script)
     if os.path.exists(f"{os.path.join(prj_dir, 'out', fileHeader, 'putative_contigs.fasta')}.fai"):
         os.remove(f"{os.path.join(prj_dir, 'out', fileHeader, 'putative_contigs.fasta.fai')}")
+    if exit_code!=0:
+        if os.path.exists(rRNAs_tmp):
+            os.remove(rRNAs_tmp)
+        raise RuntimeError(f"barrnap failed for {fileHeader} (exit status {exit_code}).")
 
-def find_rRNAs_multi_files(prj_dir, fileHeader_list, threads=32):
+def find_rRNAs_multi_files(prj_dir, fileHeader_list, threads=32, workers=1, force=False, batch_name=None):
+    # threads are shared out among the samples running at the same time
+    tasks = []
     for fileHeader in fileHeader_list:
-        # if os.path.isfile(os.path.join(prj_dir,"out",fileHeader,"rRNAs.tsv")):
-        #     print(f"{fileHeader} has finished, skip.")
-        #     continue
-        # else:
-        find_rRNAs_single_file(prj_dir=prj_dir, fileHeader=fileHeader, threads=threads)
+        tasks.append((
+            fileHeader,
+            [os.path.join(prj_dir, 'out', fileHeader, 'putative_contigs.fasta')],
+            [os.path.join(prj_dir, 'out', fileHeader, 'rRNAs.tsv')],
+            dict(prj_dir=prj_dir, fileHeader=fileHeader, threads=max(1, threads//workers)),
+        ))
+    return run_samples(prj_dir, stage_name("find_rRNAs", batch_name), find_rRNAs_single_file, tasks, workers=workers, force=force)
     
-def extract_decontaminated_contigs_single_file(prj_dir, fileHeader):
+BARRNAP_KINGDOMS = ["bac", "arc", "euk", "mito"]
+BARRNAP_EVALUE = 1e-6
+
+def run_barrnap(fasta_path, kingdom, gff_path, threads, evalue=BARRNAP_EVALUE):
+    # one barrnap run in the main environment; returns (seconds, error message or "")
+    start = time.time()
+    command = f"source {envs.CONDA_PATH}/bin/activate {envs.MAIN_ENV_NAME} && barrnap --kingdom {kingdom} --threads {threads} --evalue {evalue:.6g} {fasta_path} > {gff_path}"
+    result = subprocess.run(["bash", "-c", command], stderr=subprocess.PIPE, text=True)
+    error = "" if result.returncode==0 else f"barrnap --kingdom {kingdom} exited with {result.returncode}: {result.stderr.strip().splitlines()[-1] if result.stderr.strip() else ''}"
+    return time.time()-start, error
+
+def find_rRNAs_pooled(prj_dir, fileHeader_list, threads=32, workers=1, force=False, batch_name=None):
+    # putative contigs of many samples are pooled into `workers` shards (contig names prefixed with s<sample index>__),
+    # the four kingdoms run side by side on every shard, and the hits are split back into each sample's rRNAs.tsv.
+    # nhmmer e-values grow with the size of the searched fasta, so shards are searched with a relaxed cut-off and every
+    # hit's e-value (gff score) is scaled back to its own sample before the usual cut-off is applied; the gff line itself,
+    # score included, is kept as barrnap wrote it
+    start = time.time()
+    report = []
+    samples = []
+    for fileHeader in fileHeader_list:
+        putative_fasta = os.path.join(prj_dir, 'out', fileHeader, 'putative_contigs.fasta')
+        if not os.path.exists(putative_fasta):
+            report.append([fileHeader, "missing_input", 0.0, f"{putative_fasta} does not exist."])
+        elif not force and outputs_up_to_date([putative_fasta], [os.path.join(prj_dir, 'out', fileHeader, 'rRNAs.tsv')]):
+            report.append([fileHeader, "up_to_date", 0.0, ""])
+        else:
+            samples.append(fileHeader)
+    if len(samples)==0:
+        return write_report(prj_dir, stage_name("find_rRNAs", batch_name), report, start)
+
+    pool_dir = os.path.join(prj_dir, stage_name("decontam_pool", batch_name))
+    os.makedirs(pool_dir, exist_ok=True)
+    # whole samples go to the least loaded shard, largest first; every shard runs the four kingdoms at once, so there are
+    # at most threads//4 shards and the barrnap processes together never use more than threads
+    num_shards = max(1, min(workers, len(samples), threads//len(BARRNAP_KINGDOMS)))
+    sizes = {fileHeader: os.path.getsize(os.path.join(prj_dir, 'out', fileHeader, 'putative_contigs.fasta')) for fileHeader in samples}
+    shard_load = [0] * num_shards
+    shard_samples = [[] for _ in range(num_shards)]
+    for fileHeader in sorted(samples, key=lambda x: -sizes[x]):
+        shard = int(np.argmin(shard_load))
+        shard_load[shard] += sizes[fileHeader]
+        shard_samples[shard].append(fileHeader)
+    sample_index = {fileHeader: idx for idx, fileHeader in enumerate(samples)}
+    sample_bp = {fileHeader: 0 for fileHeader in samples}
+    shard_paths = []
+    for shard, fileHeaders in enumerate(shard_samples):
+        shard_paths.append(os.path.join(pool_dir, f"shard_{shard}.fasta"))
+        with open(shard_paths[-1], 'w') as out:
+            for fileHeader in fileHeaders:
+                with open(os.path.join(prj_dir, 'out', fileHeader, 'putative_contigs.fasta'), 'r') as f:
+                    for line in f:
+                        if line.startswith('>'):
+                            out.write(f">s{sample_index[fileHeader]}__{line[1:]}")
+                        else:
+                            sample_bp[fileHeader] += len(line.rstrip())
+                            out.write(line)
+    shard_bp = [sum(sample_bp[x] for x in fileHeaders) for fileHeaders in shard_samples]
+    shard_evalue = [BARRNAP_EVALUE * shard_bp[shard] / max(1, min(sample_bp[x] for x in fileHeaders)) for shard, fileHeaders in enumerate(shard_samples)]
+
+    jobs = [(shard, kingdom) for shard in range(num_shards) for kingdom in BARRNAP_KINGDOMS]
+    def gff_path(shard, kingdom):
+        return os.path.join(pool_dir, f"shard_{shard}.{kingdom}.gff")
+    with ThreadPoolExecutor(max_workers=min(len(jobs), max(1, threads))) as pool:
+        futures = {job: pool.submit(run_barrnap, shard_paths[job[0]], job[1], gff_path(*job), max(1, threads//len(jobs)), shard_evalue[job[0]]) for job in jobs}
+        results = {job: future.result() for job, future in futures.items()}
+
+    for shard, fileHeaders in enumerate(shard_samples):
+        seconds = max(results[(shard, kingdom)][0] for kingdom in BARRNAP_KINGDOMS)
+        errors = [results[(shard, kingdom)][1] for kingdom in BARRNAP_KINGDOMS if results[(shard, kingdom)][1]]
+        if len(errors)>0:
+            report += [[fileHeader, "failed", round(seconds, 2), errors[0]] for fileHeader in fileHeaders]
+            continue
+        # hits in kingdom order (bac, arc, euk, mito) as the per-sample runs append them
+        hits = {fileHeader: [] for fileHeader in fileHeaders}
+        for kingdom in BARRNAP_KINGDOMS:
+            with open(gff_path(shard, kingdom), 'r') as f:
+                for line in f:
+                    if line.startswith('#') or not line.strip():
+                        continue
+                    index, line = line[1:].split("__", 1)
+                    fileHeader = samples[int(index)]
+                    fields = line.split('\t')
+                    evalue = float(fields[5]) * sample_bp[fileHeader] / max(1, shard_bp[shard])
+                    if evalue <= BARRNAP_EVALUE:
+                        hits[fileHeader].append(line)
+        for fileHeader in fileHeaders:
+            rRNAs_path = os.path.join(prj_dir, 'out', fileHeader, 'rRNAs.tsv')
+            with open(rRNAs_path + ".tmp", 'w') as f:
+                f.writelines(hits[fileHeader])
+            os.replace(rRNAs_path + ".tmp", rRNAs_path)
+            report.append([fileHeader, "done", round(seconds, 2), ""])
+        for kingdom in BARRNAP_KINGDOMS:
+            os.remove(gff_path(shard, kingdom))
+        os.remove(shard_paths[shard])
+        if os.path.exists(shard_paths[shard] + ".fai"):
+            os.remove(shard_paths[shard] + ".fai")
+    if len(os.listdir(pool_dir))==0:
+        os.rmdir(pool_dir)
+    return write_report(prj_dir, stage_name("find_rRNAs", batch_name), report, start)
+
+def extract_decontaminated_contigs_single_file(prj_dir, fileHeader, file_path=None):
     
     # pre-run check
     files_to_check = [
         os.path.join(prj_dir, 'out', fileHeader, 'putative_summary.csv'),
         os.path.join(prj_dir, 'out', fileHeader, 'rRNAs.tsv'),
-        os.path.join(prj_dir, "completeness_status.csv")
     ]
+    if file_path is None:
+        files_to_check.append(os.path.join(prj_dir, "completeness_status.csv"))
     for file in files_to_check:
         if not os.path.exists(file):
             return
     
     putative_summary = pd.read_table(os.path.join(prj_dir, 'out', fileHeader, 'putative_summary.csv'), sep=',', header=0).astype({"length":int})
     rRNAs_summary = pd.read_table(os.path.join(prj_dir, 'out', fileHeader, 'rRNAs.tsv'), header=None, names=["seq_name","source","type","start","end","score","strand","phase","attributes"])
-    completeness_status = pd.read_csv(os.path.join(prj_dir, "completeness_status.csv"), sep=',', header=0, index_col=None)
+    if file_path is None:
+        completeness_status = pd.read_csv(os.path.join(prj_dir, "completeness_status.csv"), sep=',', header=0, index_col=None)
+        file_path = completeness_status[completeness_status['fileHeader']==fileHeader].iloc[0]['path']
     
     confirmed_summary = putative_summary.copy()
     confirmed_summary = confirmed_summary[~confirmed_summary["seq_name"].isin(rRNAs_summary["seq_name"])]
     confirmed_summary.to_csv(os.path.join(prj_dir, 'out', fileHeader, 'decontaminated_summary.csv'), sep=',', index=None)
 
     # extract confirmed fasta
-    bash_commands = [
-        f"seqkit grep -f <(sed '1d' {os.path.join(prj_dir, 'out', fileHeader, 'decontaminated_summary.csv')} | cut -f1 -d',') {completeness_status[completeness_status['fileHeader']==fileHeader].iloc[0]['path']} > {os.path.join(prj_dir, 'out', fileHeader, 'decontaminated_contigs.fasta')}\n"
-    ]
-    with open(os.path.join(prj_dir, "extract_decontaminated_contigs_tmp.sh"), 'w') as f:
-        f.writelines("#!/bin/bash\n")
-        f.writelines(bash_commands)
-    os.system(f"chmod +x {os.path.join(prj_dir, 'extract_decontaminated_contigs_tmp.sh')}")
-    os.system(os.path.join(prj_dir, "extract_decontaminated_contigs_tmp.sh"))
-    os.remove(os.path.join(prj_dir, "extract_decontaminated_contigs_tmp.sh"))
+    with fasta.FastaIndex(file_path) as assembly:
+        assembly.write_records(confirmed_summary["seq_name"].astype(str), os.path.join(prj_dir, 'out', fileHeader, 'decontaminated_contigs.fasta'))
     
-def extract_decontaminated_contigs_multi_files(prj_dir, fileHeader_list):
+def extract_decontaminated_contigs_multi_files(prj_dir, fileHeader_list, workers=1, force=False, batch_name=None):
+    status = pd.read_csv(os.path.join(prj_dir,"completeness_status.csv"),sep=',',header=0,index_col=None).set_index("fileHeader")
+    tasks = []
     for fileHeader in fileHeader_list:
-        # if os.path.isfile(os.path.join(prj_dir,"out",fileHeader,"decontaminated_contigs.fasta")):
-        #     print(f"{fileHeader} has finished, skip.")
-        #     continue
-        # else:
-        extract_decontaminated_contigs_single_file(prj_dir=prj_dir, fileHeader=fileHeader)
+        file_path = status.loc[fileHeader,"path"]
+        tasks.append((
+            fileHeader,
+            [os.path.join(prj_dir, 'out', fileHeader, 'putative_summary.csv'), os.path.join(prj_dir, 'out', fileHeader, 'rRNAs.tsv'), file_path],
+            [os.path.join(prj_dir, 'out', fileHeader, 'decontaminated_summary.csv'), os.path.join(prj_dir, 'out', fileHeader, 'decontaminated_contigs.fasta')],
+            dict(prj_dir=prj_dir, fileHeader=fileHeader, file_path=file_path),
+        ))
+    return run_samples(prj_dir, stage_name("decontam", batch_name), extract_decontaminated_contigs_single_file, tasks, workers=workers, force=force)
         
-def merge_confirmed_contigs(prj_dir, fileHeader_list):
+def generate_post_process_jobs(prj_dir, config, batch_size=10, extract_options="", pooled=False, fileHeader_list=None):
+    # one job per batch of samples (batched like the search jobs) that runs extract, barrnap decontamination
+    # and extraction of the decontaminated contigs on a compute node; fileHeader_list limits the jobs to those samples
+    status = pd.read_csv(os.path.join(prj_dir,"completeness_status.csv"), sep=',', header=0, index_col=None)
+    if fileHeader_list is not None:
+        status = status[status["fileHeader"].astype(str).isin([str(x) for x in fileHeader_list])]
+    job_dir = os.path.join(prj_dir,"jobs")
+    log_dir = os.path.join(prj_dir,"logs")
+    os.makedirs(job_dir, exist_ok=True)
+    os.makedirs(log_dir, exist_ok=True)
+    script_path = os.path.join(envs.INSTALLATION_PATH,"src")
+    ncpus = config['bash']['ncpus'] if config['job_manager']=='bash' else config['pbs']['ncpus']
+    job_names = []
+    for chunk in job_management.chunk_dataframe(status, size=batch_size):
+        job_name = f"post_{chunk.index.to_list()[0]+1}_{chunk.index.to_list()[-1]+1}"
+        samples = ' '.join(chunk["fileHeader"].astype(str).to_list())
+        bash_commands = [
+            f"source {envs.CONDA_PATH}/bin/activate {envs.MAIN_ENV_NAME}",
+            f"python {os.path.join(script_path, 'main.py')} -p {prj_dir} extract {extract_options} -w {ncpus} --batch_name {job_name} --samples {samples}",
+            f"python {os.path.join(script_path, 'main.py')} -p {prj_dir} decontam -w {ncpus} --batch_name {job_name}" + (" --pooled" if pooled else "") + f" --samples {samples}",
+        ]
+        job_names += job_management.save_stage_job(config, job_name, bash_commands, job_dir, log_dir, mem="32GB", walltime="10:00:00", ncpus=ncpus)
+    print(f"{len(job_names)} post-processing jobs written to {job_dir}")
+    return job_names
+
+def current_fasta(path):
+    # path or its compressed version path.gz, whichever was written last
+    if os.path.exists(path + ".gz") and (not os.path.exists(path) or os.path.getmtime(path + ".gz") >= os.path.getmtime(path)):
+        return path + ".gz"
+    return path
+
+def sketch_mem(catalogue):
+    # sketch.py keeps every sketch (~bp/100 hashes at --scaled 100), the np.unique inverse, the presence matrix and the
+    # shared-hash product in memory at once; budget ~4 bytes per catalogue byte on top of 16GB, or the stage default
+    # when the catalogue is not there yet
+    if not os.path.isfile(catalogue):
+        return "64GB"
+    return f"{int(np.ceil(16 + 4 * os.path.getsize(catalogue) / 1e9))}GB"
+
+def merge_confirmed_contigs(prj_dir, fileHeader_list, compress=False, threads=1):
     if not os.path.isdir(os.path.join(prj_dir,"OVU")):
         os.makedirs(os.path.join(prj_dir,"OVU"), exist_ok=True)
-    with open(os.path.join(prj_dir,"OVU","merged_decontaminated_contigs.fasta"), 'w') as merged_confirmed_contigs:
-        for fileHeader in fileHeader_list:
-            if not os.path.exists(os.path.join(prj_dir, 'out', fileHeader, 'decontaminated_contigs.fasta')):
-                print(f"{os.path.join(prj_dir, 'out', fileHeader, 'decontaminated_contigs.fasta')} not exist. Exiting.")
-                return
-        for fileHeader in fileHeader_list:
-            with open(os.path.join(prj_dir, 'out', fileHeader, 'decontaminated_contigs.fasta'), 'r') as fasta:
-                sequence = []
-                for line in fasta:
-                    if line.startswith('>'):
-                        sequence.append(f">{fileHeader}_{line[1:]}")
-                    else:
-                        sequence.append(line)
-                merged_confirmed_contigs.writelines(sequence)
-
-def dedup(prj_dir):
-    merged_fasta = os.path.join(prj_dir,"OVU","merged_decontaminated_contigs.fasta")
+    for fileHeader in fileHeader_list:
+        if not os.path.exists(os.path.join(prj_dir, 'out', fileHeader, 'decontaminated_contigs.fasta')):
+            print(f"{os.path.join(prj_dir, 'out', fileHeader, 'decontaminated_contigs.fasta')} not exist. Exiting.")
+            return
+    # headers become {fileHeader}_{contig}; the merged .fai and a contig-to-sample table are written along the way
+    inputs = [(os.path.join(prj_dir, 'out', fileHeader, 'decontaminated_contigs.fasta'), f"{fileHeader}_", fileHeader) for fileHeader in fileHeader_list]
+    merged_fasta = os.path.join(prj_dir,"OVU","merged_decontaminated_contigs.fasta") + (".gz" if compress else "")
+    num_contigs = fasta.merge_fastas(inputs, merged_fasta, table_path=os.path.join(prj_dir,"OVU","merged_contig_samples.tsv"), threads=threads)
+    print(f"merge: {num_contigs} contigs of {len(fileHeader_list)} samples written to {merged_fasta}")
+
+def dedup(prj_dir, workers=1):
+    # a compressed merged catalogue (merge --compress) gives compressed dedup outputs
+    merged_fasta = current_fasta(os.path.join(prj_dir,"OVU","merged_decontaminated_contigs.fasta"))
+    suffix = ".gz" if fasta.is_compressed(merged_fasta) else ""
     dedup_details = os.path.join(prj_dir,"OVU","merged_decontaminated_contigs_dedup_detail.txt")
-    dup = os.path.join(prj_dir,"OVU","merged_decontaminated_contigs_dup.fasta")
-    dedup = os.path.join(prj_dir,"OVU","merged_decontaminated_contigs_dedup.fasta")
+    dup = os.path.join(prj_dir,"OVU","merged_decontaminated_contigs_dup.fasta") + suffix
+    dedup = os.path.join(prj_dir,"OVU","merged_decontaminated_contigs_dedup.fasta") + suffix
     if not os.path.isdir(os.path.join(prj_dir,"OVU")):
         os.makedirs(os.path.join(prj_dir,"OVU"), exist_ok=True)
-    bash_commands = [
-        f"source {envs.CONDA_PATH}/bin/activate {envs.MAIN_ENV_NAME}\n",
-        f"cat {merged_fasta} | seqkit rmdup -s -D {dedup_details} -d {dup} -o {dedup}\n",
-    ]
-    with open(os.path.join(prj_dir, "dedup_tmp.sh"), 'w') as f:
-        f.writelines("#!/bin/bash\n")
-        f.writelines(bash_commands)
-    os.system(f"chmod +x {os.path.join(prj_dir, 'dedup_tmp.sh')}")
-    os.system(os.path.join(prj_dir, "dedup_tmp.sh"))
-    os.remove(os.path.join(prj_dir, "dedup_tmp.sh"))
+    # reverse-complement copies of a contig from different assemblies count as duplicates too
+    num_unique, num_removed = fasta.dedup_fasta(merged_fasta, dedup, dup, dedup_details, workers=workers)
+    print(f"dedup: {num_unique} unique contigs kept, {num_removed} duplicates removed. Details in {dedup_details}")
 
-def check_quality(prj_dir, config):
-    dedup = os.path.join(prj_dir,"OVU","merged_decontaminated_contigs_dedup.fasta")
+def check_quality(prj_dir, config, num_shards=1):
+    if num_shards>1:
+        check_quality_staged(prj_dir, config, num_shards=num_shards)
+        return
+    dedup = current_fasta(os.path.join(prj_dir,"OVU","merged_decontaminated_contigs_dedup.fasta"))
+    uncontained = os.path.join(prj_dir,"OVU","merged_decontaminated_contigs_uncontained.fasta")
+    contained_table = os.path.join(prj_dir,"OVU","contained_contigs.tsv")
     quality_check_dir = os.path.join(prj_dir,'OVU','quality_check')
     quality_filtered_fasta = os.path.join(prj_dir,'OVU','quality_filtered_viral_contigs.fasta')
     log_dir = os.path.join(prj_dir,'OVU')
     job_dir = os.path.join(prj_dir,'OVU')
+    script_path = os.path.join(envs.INSTALLATION_PATH,"src")
     if config['job_manager'] in ['pbs', 'gadi']:
         threads = config['pbs']['ncpus']
     if not os.path.isdir(os.path.join(prj_dir,"OVU")):
         os.makedirs(os.path.join(prj_dir,"OVU"), exist_ok=True)
+    # contigs found verbatim inside a longer contig skip CheckV and blast; cluster adds them back to their container's OVU
     bash_commands = [
         f"source {envs.CONDA_PATH}/bin/activate {envs.MAIN_ENV_NAME}",
-        f"checkv end_to_end {dedup} {quality_check_dir} -d {envs.CHECKV_DB_PATH} -t {threads}",
-        f"seqkit grep -f <(awk -F \'\\t\' \'{{if ($6 == 0 && $8 == \"Not-determined\") {{next;}} print $1}}\' {quality_check_dir}/quality_summary.tsv | sed \'1d\') {dedup} > {quality_filtered_fasta}",
+        f"python {os.path.join(script_path, 'contain.py')} filter -i {dedup} -o {uncontained} --table {contained_table}",
+        f"checkv end_to_end {uncontained} {quality_check_dir} -d {envs.CHECKV_DB_PATH} -t {threads}",
+        f"seqkit grep -f <(awk -F \'\\t\' \'{{if ($6 == 0 && $8 == \"Not-determined\") {{next;}} print $1}}\' {quality_check_dir}/quality_summary.tsv | sed \'1d\') {uncontained} > {quality_filtered_fasta}",
     ]
     bash_commands = [x+"\n" for x in bash_commands]
     if config['job_manager']=='pbs':
@@ -306,39 +474,132 @@ def check_quality(prj_dir, config):
     # os.system(os.path.join(prj_dir, "check_quality_tmp.sh"))
     # os.remove(os.path.join(prj_dir, "check_quality_tmp.sh"))
 
-def cluster(prj_dir, config):
+def check_quality_staged(prj_dir, config, num_shards=2):
+    # CheckV split into contig shards balanced by total bp: prepare -> checkv (array, one subjob per shard) -> merge & filter.
+    # Submit in order with OVU/check_quality_submit.sh
+    dedup = current_fasta(os.path.join(prj_dir,"OVU","merged_decontaminated_contigs_dedup.fasta"))
+    uncontained = os.path.join(prj_dir,"OVU","merged_decontaminated_contigs_uncontained.fasta")
+    contained_table = os.path.join(prj_dir,"OVU","contained_contigs.tsv")
+    shard_dir = os.path.join(prj_dir,"OVU","quality_check_shards")
+    job_dir = os.path.join(prj_dir,"OVU")
+    log_dir = os.path.join(prj_dir,"OVU")
+    script_path = os.path.join(envs.INSTALLATION_PATH,"src")
+    threads = config['bash']['ncpus'] if config['job_manager']=='bash' else config['pbs']['ncpus']
+    os.makedirs(job_dir, exist_ok=True)
+    prepare_commands = [
+        f"source {envs.CONDA_PATH}/bin/activate {envs.MAIN_ENV_NAME}",
+        f"python {os.path.join(script_path, 'contain.py')} filter -i {dedup} -o {uncontained} --table {contained_table}",
+        f"rm -rf {shard_dir}",
+        f"python {os.path.join(script_path, 'utils', 'fasta.py')} split -i {uncontained} -o {shard_dir} -n {num_shards}",
+    ]
+    # fewer contigs than shards leaves some subjobs without a shard
+    checkv_commands = [
+        f"source {envs.CONDA_PATH}/bin/activate {envs.MAIN_ENV_NAME}",
+        f"shard={shard_dir}/shard_$PBS_ARRAY_INDEX.fasta",
+        f"if [ ! -f $shard ]; then echo \"no shard $PBS_ARRAY_INDEX, finished\"; exit 0; fi",
+        f"checkv end_to_end $shard {shard_dir}/checkv_$PBS_ARRAY_INDEX -d {envs.CHECKV_DB_PATH} -t {threads}",
+    ]
+    merge_commands = [
+        f"source {envs.CONDA_PATH}/bin/activate {envs.MAIN_ENV_NAME}",
+        f"python {os.path.join(script_path, 'main.py')} -p {prj_dir} check_quality --merge_shards",
+    ]
+    stages = [
+        job_management.save_stage_job(config, "check_quality_prepare", prepare_commands, job_dir, log_dir, mem="16GB", walltime="2:00:00"),
+        job_management.save_stage_job(config, "check_quality_checkv", checkv_commands, job_dir, log_dir, array_indices=list(range(num_shards))),
+        job_management.save_stage_job(config, "check_quality_merge", merge_commands, job_dir, log_dir, mem="16GB", walltime="2:00:00"),
+    ]
+    job_management.save_submit_script(job_dir, stages, "check_quality_submit.sh", job_manager=config['job_manager'])
+    print(f"Jobs written to {job_dir}; submit them in order with {os.path.join(job_dir, 'check_quality_submit.sh')}")
+
+def merge_quality_shards(prj_dir):
+    # concatenate the per-shard CheckV quality_summary.tsv files (in shard order) into OVU/quality_check/quality_summary.tsv
+    # and keep the contigs that CheckV could say anything about: at least one viral gene or a determined quality
+    shard_dir = os.path.join(prj_dir,"OVU","quality_check_shards")
+    quality_check_dir = os.path.join(prj_dir,'OVU','quality_check')
+    uncontained = os.path.join(prj_dir,"OVU","merged_decontaminated_contigs_uncontained.fasta")
+    quality_filtered_fasta = os.path.join(prj_dir,'OVU','quality_filtered_viral_contigs.fasta')
+    shards = sorted((int(x.split("_")[-1]), x) for x in os.listdir(shard_dir) if x.startswith("checkv_"))
+    missing = [x for _, x in shards if not os.path.exists(os.path.join(shard_dir, x, "quality_summary.tsv"))]
+    if len(shards)==0 or len(missing)>0:
+        raise RuntimeError(f"CheckV did not finish for {', '.join(missing) if missing else 'any shard'} in {shard_dir}")
+    summary = pd.concat([pd.read_table(os.path.join(shard_dir, x, "quality_summary.tsv"), sep='\t', header=0, dtype={"contig_id":str}) for _, x in shards], ignore_index=True)
+    os.makedirs(quality_check_dir, exist_ok=True)
+    summary.to_csv(os.path.join(quality_check_dir, "quality_summary.tsv"), sep='\t', index=False)
+    passed = summary.loc[~((summary["viral_genes"]==0) & (summary["checkv_quality"]=="Not-determined")), "contig_id"]
+    with fasta.FastaIndex(uncontained) as contigs:
+        num_passed = contigs.write_records(passed, quality_filtered_fasta)
+    print(f"check_quality: {len(summary)} contigs from {len(shards)} CheckV shards, {num_passed} written to {quality_filtered_fasta}")
+
+def cluster(prj_dir, config, incremental=False, keep_blast=False, num_shards=1, prefilter=False):
     job_dir = os.path.join(prj_dir,"OVU")
     log_dir = os.path.join(prj_dir,"OVU")
     quality_filtered_fasta = os.path.join(prj_dir,'OVU','quality_filtered_viral_contigs.fasta')
     script_path = os.path.join(envs.INSTALLATION_PATH,"src")
     if config['job_manager'] in ['pbs', 'gadi']:
         threads = config['pbs']['ncpus']
-    bash_commands = [
-        f"source {envs.CONDA_PATH}/bin/activate {envs.MAIN_ENV_NAME}",
-        f"echo \"make blast db ...\"",
-        f"makeblastdb -in {quality_filtered_fasta} -out {prj_dir}/OVU/blastdb_for_anicluster/blastdb_for_anicluster -dbtype nucl",
-        f"echo \"blasting ...\"",
-        f"blastn -query {quality_filtered_fasta} -db {prj_dir}/OVU/blastdb_for_anicluster/blastdb_for_anicluster -out {prj_dir}/OVU/filtered_blast.tsv -outfmt '6 std qlen slen' -max_target_seqs 25000 -perc_identity 90",
-        f"echo \"blast finished\"",
-        f"python {os.path.join(script_path, 'blastani.py')} -i {prj_dir}/OVU/filtered_blast.tsv -o {prj_dir}/OVU/filtered_ani.tsv",
-        f"echo \"compute ANI finished\"",
-        f"python {os.path.join(script_path, 'cluster.py')} --fna {quality_filtered_fasta} --ani {prj_dir}/OVU/filtered_ani.tsv --out {prj_dir}/OVU/filtered_clusters.tsv --min_ani 95 --min_qcov 0 --min_tcov 85",
-        f"echo \"cluster finished\"",
-        f"echo \"extract representatives ...\"",
-        f"seqkit grep -f <(cat {prj_dir}/OVU/filtered_clusters.tsv | cut -f1) {quality_filtered_fasta} > {prj_dir}/OVU/rep_contigs.fasta",
-        f"echo \"finished\"",
-    ]
+    job_name = "cluster_incremental" if incremental else "cluster"
+    if incremental:
+        # keep existing OVUs; only align new contigs against the representatives and each other
+        # coverage is not prefiltered here since cluster.py flips new-vs-representative alignments
+        for file in [os.path.join(prj_dir,"OVU","filtered_clusters.tsv"), os.path.join(prj_dir,"OVU","rep_contigs.fasta")]:
+            if not os.path.exists(file):
+                print(f"{file} does not exist. Run cluster without --incremental first.")
+                return
+        incremental_dir = os.path.join(prj_dir,"OVU","incremental")
+        new_fasta = os.path.join(incremental_dir,"new_contigs.fasta")
+        reps_and_new_fasta = os.path.join(incremental_dir,"reps_and_new_contigs.fasta")
+        bash_commands = [
+            f"source {envs.CONDA_PATH}/bin/activate {envs.MAIN_ENV_NAME}",
+            f"set -eo pipefail",
+            f"mkdir -p {incremental_dir}",
+            f"echo \"extract new contigs ...\"",
+            f"seqkit grep -v -f <(cut -f2 {prj_dir}/OVU/filtered_clusters.tsv | tr ',' '\\n') {quality_filtered_fasta} > {new_fasta}",
+            f"if [ ! -s {new_fasta} ]; then echo \"no new contigs, finished\"; exit 0; fi",
+            f"cat {prj_dir}/OVU/rep_contigs.fasta {new_fasta} > {reps_and_new_fasta}",
+            f"echo \"make blast db ...\"",
+            f"makeblastdb -in {reps_and_new_fasta} -out {incremental_dir}/blastdb_for_anicluster/blastdb_for_anicluster -dbtype nucl",
+            f"echo \"blasting ...\"",
+            f"blastn -query {new_fasta} -db {incremental_dir}/blastdb_for_anicluster/blastdb_for_anicluster -outfmt '6 std qlen slen' -max_target_seqs 25000 -perc_identity 90 -num_threads {threads} | python {os.path.join(script_path, 'blastani.py')} -i - -o {incremental_dir}/filtered_ani.tsv --min_ani 95" + (f" --blast_out {incremental_dir}/filtered_blast.tsv" if keep_blast else ""),
+            f"echo \"blast and compute ANI finished\"",
+            f"python {os.path.join(script_path, 'cluster.py')} --fna {new_fasta} --reps {prj_dir}/OVU/rep_contigs.fasta --clusters {prj_dir}/OVU/filtered_clusters.tsv --ani {incremental_dir}/filtered_ani.tsv --out {incremental_dir}/filtered_clusters.tsv --min_ani 95 --min_qcov 0 --min_tcov 85",
+            f"cp {prj_dir}/OVU/filtered_clusters.tsv {incremental_dir}/filtered_clusters.previous.tsv",
+            f"mv {incremental_dir}/filtered_clusters.tsv {prj_dir}/OVU/filtered_clusters.tsv",
+            f"python {os.path.join(script_path, 'contain.py')} add --clusters {prj_dir}/OVU/filtered_clusters.tsv --table {prj_dir}/OVU/contained_contigs.tsv",
+            f"echo \"cluster finished\"",
+            f"echo \"extract representatives ...\"",
+            f"seqkit grep -f <(cat {prj_dir}/OVU/filtered_clusters.tsv | cut -f1) {reps_and_new_fasta} > {prj_dir}/OVU/rep_contigs.fasta",
+            f"echo \"finished\"",
+        ]
+    elif num_shards>1 or prefilter:
+        cluster_staged(prj_dir, config, num_shards=num_shards, keep_blast=keep_blast, prefilter=prefilter)
+        return
+    else:
+        bash_commands = [
+            f"source {envs.CONDA_PATH}/bin/activate {envs.MAIN_ENV_NAME}",
+            f"set -eo pipefail",
+            f"echo \"make blast db ...\"",
+            f"makeblastdb -in {quality_filtered_fasta} -out {prj_dir}/OVU/blastdb_for_anicluster/blastdb_for_anicluster -dbtype nucl",
+            f"echo \"blasting ...\"",
+            f"blastn -query {quality_filtered_fasta} -db {prj_dir}/OVU/blastdb_for_anicluster/blastdb_for_anicluster -outfmt '6 std qlen slen' -max_target_seqs 25000 -perc_identity 90 -num_threads {threads} | python {os.path.join(script_path, 'blastani.py')} -i - -o {prj_dir}/OVU/filtered_ani.tsv --min_ani 95 --min_qcov 0 --min_tcov 85" + (f" --blast_out {prj_dir}/OVU/filtered_blast.tsv" if keep_blast else ""),
+            f"echo \"blast and compute ANI finished\"",
+            f"python {os.path.join(script_path, 'cluster.py')} --fna {quality_filtered_fasta} --ani {prj_dir}/OVU/filtered_ani.tsv --out {prj_dir}/OVU/filtered_clusters.tsv --min_ani 95 --min_qcov 0 --min_tcov 85",
+            f"python {os.path.join(script_path, 'contain.py')} add --clusters {prj_dir}/OVU/filtered_clusters.tsv --table {prj_dir}/OVU/contained_contigs.tsv",
+            f"echo \"cluster finished\"",
+            f"echo \"extract representatives ...\"",
+            f"seqkit grep -f <(cat {prj_dir}/OVU/filtered_clusters.tsv | cut -f1) {quality_filtered_fasta} > {prj_dir}/OVU/rep_contigs.fasta",
+            f"echo \"finished\"",
+        ]
     bash_commands = [x+"\n" for x in bash_commands]
     if config['job_manager']=='pbs':
         cluster_job_header = job_management.PBSHeader(
-            job_name="cluster",
+            job_name=job_name,
             ncpus=threads,
             ngpus=0,
             mem="64GB",
             walltime="10:00:00",
             mail_addr=config['pbs']['mail_addr'],
-            log_o=f"{log_dir}/cluster.o",
-            log_e=f"{log_dir}/cluster.e",
+            log_o=f"{log_dir}/{job_name}.o",
+            log_e=f"{log_dir}/{job_name}.e",
         )
         cluster_job = job_management.Job(
             job_manager='pbs',job_header=cluster_job_header, commands=bash_commands,
@@ -346,14 +607,14 @@ def cluster(prj_dir, config):
         cluster_job.save_job(job_dir=job_dir)
     elif config['job_manager']=='gadi':
         cluster_job_header = job_management.GadiHeader(
-            job_name="cluster",
+            job_name=job_name,
             ncpus=threads,
             ngpus=0,
             mem="64GB",
             walltime="10:00:00",
             mail_addr=config['pbs']['mail_addr'],
-            log_o=f"{log_dir}/cluster.o",
-            log_e=f"{log_dir}/cluster.e",
+            log_o=f"{log_dir}/{job_name}.o",
+            log_e=f"{log_dir}/{job_name}.e",
             project=config['pbs']['gadi']['-P project'],
             storage=config['pbs']['gadi']['-l storage'],
             node_type="normalsl",
@@ -392,6 +653,89 @@ def cluster(prj_dir, config):
     
     return
 
+def cluster_staged(prj_dir, config, num_shards=1, keep_blast=False, prefilter=False):
+    # all-vs-all blast split into query shards: prepare -> blast (array, one subjob per num_shards) -> merge & cluster
+    # without prefilter, shards are contiguous and balanced by total bp; with prefilter, sketch.py writes query batches
+    # that are only aligned against their MinHash candidates. Submit in order with OVU/cluster_submit.sh
+    job_dir = os.path.join(prj_dir,"OVU")
+    log_dir = os.path.join(prj_dir,"OVU")
+    quality_filtered_fasta = os.path.join(prj_dir,'OVU','quality_filtered_viral_contigs.fasta')
+    script_path = os.path.join(envs.INSTALLATION_PATH,"src")
+    threads = config['bash']['ncpus'] if config['job_manager']=='bash' else config['pbs']['ncpus']
+    blastdb = f"{prj_dir}/OVU/blastdb_for_anicluster/blastdb_for_anicluster"
+    shard_dir = os.path.join(prj_dir,"OVU","blast_shards")
+    ani_shard_dir = os.path.join(prj_dir,"OVU","ani_shards")
+    prepare_commands = [
+        f"source {envs.CONDA_PATH}/bin/activate {envs.MAIN_ENV_NAME}",
+        f"set -eo pipefail",
+        f"echo \"make blast db ...\"",
+        f"makeblastdb -in {quality_filtered_fasta} -out {blastdb} -dbtype nucl",
+        f"rm -rf {shard_dir} {ani_shard_dir}",
+        f"mkdir -p {ani_shard_dir}",
+    ]
+    if prefilter:
+        prepare_commands += [
+            f"echo \"sketch and find candidate pairs ...\"",
+            f"python {os.path.join(script_path, 'sketch.py')} -i {quality_filtered_fasta} -o {shard_dir} -n {max(100, num_shards)} -t {threads}",
+        ]
+    else:
+        prepare_commands += [
+            f"echo \"split queries ...\"",
+            f"python {os.path.join(script_path, 'utils', 'fasta.py')} split -i {quality_filtered_fasta} -o {shard_dir} -n {num_shards}",
+        ]
+    prepare_commands += [f"echo \"finished\""]
+    # subjob PBS_ARRAY_INDEX takes every query shard i with i % num_shards == PBS_ARRAY_INDEX; shards missing
+    # because there were fewer contigs (or no candidates) are simply not there to take
+    # a shard with subjects_i.fasta is aligned against a db of those subjects only, with e-values scaled to the full catalogue
+    blast_commands = [
+        f"source {envs.CONDA_PATH}/bin/activate {envs.MAIN_ENV_NAME}",
+        f"set -eo pipefail",
+        f"for query in {shard_dir}/shard_*.fasta; do",
+        f"    [ -f $query ] || continue",
+        f"    i=$(basename $query .fasta); i=${{i#shard_}}",
+        f"    if [ $((i % {num_shards})) -ne $PBS_ARRAY_INDEX ]; then continue; fi",
+        f"    echo \"blasting shard $i ...\"",
+        f"    db={blastdb}; dbsize=\"\"",
+        f"    if [ -f {shard_dir}/subjects_$i.fasta ]; then",
+        f"        makeblastdb -in {shard_dir}/subjects_$i.fasta -out {shard_dir}/blastdb_$i/blastdb -dbtype nucl > /dev/null",
+        f"        db={shard_dir}/blastdb_$i/blastdb; dbsize=\"-dbsize $(cat {shard_dir}/dbsize)\"",
+        f"    fi",
+        f"    blastn -query $query -db $db $dbsize -outfmt '6 std qlen slen' -max_target_seqs 25000 -perc_identity 90 -num_threads {threads} | python {os.path.join(script_path, 'blastani.py')} -i - -o {ani_shard_dir}/shard_$i.tsv --min_ani 95 --min_qcov 0 --min_tcov 85" + (f" --blast_out {ani_shard_dir}/blast_$i.tsv" if keep_blast else ""),
+        f"done",
+        f"echo \"finished\"",
+    ]
+    if num_shards==1:
+        blast_commands.insert(0, "PBS_ARRAY_INDEX=0")
+    # shards are contiguous runs of queries, so concatenating them in index order keeps the single-job row order
+    merge_commands = [
+        f"source {envs.CONDA_PATH}/bin/activate {envs.MAIN_ENV_NAME}",
+        f"set -eo pipefail",
+        f"echo \"merge ANI shards ...\"",
+        f"printf \"qname\\ttname\\tnum_alns\\tpid\\tqcov\\ttcov\\n\" > {prj_dir}/OVU/filtered_ani.tsv",
+        f"for ani in $(ls {ani_shard_dir}/shard_*.tsv | sort -V); do tail -n +2 $ani >> {prj_dir}/OVU/filtered_ani.tsv; done",
+    ]
+    if keep_blast:
+        merge_commands += [
+            f"cat $(ls {ani_shard_dir}/blast_*.tsv | sort -V) > {prj_dir}/OVU/filtered_blast.tsv",
+        ]
+    merge_commands += [
+        f"echo \"blast and compute ANI finished\"",
+        f"python {os.path.join(script_path, 'cluster.py')} --fna {quality_filtered_fasta} --ani {prj_dir}/OVU/filtered_ani.tsv --out {prj_dir}/OVU/filtered_clusters.tsv --min_ani 95 --min_qcov 0 --min_tcov 85",
+        f"python {os.path.join(script_path, 'contain.py')} add --clusters {prj_dir}/OVU/filtered_clusters.tsv --table {prj_dir}/OVU/contained_contigs.tsv",
+        f"echo \"cluster finished\"",
+        f"echo \"extract representatives ...\"",
+        f"seqkit grep -f <(cat {prj_dir}/OVU/filtered_clusters.tsv | cut -f1) {quality_filtered_fasta} > {prj_dir}/OVU/rep_contigs.fasta",
+        f"echo \"finished\"",
+    ]
+    stages = [
+        job_management.save_stage_job(config, "cluster_prepare", prepare_commands, job_dir, log_dir, mem=sketch_mem(quality_filtered_fasta) if prefilter else "16GB", walltime="2:00:00"),
+        job_management.save_stage_job(config, "cluster_blast", blast_commands, job_dir, log_dir, array_indices=list(range(num_shards)) if num_shards>1 else None),
+        job_management.save_stage_job(config, "cluster_merge", merge_commands, job_dir, log_dir),
+    ]
+    job_management.save_submit_script(job_dir, stages, "cluster_submit.sh", job_manager=config['job_manager'])
+    print(f"Jobs written to {job_dir}; submit them in order with {os.path.join(job_dir, 'cluster_submit.sh')}")
+    return
+
 def find_genomad_header():
     genomad_out_header = os.path.join("/g/data/oo46/wj6768/Healthy_Virome_HOAM_STOOL","out","HOAM22501", "GeNomad_results", "*_summary", "*_virus_summary.tsv")
     # genomad_out_header = os.path.basename(glob.glob("/g/data/oo46/wj6768/Healthy_Virome_HOAM_STOOL/out/HOAM22501/GeNomad_results/*_summary")[0]).split()